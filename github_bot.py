@@ -11,11 +11,28 @@ import argparse
 import threading
 import base64
 import hashlib
+import hmac
+import itertools
+import math
+import secrets
+import sqlite3
+import signal
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from datetime import datetime, timedelta
-from urllib.parse import quote_plus
-from typing import Dict, List, Optional, Tuple, Any, Union
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, quote_plus
+from typing import Dict, List, Optional, Tuple, Any, Union, Iterator, Callable
 import telebot
-from telebot.types import Message, ReactionTypeEmoji, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from io import BytesIO
+from telebot.types import Message, ReactionTypeEmoji, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Update
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 # ========== КОНФИГУРАЦИЯ ==========
 logging.basicConfig(
@@ -29,12 +46,71 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN")
 MAIN_CHANNEL = os.environ.get("MAIN_CHANNEL_ID", "@da4a_hr")
 ZEN_CHANNEL = os.environ.get("ZEN_CHANNEL_ID", "@tehdzenm")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemma-3-27b-it")
 PEXELS_API_KEY = os.environ.get("PEXELS_API_KEY")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")
 GITHUB_TOKEN = os.environ.get("MANAGER_GITHUB_TOKEN")
 REPO_NAME = os.environ.get("REPO_NAME", "")
 REPO_OWNER = os.environ.get("GITHUB_REPOSITORY_OWNER", "")
 
+# Общий бюджет времени (сек) на генерацию Telegram и Дзен постов одного слота
+GENERATION_BUDGET = int(os.environ.get("GENERATION_BUDGET", "300"))
+# Бюджет (сек) одного запроса к Gemini, если вызывающий не передал дедлайн, и всей перегенерации по кнопке модерации
+GEMINI_REQUEST_BUDGET = int(os.environ.get("GEMINI_REQUEST_BUDGET", "90"))
+CALLBACK_GENERATION_BUDGET = int(os.environ.get("CALLBACK_GENERATION_BUDGET", "240"))
+# Сколько кандидатов запрашивать у Gemini параллельно на одну попытку (1 = без fan-out)
+GEMINI_CANDIDATES = max(1, int(os.environ.get("GEMINI_CANDIDATES", "1")))
+# Кэш ответов Gemini на диске: время жизни (сек, 0 = выключен) и максимум записей
+GEMINI_CACHE_TTL = int(os.environ.get("GEMINI_CACHE_TTL", "86400"))
+GEMINI_CACHE_SIZE = int(os.environ.get("GEMINI_CACHE_SIZE", "200"))
+# Пул кандидатов-картинок Pexels по запросу: сколько секунд держать результаты поиска (0 = без пула)
+IMAGE_POOL_TTL = int(os.environ.get("IMAGE_POOL_TTL", str(7 * 86400)))
+# Квота Pexels: лимит запросов в час (пока API не прислал свой) и сколько запросов держать в запасе
+PEXELS_HOURLY_LIMIT = int(os.environ.get("PEXELS_HOURLY_LIMIT", "800"))
+PEXELS_QUOTA_RESERVE = int(os.environ.get("PEXELS_QUOTA_RESERVE", "20"))
+# Источники картинок через запятую в порядке предпочтения: pexels, unsplash, local, stub (заглушка для тестов);
+# опрашиваются параллельно, общий лимит ожидания - IMAGE_SEARCH_TIMEOUT сек
+IMAGE_PROVIDERS = [name.strip() for name in os.environ.get("IMAGE_PROVIDERS", "pexels,unsplash").split(",") if name.strip()]
+IMAGE_SEARCH_TIMEOUT = float(os.environ.get("IMAGE_SEARCH_TIMEOUT", "15"))
+# Локальная библиотека картинок: папка в репозитории и публичный URL, по которому она доступна Telegram
+IMAGE_LOCAL_DIR = os.environ.get("IMAGE_LOCAL_DIR", "images")
+# Картинки для Telegram: скачиваются один раз, пережимаются до стороны TELEGRAM_PHOTO_MAX_SIDE px
+# (0 - без пережатия, нужен Pillow) и дальше отправляются по file_id; сколько file_id помнить
+TELEGRAM_PHOTO_MAX_SIDE = int(os.environ.get("TELEGRAM_PHOTO_MAX_SIDE", "1280"))
+TELEGRAM_PHOTO_CACHE_SIZE = int(os.environ.get("TELEGRAM_PHOTO_CACHE_SIZE", "500"))
+IMAGE_LOCAL_BASE_URL = os.environ.get("IMAGE_LOCAL_BASE_URL") or (
+    f"https://raw.githubusercontent.com/{REPO_OWNER}/{REPO_NAME}/main/{IMAGE_LOCAL_DIR}" if REPO_OWNER and REPO_NAME else ""
+)
+# Структурированный ответ Gemini (JSON с блоками поста): schema - responseSchema API, prompt - JSON по инструкции
+# в промпте (для моделей без JSON mode, например gemma), off - свободный текст, auto - по модели
+GEMINI_STRUCTURED_OUTPUT = os.environ.get("GEMINI_STRUCTURED_OUTPUT", "auto").lower()
+# Telegram и Дзен варианты одним запросом к Gemini; повторно генерируется только не прошедшая проверку половина
+GEMINI_COMBINED = os.environ.get("GEMINI_COMBINED", "1") == "1"
+# Черновики (--pregenerate): на сколько ближайших слотов готовить посты заранее и сколько часов черновик годен
+DRAFT_SLOTS_AHEAD = int(os.environ.get("DRAFT_SLOTS_AHEAD", "3"))
+DRAFT_MAX_AGE_HOURS = int(os.environ.get("DRAFT_MAX_AGE_HOURS", "24"))
+# Режим демона (--daemon): за сколько минут до слота начинать, через сколько повторять неудачный слот,
+# сколько раз пробовать и насколько опоздавший слот еще имеет смысл генерировать
+DAEMON_LEAD_MINUTES = int(os.environ.get("DAEMON_LEAD_MINUTES", "5"))
+DAEMON_RETRY_MINUTES = int(os.environ.get("DAEMON_RETRY_MINUTES", "10"))
+DAEMON_MAX_ATTEMPTS = int(os.environ.get("DAEMON_MAX_ATTEMPTS", "3"))
+DAEMON_MAX_LATE_MINUTES = int(os.environ.get("DAEMON_MAX_LATE_MINUTES", "60"))
+# Webhook вместо polling: публичный HTTPS URL (пусто = polling), где слушать локально и секрет для проверки запросов
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Сколько долгих действий модерации (перегенерация, замена фото) выполнять параллельно
+CALLBACK_WORKERS = max(1, int(os.environ.get("CALLBACK_WORKERS", "4")))
+# Режим журнала SQLite для истории (WAL позволяет восстановиться после падения; DELETE/TRUNCATE - классический)
+HISTORY_JOURNAL_MODE = os.environ.get("HISTORY_JOURNAL_MODE", "WAL")
+# Проверка дубликатов: сколько последних хешей держать в памяти точно
+# и на сколько записей рассчитывать фильтр Блума для старой истории (0 = без фильтра)
+DEDUP_MEMORY_LIMIT = int(os.environ.get("DEDUP_MEMORY_LIMIT", "100000"))
+DEDUP_BLOOM_CAPACITY = int(os.environ.get("DEDUP_BLOOM_CAPACITY", "1000000"))
+# Почти-дубликаты: максимальное расстояние Хэмминга между SimHash (из 64 бит; у несвязанных текстов ~32), 0 = выключено
+NEAR_DUP_MAX_DISTANCE = int(os.environ.get("NEAR_DUP_MAX_DISTANCE", "10"))
+
 CRITICAL_VARS = {
     "BOT_TOKEN": BOT_TOKEN,
     "GEMINI_API_KEY": GEMINI_API_KEY,
@@ -60,6 +136,30 @@ session.headers.update({
 session.timeout = 30
 
 
+def atomic_write_json(filename: str, data: Any, indent: Optional[int] = None):
+    """Атомарная запись JSON: временный файл + fsync + rename, файл никогда не остается обрезанным"""
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(filename)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    
+    # Фиксируем сам rename в каталоге
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
 # ========== КОНСТАНТЫ И КЛАССЫ ==========
 class PostStatus:
     PENDING = "pending"
@@ -83,52 +183,1809 @@ class GitHubAPIManager:
             headers["Authorization"] = f"token {self.github_token}"
         return headers
     
-    def get_file_content(self, file_path: str) -> Union[Dict, str]:
-        try:
-            if not self.github_token or not self.repo_owner or not self.repo_name:
-                return {"error": "Недостаточно данных для доступа к репозиторию"}
+    def get_file_content(self, file_path: str) -> Union[Dict, str]:
+        try:
+            if not self.github_token or not self.repo_owner or not self.repo_name:
+                return {"error": "Недостаточно данных для доступа к репозиторию"}
+            
+            url = f"{self.BASE_URL}/repos/{self.repo_owner}/{self.repo_name}/contents/{file_path}"
+            response = session.get(url, headers=self._get_headers())
+            
+            if response.status_code == 200:
+                content = response.json()
+                if "content" in content and content.get("encoding") == "base64":
+                    decoded = base64.b64decode(content["content"]).decode('utf-8')
+                    return decoded
+                return {"error": "Неожиданный формат ответа"}
+            return {"error": f"API error: {response.status_code}"}
+        except Exception as e:
+            logger.error(f"❌ Ошибка GitHub API: {e}")
+            return {"error": str(e)}
+    
+    def edit_file(self, file_path: str, new_content: str, commit_message: str) -> Dict:
+        try:
+            if not self.github_token or not self.repo_owner or not self.repo_name:
+                return {"error": "Недостаточно данных для доступа к репозиторию"}
+            
+            url = f"{self.BASE_URL}/repos/{self.repo_owner}/{self.repo_name}/contents/{file_path}"
+            response = session.get(url, headers=self._get_headers())
+            
+            if response.status_code != 200:
+                return {"error": "Файл не найден"}
+            
+            current_file = response.json()
+            sha = current_file["sha"]
+            
+            encoded_content = base64.b64encode(new_content.encode('utf-8')).decode('utf-8')
+            
+            data = {
+                "message": commit_message,
+                "content": encoded_content,
+                "sha": sha
+            }
+            
+            response = session.put(url, headers=self._get_headers(), json=data)
+            return response.json()
+        except Exception as e:
+            logger.error(f"❌ Ошибка редактирования файла: {e}")
+            return {"error": str(e)}
+
+
+class GeminiClient:
+    """Клиент Gemini API: пул keep-alive соединений, backoff с jitter, Retry-After и дедлайны"""
+    BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+    # Базовая задержка backoff по классу ошибки: лимиты ждем дольше, чем сбои сервера
+    BACKOFF_BASE = {"rate_limit": 2.0, "server": 1.0, "network": 0.5}
+    RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+    # Минимальный бюджет размышлений у моделей, где их нельзя выключить (*-pro)
+    MIN_THINKING_BUDGET = 128
+    
+    def __init__(self, api_key: str, model: str = GEMINI_MODEL, max_retries: int = 3,
+                 call_timeout: float = 60, max_delay: float = 20):
+        self.api_key = api_key
+        self.model = model
+        self.max_retries = max_retries
+        self.call_timeout = call_timeout
+        self.max_delay = max_delay
+        
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=16, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive',
+            'x-goog-api-key': api_key
+        })
+    
+    @property
+    def structured_mode(self) -> Optional[str]:
+        """'schema', 'prompt' или None - как просить у модели JSON"""
+        mode = GEMINI_STRUCTURED_OUTPUT
+        if mode == "auto":
+            # gemma через Gemini API не поддерживает responseSchema
+            return "prompt" if self.model.startswith("gemma") else "schema"
+        return mode if mode in ("schema", "prompt") else None
+    
+    @property
+    def thinking_budget(self) -> Optional[int]:
+        """thinkingBudget для модели с размышлениями или None, если модель их не поддерживает"""
+        model = self.model.lower()
+        if not (model.startswith(("gemini-2.5", "gemini-3")) or "thinking" in model):
+            return None
+        return self.MIN_THINKING_BUDGET if "pro" in model else 0
+    
+    def limit_thinking(self, generation_config: Dict):
+        """Ограничивает размышления модели в generationConfig.
+        
+        Токены размышлений входят в maxOutputTokens: при лимите по бюджету слота они съели бы ответ
+        (MAX_TOKENS), поэтому размышления выключаются, а где нельзя - минимальный бюджет добавляется к лимиту.
+        """
+        budget = self.thinking_budget
+        if budget is None:
+            return
+        generation_config["thinkingConfig"] = {"thinkingBudget": budget}
+        generation_config["maxOutputTokens"] += budget
+    
+    def _backoff(self, error_class: str, attempt: int) -> float:
+        """Экспоненциальная задержка с full jitter"""
+        ceiling = min(self.max_delay, self.BACKOFF_BASE[error_class] * (2 ** attempt))
+        return random.uniform(0, ceiling)
+    
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Retry-After: число секунд или HTTP-дата"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+    
+    def generate_content(self, payload: Dict, deadline: Optional[float] = None) -> Optional[Dict]:
+        """POST generateContent с повторами; deadline - момент time.monotonic(), после которого не ждем"""
+        url = f"{self.BASE_URL}/{self.model}:generateContent"
+        
+        for attempt in range(self.max_retries + 1):
+            timeout = self.call_timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining < 1:
+                    logger.warning("⏰ Gemini: дедлайн вызова исчерпан")
+                    return None
+                timeout = min(timeout, remaining)
+            
+            try:
+                response = self.session.post(url, json=payload, timeout=timeout)
+            except (requests.Timeout, requests.ConnectionError) as e:
+                logger.warning(f"⚠️ Gemini: сетевая ошибка ({e}), попытка {attempt+1}/{self.max_retries + 1}")
+                delay = self._backoff("network", attempt)
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                
+                if response.status_code not in self.RETRYABLE_STATUSES:
+                    logger.error(f"❌ Ошибка API: {response.status_code} (повтор не поможет)")
+                    return None
+                
+                error_class = "rate_limit" if response.status_code == 429 else "server"
+                retry_after = self._parse_retry_after(response.headers.get("Retry-After"))
+                delay = retry_after if retry_after is not None else self._backoff(error_class, attempt)
+                logger.warning(f"⚠️ Gemini: {response.status_code}, повтор через {delay:.1f} сек "
+                               f"(попытка {attempt+1}/{self.max_retries + 1})")
+            
+            if attempt == self.max_retries:
+                break
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                logger.warning("⏰ Gemini: повтор не укладывается в дедлайн")
+                return None
+            time.sleep(delay)
+        
+        logger.error("❌ Gemini: попытки исчерпаны")
+        return None
+
+
+class GeminiResponseCache:
+    """Кэш ответов Gemini на диске: ключ - хеш промпта, модели и generationConfig, TTL + LRU"""
+    
+    def __init__(self, filename: str = "gemini_cache.json", ttl: int = GEMINI_CACHE_TTL,
+                 max_entries: int = GEMINI_CACHE_SIZE):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.dirty = False
+        
+        if self.enabled and os.path.exists(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    stored = json.load(f)
+                # Файл хранится от старых к новым - порядок LRU сохраняется
+                now = time.time()
+                for key, entry in stored.items():
+                    if now - entry.get("created", 0) < ttl:
+                        self.entries[key] = entry
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка загрузки {filename}: {e}")
+    
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+    
+    @staticmethod
+    def make_key(prompt: str, model: str, generation_config: Dict) -> str:
+        normalized_prompt = re.sub(r'\s+', ' ', prompt).strip()
+        config = json.dumps(generation_config, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f"{model}\n{config}\n{normalized_prompt}".encode('utf-8')).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry:
+                return None
+            if time.time() - entry.get("created", 0) >= self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry.get("text")
+    
+    def put(self, key: str, text: str):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries[key] = {"text": text, "created": time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+    
+    def flush(self):
+        """Сбрасывает накопленные изменения на диск одной атомарной записью"""
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                atomic_write_json(self.filename, self.entries)
+                self.dirty = False
+            except Exception as e:
+                logger.error(f"❌ Ошибка сохранения {self.filename}: {e}")
+
+
+class ImageCandidatePool:
+    """Пул найденных картинок по поисковому запросу: метаданные фото, курсор страниц и срок жизни.
+    
+    Замена фото берет кандидатов из пула без запроса к API; следующая страница
+    поиска нужна, только когда неиспользованные кандидаты запроса закончились.
+    """
+    
+    def __init__(self, filename: str = "image_pool.json", ttl: int = IMAGE_POOL_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict] = {}
+        self.dirty = False
+        
+        if self.ttl > 0 and os.path.exists(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    stored = json.load(f)
+                now = time.time()
+                self.entries = {query: entry for query, entry in stored.items() if entry.get("expires", 0) > now}
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка загрузки {filename}: {e}")
+    
+    def _entry(self, query: str) -> Optional[Dict]:
+        entry = self.entries.get(query)
+        if entry and entry.get("expires", 0) <= time.time():
+            del self.entries[query]
+            self.dirty = True
+            return None
+        return entry
+    
+    def photos(self, query: str) -> List[Dict]:
+        with self.lock:
+            entry = self._entry(query)
+            return list(entry["photos"]) if entry else []
+    
+    def next_page(self, query: str) -> Optional[int]:
+        """Номер следующей страницы поиска или None, если результаты запроса исчерпаны"""
+        with self.lock:
+            entry = self._entry(query)
+            if not entry:
+                return 1
+            return entry["next_page"] if entry["has_more"] else None
+    
+    def add_page(self, query: str, page: int, photos: List[Dict], has_more: bool):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            entry = self._entry(query)
+            if not entry:
+                entry = self.entries[query] = {"photos": [], "expires": time.time() + self.ttl}
+            known = {photo["url"] for photo in entry["photos"]}
+            entry["photos"].extend(photo for photo in photos if photo["url"] not in known)
+            entry["next_page"] = page + 1
+            entry["has_more"] = has_more
+            self.dirty = True
+    
+    def flush(self):
+        """Сбрасывает накопленные изменения на диск одной атомарной записью"""
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                atomic_write_json(self.filename, self.entries)
+                self.dirty = False
+            except Exception as e:
+                logger.error(f"❌ Ошибка сохранения {self.filename}: {e}")
+
+
+class TelegramPhotoCache:
+    """file_id загруженных в Telegram картинок по исходному URL (LRU, на диске в JSON).
+    
+    Повторная отправка той же картинки идет по file_id, без повторного скачивания Telegram'ом.
+    """
+    
+    def __init__(self, filename: str = "telegram_photos.json", max_entries: int = TELEGRAM_PHOTO_CACHE_SIZE):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, str]" = OrderedDict()
+        self.dirty = False
+        
+        if self.max_entries > 0 and os.path.exists(filename):
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    self.entries = OrderedDict(json.load(f))
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка загрузки {filename}: {e}")
+    
+    def get(self, url: str) -> Optional[str]:
+        with self.lock:
+            file_id = self.entries.get(url)
+            if file_id:
+                self.entries.move_to_end(url)
+            return file_id
+    
+    def remember(self, url: str, message: Any):
+        """Запоминает file_id самого большого размера фото из отправленного сообщения"""
+        photo_sizes = getattr(message, "photo", None)
+        if self.max_entries <= 0 or not photo_sizes:
+            return
+        with self.lock:
+            self.entries[url] = photo_sizes[-1].file_id
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+    
+    def forget(self, url: str):
+        with self.lock:
+            if self.entries.pop(url, None):
+                self.dirty = True
+    
+    def flush(self):
+        """Сбрасывает накопленные изменения на диск одной атомарной записью"""
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                atomic_write_json(self.filename, self.entries)
+                self.dirty = False
+            except Exception as e:
+                logger.error(f"❌ Ошибка сохранения {self.filename}: {e}")
+
+
+class PexelsClient:
+    """Клиент Pexels API с учетом квоты.
+    
+    Остаток и момент сброса берутся из заголовков X-Ratelimit-* и сохраняются в истории
+    между запусками; когда остаток доходит до резерва, запросы не отправляются до сброса.
+    """
+    SEARCH_URL = "https://api.pexels.com/v1/search"
+    QUOTA_KEY = "pexels_quota"
+    
+    def __init__(self, api_key: Optional[str], history: "HistoryStore",
+                 hourly_limit: int = PEXELS_HOURLY_LIMIT, reserve: int = PEXELS_QUOTA_RESERVE):
+        self.api_key = api_key
+        self.history = history
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        self.quota = {"limit": hourly_limit, "remaining": None, "reset": 0.0}
+        
+        stored = history.get_meta(self.QUOTA_KEY)
+        if stored:
+            try:
+                self.quota.update(json.loads(stored))
+            except ValueError as e:
+                logger.warning(f"⚠️ Ошибка чтения квоты Pexels: {e}")
+    
+    def _refresh(self):
+        """После сброса окна квота снова полная"""
+        if self.quota["reset"] and self.quota["reset"] <= time.time():
+            self.quota["remaining"] = None
+            self.quota["reset"] = 0.0
+    
+    def _save(self):
+        self.history.set_meta(self.QUOTA_KEY, json.dumps(self.quota))
+    
+    def _update_from_response(self, response: requests.Response):
+        headers = response.headers
+        now = time.time()
+        try:
+            if headers.get("X-Ratelimit-Limit"):
+                self.quota["limit"] = int(headers["X-Ratelimit-Limit"])
+            if headers.get("X-Ratelimit-Remaining"):
+                self.quota["remaining"] = int(headers["X-Ratelimit-Remaining"])
+            elif self.quota["remaining"] is not None:
+                # Заголовков нет - считаем запрос сами
+                self.quota["remaining"] = max(0, self.quota["remaining"] - 1)
+            else:
+                self.quota["remaining"] = self.quota["limit"] - 1
+            if headers.get("X-Ratelimit-Reset"):
+                self.quota["reset"] = float(headers["X-Ratelimit-Reset"])
+            elif not self.quota["reset"]:
+                self.quota["reset"] = now + 3600
+        except ValueError as e:
+            logger.warning(f"⚠️ Некорректные заголовки квоты Pexels: {e}")
+        
+        if response.status_code == 429:
+            retry_after = GeminiClient._parse_retry_after(headers.get("Retry-After"))
+            self.quota["remaining"] = 0
+            if retry_after is not None:
+                self.quota["reset"] = now + retry_after
+            elif self.quota["reset"] <= now:
+                self.quota["reset"] = now + 3600
+        self._save()
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_key)
+    
+    def available(self) -> bool:
+        """Можно ли сейчас тратить запрос, не залезая в резерв"""
+        with self.lock:
+            self._refresh()
+            remaining = self.quota["remaining"]
+            return self.enabled and (remaining is None or remaining > self.reserve)
+    
+    def search(self, query: str, page: int = 1, per_page: int = 30) -> Optional[Dict]:
+        """Поиск фото; None - если квота на исходе, лимит превышен или запрос не удался"""
+        if not self.available():
+            logger.warning(f"⏳ Квота Pexels на исходе, запрос '{query}' не отправлен: {self.summary()}")
+            return None
+        
+        params = {"query": query, "per_page": per_page, "page": page, "orientation": "landscape", "size": "large"}
+        logger.info(f"🌐 Pexels: '{query}', страница {page}")
+        try:
+            response = session.get(self.SEARCH_URL, params=params, headers={"Authorization": self.api_key},
+                                   timeout=15)
+        except requests.RequestException as e:
+            logger.warning(f"⚠️ Ошибка запроса к Pexels: {e}")
+            return None
+        
+        with self.lock:
+            self._update_from_response(response)
+        
+        if response.status_code == 429:
+            logger.warning(f"⏳ Pexels: лимит запросов превышен, {self.summary()}")
+            return None
+        if response.status_code != 200:
+            logger.warning(f"⚠️ Pexels вернул {response.status_code}")
+            return None
+        return response.json()
+    
+    def summary(self) -> str:
+        """Остаток квоты для админа"""
+        with self.lock:
+            self._refresh()
+            limit, remaining, reset = self.quota["limit"], self.quota["remaining"], self.quota["reset"]
+        if remaining is None:
+            return f"осталось {limit}/{limit} запросов"
+        reset_time = (datetime.utcfromtimestamp(reset) + timedelta(hours=3)).strftime('%H:%M')
+        return f"осталось {remaining}/{limit} запросов, сброс в {reset_time} МСК"
+
+
+class ImageProvider:
+    """Источник картинок: search возвращает кандидатов [{url, ...}] по поисковому запросу"""
+    name = ""
+    # Пометка источника в описании картинки для промпта (пусто - без пометки)
+    label = ""
+    
+    @property
+    def enabled(self) -> bool:
+        return True
+    
+    def search(self, query: str, is_fresh: Callable[[Dict], bool]) -> List[Dict]:
+        raise NotImplementedError
+
+
+class PexelsProvider(ImageProvider):
+    """Pexels через пул кандидатов: новая страница поиска - только когда свободные фото пула закончились"""
+    name = "pexels"
+    
+    def __init__(self, client: PexelsClient, pool: ImageCandidatePool):
+        self.client = client
+        self.pool = pool
+    
+    @property
+    def enabled(self) -> bool:
+        return self.client.enabled
+    
+    def search(self, query: str, is_fresh: Callable[[Dict], bool]) -> List[Dict]:
+        photos = self.pool.photos(query)
+        if any(is_fresh(photo) for photo in photos):
+            logger.info(f"🗂️ Фото из пула: {len(photos)} кандидатов для '{query}'")
+            return photos
+        
+        page = self.pool.next_page(query)
+        fetched = self._fetch_page(query, page) if page else []
+        # С выключенным пулом (IMAGE_POOL_TTL=0) выбираем из только что загруженной страницы
+        return (self.pool.photos(query) or fetched) if fetched else photos
+    
+    def _fetch_page(self, query: str, page: int) -> List[Dict]:
+        """Загружает страницу поиска Pexels в пул картинок, возвращает фото страницы"""
+        data = self.client.search(query, page)
+        if not data:
+            return []
+        
+        photos = [
+            {"url": photo["src"]["large"], "id": photo.get("id"),
+             "photographer": photo.get("photographer"), "alt": photo.get("alt")}
+            for photo in data.get("photos", []) if photo.get("src", {}).get("large")
+        ]
+        self.pool.add_page(query, page, photos, has_more=bool(data.get("next_page")) and bool(photos))
+        return photos
+
+
+class UnsplashProvider(ImageProvider):
+    """Случайное фото Unsplash по запросу (редирект source.unsplash.com)"""
+    name = "unsplash"
+    label = "Unsplash"
+    
+    def search(self, query: str, is_fresh: Callable[[Dict], bool]) -> List[Dict]:
+        unsplash_url = f"https://source.unsplash.com/featured/1200x630/?{quote_plus(query)}"
+        response = session.head(unsplash_url, timeout=5, allow_redirects=True)
+        if response.status_code != 200:
+            return []
+        return [{"url": response.url}]
+
+
+class LocalFolderProvider(ImageProvider):
+    """Своя библиотека картинок: файлы из папки, отдаваемые по публичному URL"""
+    name = "local"
+    label = "библиотека"
+    EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+    
+    def __init__(self, directory: str = IMAGE_LOCAL_DIR, base_url: str = IMAGE_LOCAL_BASE_URL):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.base_url) and os.path.isdir(self.directory)
+    
+    def search(self, query: str, is_fresh: Callable[[Dict], bool]) -> List[Dict]:
+        files = []
+        for root, _, names in os.walk(self.directory):
+            files.extend(os.path.relpath(os.path.join(root, name), self.directory)
+                         for name in names if name.lower().endswith(self.EXTENSIONS))
+        
+        # Подходящими считаем файлы, в пути которых есть слово запроса; иначе годится любой
+        words = query.lower().split()
+        matching = [path for path in files if any(word in path.lower() for word in words)]
+        return [{"url": f"{self.base_url}/{quote(path.replace(os.sep, '/'))}"} for path in (matching or files)]
+
+
+class StubImageProvider(ImageProvider):
+    """Заглушка без внешних API: детерминированная картинка-плейсхолдер по запросу"""
+    name = "stub"
+    label = "заглушка"
+    
+    def search(self, query: str, is_fresh: Callable[[Dict], bool]) -> List[Dict]:
+        return [{"url": f"https://placehold.co/1200x630/png?text={quote_plus(query)}"}]
+
+
+class ImageResolver:
+    """Опрашивает источники картинок параллельно с общим дедлайном.
+    
+    Лучший результат - свежий (не использованный недавно) кандидат самого предпочтительного
+    источника; медленный источник не задерживает ответ, если более предпочтительный уже нашел фото.
+    """
+    
+    def __init__(self, providers: List[ImageProvider], timeout: float = IMAGE_SEARCH_TIMEOUT):
+        self.providers = providers
+        self.timeout = timeout
+    
+    def _search(self, provider: ImageProvider, query: str, is_fresh: Callable[[Dict], bool]) -> List[Dict]:
+        try:
+            return provider.search(query, is_fresh)
+        except Exception as e:
+            logger.warning(f"⚠️ Источник картинок {provider.name}: {e}")
+            return []
+    
+    def resolve(self, query: str, is_fresh: Callable[[Dict], bool],
+                usage_count: Callable[[Dict], int]) -> Optional[Tuple[Dict, ImageProvider]]:
+        providers = [provider for provider in self.providers if provider.enabled]
+        if not providers:
+            return None
+        
+        results: Dict[int, List[Dict]] = {}
+        fresh: Dict[int, List[Dict]] = {}
+        deadline = time.monotonic() + self.timeout
+        executor = ThreadPoolExecutor(max_workers=len(providers), thread_name_prefix="image")
+        futures = {executor.submit(self._search, provider, query, is_fresh): index
+                   for index, provider in enumerate(providers)}
+        
+        try:
+            pending = set(futures)
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"⏰ Поиск картинки: не дождались {len(pending)} источников за {self.timeout:g} сек")
+                    break
+                
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures[future]
+                    results[index] = future.result()
+                    fresh[index] = [photo for photo in results[index] if is_fresh(photo)]
+                
+                # Дальше ждать незачем: все источники предпочтительнее лучшего найденного уже ответили
+                best = min((index for index, photos in fresh.items() if photos), default=None)
+                if best is not None and all(index in results for index in range(best)):
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        for index in sorted(fresh):
+            if fresh[index]:
+                return random.choice(fresh[index]), providers[index]
+        
+        # Все найденное недавно использовалось - берем наименее используемое
+        candidates = [(photo, providers[index]) for index in sorted(results) for photo in results[index]]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda candidate: (usage_count(candidate[0]), random.random()))
+
+
+class HistoryStore:
+    """История публикаций в SQLite: индексированные таблицы и инкрементальные записи.
+    
+    Изменения копятся в одной открытой транзакции и фиксируются пачкой в flush().
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS rotation_usage (
+            catalog TEXT NOT NULL,
+            item TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (catalog, item, day)
+        );
+        CREATE INDEX IF NOT EXISTS idx_rotation_usage_day ON rotation_usage (catalog, day);
+        CREATE TABLE IF NOT EXISTS text_hashes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            hash TEXT NOT NULL UNIQUE,
+            created_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS image_usage (
+            url TEXT PRIMARY KEY,
+            last_used TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            theme TEXT,
+            query TEXT,
+            source TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_image_usage_last_used ON image_usage (last_used);
+        CREATE TABLE IF NOT EXISTS slot_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            day TEXT NOT NULL,
+            slot_time TEXT NOT NULL,
+            status TEXT NOT NULL,
+            post_type TEXT,
+            theme TEXT,
+            reason TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_slot_events_day ON slot_events (day, status);
+        CREATE TABLE IF NOT EXISTS length_stats (
+            slot_type TEXT NOT NULL,
+            post_type TEXT NOT NULL,
+            chars_per_token REAL,
+            length_ratio REAL,
+            samples INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (slot_type, post_type)
+        );
+        CREATE TABLE IF NOT EXISTS drafts (
+            day TEXT NOT NULL,
+            slot_time TEXT NOT NULL,
+            theme TEXT NOT NULL,
+            tg_text TEXT NOT NULL,
+            zen_text TEXT,
+            image_url TEXT,
+            image_description TEXT,
+            picks TEXT,
+            image_usage TEXT,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (day, slot_time)
+        );
+    """
+    def __init__(self, path: str = "bot_history.db"):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(f"PRAGMA journal_mode={HISTORY_JOURNAL_MODE}")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.executescript(self.SCHEMA)
+        # Колонка появилась после первой версии очереди черновиков
+        if "image_usage" not in {row[1] for row in self.conn.execute("PRAGMA table_info(drafts)")}:
+            self.conn.execute("ALTER TABLE drafts ADD COLUMN image_usage TEXT")
+        self.conn.commit()
+    
+    def _execute(self, sql: str, params: Tuple = ()) -> sqlite3.Cursor:
+        with self.lock:
+            return self.conn.execute(sql, params)
+    
+    def _query(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+    
+    def flush(self):
+        """Фиксирует накопленные изменения одной транзакцией"""
+        with self.lock:
+            if self.conn.in_transaction:
+                self.conn.commit()
+    
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+    
+    # ---------- ротация (темы, подходы, вопросы, мысли) и использование картинок ----------
+    def record_usage(self, catalog: str, item: str, day: str):
+        self._execute(
+            "INSERT INTO rotation_usage (catalog, item, day, count) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT (catalog, item, day) DO UPDATE SET count = count + 1",
+            (catalog, item, day)
+        )
+    
+    def usage_by_day(self, catalog: str, since_day: str) -> List[Tuple[str, str, int]]:
+        return self._query(
+            "SELECT item, day, count FROM rotation_usage WHERE catalog = ? AND day >= ?",
+            (catalog, since_day)
+        )
+    
+    def prune_usage(self, before_day: str):
+        self._execute("DELETE FROM rotation_usage WHERE day < ?", (before_day,))
+    
+    # ---------- хеши текстов ----------
+    def text_hashes(self) -> List[str]:
+        """Хеши, перенесенные из post_history.json (источник для TextHashIndex)"""
+        return [text_hash for (text_hash,) in self._query("SELECT hash FROM text_hashes ORDER BY id")]
+    
+    # ---------- картинки ----------
+    def record_image(self, url: str, day: str, theme: str, query: str, source: str = "pexels"):
+        self._execute(
+            "INSERT INTO image_usage (url, last_used, count, theme, query, source) VALUES (?, ?, 1, ?, ?, ?) "
+            "ON CONFLICT (url) DO UPDATE SET last_used = excluded.last_used, count = count + 1, theme = excluded.theme",
+            (url, day, theme, query, source)
+        )
+    
+    # Фото Pexels: https://images.pexels.com/photos/<id>/pexels-photo-<id>.jpeg?<размер>
+    PEXELS_PHOTO_RE = re.compile(r'pexels\.com/photos/(\d+)/')
+    
+    def index_image_usage(self):
+        """Однократно переносит счетчики image_usage в дневные счетчики каталога 'image'.
+        
+        Ключ - как в ImageUsageIndex.key: pexels:<id> для фото Pexels, URL для остальных картинок.
+        """
+        with self.lock:
+            if self.get_meta("image_usage_indexed_v2"):
+                return
+            if self.get_meta("image_usage_indexed"):
+                # Первый перенос записал фото Pexels под URL: перекладываем эти строки под id
+                rows = [row for row in self._query("SELECT item, day, count FROM rotation_usage WHERE catalog = ?",
+                                                   (ImageUsageIndex.CATALOG,))
+                        if self.PEXELS_PHOTO_RE.search(row[0])]
+                for url, day, _ in rows:
+                    self._execute("DELETE FROM rotation_usage WHERE catalog = ? AND item = ? AND day = ?",
+                                  (ImageUsageIndex.CATALOG, url, day))
+            else:
+                rows = self._query("SELECT url, last_used, count FROM image_usage")
+            
+            for url, day, count in rows:
+                match = self.PEXELS_PHOTO_RE.search(url)
+                # Разные размеры одного фото сливаются в один ключ - счетчики складываем
+                self._execute(
+                    "INSERT INTO rotation_usage (catalog, item, day, count) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (catalog, item, day) DO UPDATE SET count = count + excluded.count",
+                    (ImageUsageIndex.CATALOG, f"pexels:{match.group(1)}" if match else url, day, count)
+                )
+            now = datetime.utcnow().isoformat()
+            self.set_meta("image_usage_indexed", now)
+            self.set_meta("image_usage_indexed_v2", now)
+    
+    def prune_images(self, before_day: str):
+        self._execute("DELETE FROM image_usage WHERE last_used < ?", (before_day,))
+    
+    # ---------- слоты ----------
+    def record_slot(self, day: str, slot_time: str, status: str, post_type: str = None,
+                    theme: str = None, reason: str = None):
+        self._execute(
+            "INSERT INTO slot_events (day, slot_time, status, post_type, theme, reason) VALUES (?, ?, ?, ?, ?, ?)",
+            (day, slot_time, status, post_type, theme, reason)
+        )
+    
+    def slots_on(self, day: str, status: str) -> set:
+        rows = self._query("SELECT slot_time FROM slot_events WHERE day = ? AND status = ?", (day, status))
+        return {slot_time for (slot_time,) in rows}
+    
+    # ---------- длина генерации ----------
+    def length_stats(self) -> List[Tuple[str, str, Optional[float], Optional[float], int]]:
+        return self._query("SELECT slot_type, post_type, chars_per_token, length_ratio, samples FROM length_stats")
+    
+    def save_length_stats(self, slot_type: str, post_type: str, chars_per_token: Optional[float],
+                          length_ratio: Optional[float], samples: int):
+        self._execute(
+            "INSERT INTO length_stats (slot_type, post_type, chars_per_token, length_ratio, samples) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (slot_type, post_type) DO UPDATE SET "
+            "chars_per_token = excluded.chars_per_token, length_ratio = excluded.length_ratio, "
+            "samples = excluded.samples",
+            (slot_type, post_type, chars_per_token, length_ratio, samples)
+        )
+    
+    # ---------- черновики ----------
+    DRAFT_FIELDS = ("theme", "tg_text", "zen_text", "image_url", "image_description", "picks", "image_usage",
+                    "created_at")
+    
+    def save_draft(self, day: str, slot_time: str, theme: str, tg_text: str, zen_text: Optional[str],
+                   image_url: Optional[str], image_description: Optional[str], picks: Dict,
+                   image_usage: Optional[Dict], created_at: str):
+        self._execute(
+            "INSERT OR REPLACE INTO drafts (day, slot_time, theme, tg_text, zen_text, image_url, "
+            "image_description, picks, image_usage, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (day, slot_time, theme, tg_text, zen_text, image_url, image_description,
+             json.dumps(picks, ensure_ascii=False), json.dumps(image_usage, ensure_ascii=False) if image_usage else None,
+             created_at)
+        )
+    
+    def take_draft(self, day: str, slot_time: str) -> Optional[Dict]:
+        """Забирает черновик слота из очереди (удаляется вместе с ближайшим flush)"""
+        with self.lock:
+            rows = self._query(f"SELECT {', '.join(self.DRAFT_FIELDS)} FROM drafts WHERE day = ? AND slot_time = ?",
+                               (day, slot_time))
+            if not rows:
+                return None
+            self._execute("DELETE FROM drafts WHERE day = ? AND slot_time = ?", (day, slot_time))
+        draft = dict(zip(self.DRAFT_FIELDS, rows[0]))
+        draft["picks"] = json.loads(draft["picks"] or "{}")
+        draft["image_usage"] = json.loads(draft["image_usage"]) if draft["image_usage"] else None
+        return draft
+    
+    def draft_slots(self, day: str) -> set:
+        return {slot_time for (slot_time,) in self._query("SELECT slot_time FROM drafts WHERE day = ?", (day,))}
+    
+    def prune_drafts(self, before_day: str):
+        self._execute("DELETE FROM drafts WHERE day < ?", (before_day,))
+    
+    # ---------- служебные значения ----------
+    def get_meta(self, key: str) -> Optional[str]:
+        rows = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+    
+    def set_meta(self, key: str, value: str):
+        self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    # ---------- миграция ----------
+    def needs_json_migration(self) -> bool:
+        return not self._query("SELECT 1 FROM meta WHERE key = 'json_migrated'")
+    
+    def migrate_from_json(self, post_history: Dict, image_history: Dict):
+        """Однократный перенос post_history.json и image_history.json в SQLite"""
+        with self.lock:
+            logger.info("📦 Переношу историю из JSON в SQLite...")
+            now = datetime.utcnow().isoformat()
+            cursor = self.conn.cursor()
+            
+            for text_hash in post_history.get("generated_texts", []):
+                cursor.execute("INSERT OR IGNORE INTO text_hashes (hash, created_at) VALUES (?, ?)",
+                               (text_hash, now))
+            
+            detailed_keys = {
+                "approach": ("used_approaches_detailed", "approach"),
+                "question": ("used_questions_detailed", "question"),
+                "thought": ("used_key_thoughts_detailed", "thought"),
+            }
+            for catalog, (history_key, item_key) in detailed_keys.items():
+                for entry in post_history.get(history_key, []):
+                    item, day = entry.get(item_key), entry.get("last_used")
+                    if item and day:
+                        cursor.execute(
+                            "INSERT INTO rotation_usage (catalog, item, day, count) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (catalog, item, day) DO UPDATE SET count = count + excluded.count",
+                            (catalog, item, day, entry.get("count", 1))
+                        )
+            
+            for theme, days in post_history.get("theme_usage", {}).items():
+                for day, count in days.items():
+                    cursor.execute(
+                        "INSERT INTO rotation_usage (catalog, item, day, count) VALUES ('theme', ?, ?, ?) "
+                        "ON CONFLICT (catalog, item, day) DO UPDATE SET count = count + excluded.count",
+                        (theme, day, count)
+                    )
+            
+            for day, slots in post_history.get("sent_slots", {}).items():
+                for slot_time in slots:
+                    cursor.execute("INSERT INTO slot_events (day, slot_time, status) VALUES (?, ?, 'sent')",
+                                   (day, slot_time))
+            
+            for day, slots in post_history.get("rejected_slots", {}).items():
+                for slot in slots:
+                    cursor.execute(
+                        "INSERT INTO slot_events (day, slot_time, status, post_type, theme, reason) "
+                        "VALUES (?, ?, 'rejected', ?, ?, ?)",
+                        (day, slot.get("time", ""), slot.get("type"), slot.get("theme"), slot.get("reason"))
+                    )
+            
+            for entry in image_history.get("used_images_detailed", []):
+                if entry.get("url") and entry.get("last_used"):
+                    cursor.execute(
+                        "INSERT INTO image_usage (url, last_used, count, theme, query, source) "
+                        "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (url) DO UPDATE SET "
+                        "last_used = MAX(last_used, excluded.last_used), count = count + excluded.count",
+                        (entry["url"], entry["last_used"], entry.get("count", 1), entry.get("theme"),
+                         entry.get("query"), entry.get("source", "pexels"))
+                    )
+            
+            cursor.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (now,))
+            self.conn.commit()
+            logger.info("✅ История перенесена в SQLite")
+
+
+class BloomFilter:
+    """Фильтр Блума поверх равномерных хешей (md5) - без ложноотрицательных ответов"""
+    
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+    
+    def _positions(self, digest: bytes) -> Iterator[int]:
+        # Двойное хеширование: две половины md5 дают k независимых позиций
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+    
+    def add(self, digest: bytes):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, digest: bytes) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest))
+
+
+class AppendOnlyRecordFile:
+    """Бинарный файл из записей фиксированной длины, новые записи только дописываются"""
+    
+    def __init__(self, filename: str, record_size: int):
+        self.filename = filename
+        self.record_size = record_size
+    
+    def exists(self) -> bool:
+        return os.path.exists(self.filename)
+    
+    def read_all(self) -> List[bytes]:
+        if not self.exists():
+            return []
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        
+        # Недописанная при падении запись в хвосте отбрасывается
+        valid_length = len(data) - len(data) % self.record_size
+        if valid_length != len(data):
+            logger.warning(f"⚠️ {self.filename}: отброшен неполный хвост ({len(data) - valid_length} байт)")
+            with open(self.filename, 'r+b') as f:
+                f.truncate(valid_length)
+        
+        return [data[offset:offset + self.record_size] for offset in range(0, valid_length, self.record_size)]
+    
+    def append(self, records: List[bytes]):
+        with open(self.filename, 'ab') as f:
+            f.write(b''.join(records))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class TextHashIndex:
+    """Индекс дубликатов: set 16-байтных md5 в памяти + append-only бинарный файл.
+    
+    Последние memory_limit хешей проверяются точно через set, более старые -
+    через опциональный фильтр Блума, поэтому горизонт проверки не ограничен.
+    """
+    
+    def __init__(self, filename: str = "text_hashes.bin", memory_limit: int = DEDUP_MEMORY_LIMIT,
+                 bloom_capacity: int = DEDUP_BLOOM_CAPACITY, seed: Optional[Callable[[], List[str]]] = None):
+        self.storage = AppendOnlyRecordFile(filename, 16)
+        self.memory_limit = memory_limit
+        self.lock = threading.Lock()
+        self.recent: "OrderedDict[bytes, None]" = OrderedDict()
+        self.bloom = BloomFilter(bloom_capacity) if bloom_capacity > 0 else None
+        self.pending: List[bytes] = []
+        
+        if self.storage.exists():
+            for digest in self.storage.read_all():
+                self._remember(digest)
+        elif seed:
+            # Первый запуск: переносим хеши из прежнего хранилища
+            for text_hash in seed():
+                self.add(text_hash)
+            self.flush()
+    
+    def _remember(self, digest: bytes):
+        if self.bloom is not None:
+            self.bloom.add(digest)
+        self.recent[digest] = None
+        self.recent.move_to_end(digest)
+        if len(self.recent) > self.memory_limit:
+            self.recent.popitem(last=False)
+    
+    def __len__(self) -> int:
+        return len(self.recent)
+    
+    def contains(self, text_hash: str) -> bool:
+        digest = bytes.fromhex(text_hash)
+        with self.lock:
+            if digest in self.recent:
+                return True
+            return self.bloom is not None and digest in self.bloom
+    
+    def add(self, text_hash: str):
+        digest = bytes.fromhex(text_hash)
+        with self.lock:
+            if digest in self.recent:
+                return
+            self._remember(digest)
+            self.pending.append(digest)
+    
+    def flush(self):
+        """Дописывает новые хеши в конец файла одной записью"""
+        with self.lock:
+            if not self.pending:
+                return
+            try:
+                self.storage.append(self.pending)
+                self.pending = []
+            except Exception as e:
+                logger.error(f"❌ Ошибка сохранения {self.storage.filename}: {e}")
+
+
+class SimHashIndex:
+    """Поиск почти-дубликатов: 64-битный SimHash по шинглам из слов + multi-index hashing.
+    
+    Хеш режется на полосы не уже 16 бит. Если расстояние не больше max_distance,
+    то по принципу Дирихле хотя бы в одной из m полос отличается не больше
+    max_distance // m бит, поэтому в каждой полосе перебираются ключи в этом
+    радиусе, а сравниваются только кандидаты из найденных бакетов.
+    """
+    BITS = 64
+    SHINGLE_SIZE = 2
+    MIN_BAND_BITS = 16
+    
+    def __init__(self, filename: str = "text_simhashes.bin", max_distance: int = NEAR_DUP_MAX_DISTANCE):
+        self.storage = AppendOnlyRecordFile(filename, 8)
+        self.max_distance = max_distance
+        self.lock = threading.Lock()
+        self.pending: List[bytes] = []
+        
+        self.bands = self._layout(max(0, max_distance))
+        self.buckets: List[Dict[int, List[int]]] = [{} for _ in self.bands]
+        
+        if self.enabled:
+            for record in self.storage.read_all():
+                self._index(int.from_bytes(record, 'little'))
+    
+    @classmethod
+    def _layout(cls, max_distance: int) -> List[Tuple[int, int, List[int]]]:
+        """Полосы (сдвиг, маска, маски переборов) с наименьшим числом проб на поиск"""
+        def probes(band_count: int) -> int:
+            width = cls.BITS // band_count
+            return band_count * sum(math.comb(width, flips) for flips in range(max_distance // band_count + 1))
+        
+        band_count = min(range(1, cls.BITS // cls.MIN_BAND_BITS + 1), key=probes)
+        radius = max_distance // band_count
+        bands = []
+        offset = 0
+        for band in range(band_count):
+            width = cls.BITS // band_count + (1 if band < cls.BITS % band_count else 0)
+            flips = [sum(1 << bit for bit in bits)
+                     for count in range(radius + 1) for bits in itertools.combinations(range(width), count)]
+            bands.append((offset, (1 << width) - 1, flips))
+            offset += width
+        return bands
+    
+    @property
+    def enabled(self) -> bool:
+        return self.max_distance > 0
+    
+    @classmethod
+    def fingerprint(cls, text: str) -> int:
+        words = re.findall(r'\w+', text.lower())
+        if len(words) >= cls.SHINGLE_SIZE:
+            shingles = [' '.join(words[i:i + cls.SHINGLE_SIZE]) for i in range(len(words) - cls.SHINGLE_SIZE + 1)]
+        else:
+            shingles = words
+        
+        # Счетчики единиц по 64 разрядам сразу: planes[i] - i-й бит всех 64 счетчиков
+        planes: List[int] = []
+        for shingle in shingles:
+            carry = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+            for i, plane in enumerate(planes):
+                planes[i] = plane ^ carry
+                carry &= plane
+                if not carry:
+                    break
+            else:
+                if carry:
+                    planes.append(carry)
+        
+        # Бит ставится, если единиц в разряде больше половины: сравнение счетчиков с порогом
+        # от старшего бита к младшему, тоже сразу по всем разрядам
+        half = len(shingles) // 2
+        greater, equal = 0, (1 << cls.BITS) - 1
+        for i in reversed(range(max(len(planes), half.bit_length()))):
+            plane = planes[i] if i < len(planes) else 0
+            if half >> i & 1:
+                equal &= plane
+            else:
+                greater |= equal & plane
+                equal &= ~plane
+        return greater
+    
+    def _index(self, fingerprint: int):
+        for (offset, mask, _), buckets in zip(self.bands, self.buckets):
+            buckets.setdefault((fingerprint >> offset) & mask, []).append(fingerprint)
+    
+    def nearest_distance(self, text: str) -> Optional[int]:
+        """Минимальное расстояние до известного текста, если оно не больше порога"""
+        if not self.enabled:
+            return None
+        fingerprint = self.fingerprint(text)
+        best = None
+        with self.lock:
+            for (offset, mask, flips), buckets in zip(self.bands, self.buckets):
+                key = (fingerprint >> offset) & mask
+                for flip in flips:
+                    for candidate in buckets.get(key ^ flip, ()):
+                        distance = bin(fingerprint ^ candidate).count('1')
+                        if distance <= self.max_distance and (best is None or distance < best):
+                            best = distance
+        return best
+    
+    def add(self, text: str):
+        if not self.enabled:
+            return
+        fingerprint = self.fingerprint(text)
+        with self.lock:
+            self._index(fingerprint)
+            self.pending.append(fingerprint.to_bytes(8, 'little'))
+    
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            try:
+                self.storage.append(self.pending)
+                self.pending = []
+            except Exception as e:
+                logger.error(f"❌ Ошибка сохранения {self.storage.filename}: {e}")
+
+
+class ImageUsageIndex:
+    """Индекс использования картинок: ключ - id фото Pexels (иначе URL), счетчики по дням.
+    
+    Дневные бакеты лежат в порядке времени, поэтому устаревшие снимаются с головы;
+    "использовалась ли за N дней" - одно сравнение с датой последнего использования.
+    """
+    CATALOG = "image"
+    
+    def __init__(self, store: "HistoryStore", clock: Callable[[], datetime], window_days: int = 30):
+        self.store = store
+        self.clock = clock
+        self.window_days = window_days
+        self.lock = threading.Lock()
+        self.buckets: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        self.totals: Dict[str, int] = {}
+        self.last_used: Dict[str, str] = {}
+        
+        store.index_image_usage()
+        rows = store.usage_by_day(self.CATALOG, self._window_start())
+        for key, day, count in sorted(rows, key=lambda row: row[1]):
+            self._add(key, day, count)
+    
+    @staticmethod
+    def key(photo: Dict) -> str:
+        """Одно фото Pexels в разных размерах - один ключ"""
+        return f"pexels:{photo['id']}" if photo.get("id") is not None else photo["url"]
+    
+    def _window_start(self) -> str:
+        return (self.clock() - timedelta(days=self.window_days)).strftime("%Y-%m-%d")
+    
+    def _add(self, key: str, day: str, count: int):
+        bucket = self.buckets.setdefault(day, {})
+        bucket[key] = bucket.get(key, 0) + count
+        self.totals[key] = self.totals.get(key, 0) + count
+        if day > self.last_used.get(key, ""):
+            self.last_used[key] = day
+    
+    def _expire(self):
+        window_start = self._window_start()
+        while self.buckets and next(iter(self.buckets)) < window_start:
+            _, bucket = self.buckets.popitem(last=False)
+            for key, count in bucket.items():
+                self.totals[key] -= count
+                if self.totals[key] <= 0:
+                    del self.totals[key]
+                    self.last_used.pop(key, None)
+    
+    def __len__(self) -> int:
+        return len(self.totals)
+    
+    def record(self, photo: Dict, day: str):
+        key = self.key(photo)
+        with self.lock:
+            self._add(key, day, 1)
+            self._expire()
+        self.store.record_usage(self.CATALOG, key, day)
+    
+    def used_since(self, photo: Dict, since_day: str) -> bool:
+        return self.last_used.get(self.key(photo), "") >= since_day
+    
+    def count(self, photo: Dict) -> int:
+        return self.totals.get(self.key(photo), 0)
+
+
+class FenwickTree:
+    """Дерево Фенвика над весами: обновление веса и взвешенная выборка за O(log n)"""
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.tree = [0.0] * (size + 1)
+    
+    def update(self, index: int, delta: float):
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+    
+    def total(self) -> float:
+        result = 0.0
+        i = self.size
+        while i > 0:
+            result += self.tree[i]
+            i -= i & -i
+        return result
+    
+    def find(self, value: float) -> int:
+        """Индекс первого элемента, на котором префиксная сумма превышает value"""
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            next_position = position + step
+            if next_position <= self.size and self.tree[next_position] <= value:
+                position = next_position
+                value -= self.tree[next_position]
+            step >>= 1
+        return min(position, self.size - 1)
+
+
+class RotationEngine:
+    """Взвешенная ротация элементов каталога (темы, подходы, вопросы, мысли).
+    
+    Использование хранится счетчиками по дням в скользящем окне. Вес элемента
+    1 / (использований за окно + 1), x2 если элемент не встречался bonus_days
+    дней; использованные сегодня исключаются, пока есть из чего выбирать.
+    """
+    
+    def __init__(self, catalog: str, items: List[str], store: "HistoryStore",
+                 clock: Callable[[], datetime], window_days: int = 7, bonus_days: int = 7):
+        self.catalog = catalog
+        self.items = list(dict.fromkeys(items))
+        self.positions = {item: i for i, item in enumerate(self.items)}
+        self.store = store
+        self.clock = clock
+        self.window_days = window_days
+        self.bonus_days = bonus_days
+        self.lock = threading.Lock()
+        self.today = None
+        self._rebuild()
+    
+    def _day(self, days_ago: int = 0) -> str:
+        return (self.clock() - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+    
+    def _rebuild(self):
+        """Пересчет окна - при старте и раз в сутки при смене даты"""
+        self.today = self._day()
+        window_start = self._day(self.window_days)
+        bonus_start = self._day(self.bonus_days - 1)
+        
+        self.window_counts: Dict[str, int] = {}
+        self.last_used: Dict[str, str] = {}
+        for item, day, count in self.store.usage_by_day(self.catalog, window_start):
+            if item not in self.positions:
+                continue
+            self.window_counts[item] = self.window_counts.get(item, 0) + count
+            self.last_used[item] = max(day, self.last_used.get(item, ""))
+        
+        self.bonus_start = bonus_start
+        self.weights = [self._weight(item) for item in self.items]
+        self.tree = FenwickTree(len(self.items))
+        for i, weight in enumerate(self.weights):
+            self.tree.update(i, weight)
+    
+    def _weight(self, item: str) -> float:
+        last_used = self.last_used.get(item, "")
+        if last_used == self.today:
+            return 0.0  # Не используем элементы, уже использованные сегодня
+        
+        # Вычисляем вес: меньше использований = больший вес
+        weight = 1.0 / (self.window_counts.get(item, 0) + 1)
+        if last_used < self.bonus_start:
+            weight *= 2.0
+        return weight
+    
+    def _set_weight(self, item: str):
+        i = self.positions[item]
+        weight = self._weight(item)
+        self.tree.update(i, weight - self.weights[i])
+        self.weights[i] = weight
+    
+    def pick(self) -> str:
+        """Выбирает элемент, не записывая использование"""
+        with self.lock:
+            if self._day() != self.today:
+                self._rebuild()
+            
+            total = self.tree.total()
+            if total > 1e-9:
+                return self.items[self.tree.find(random.random() * total)]
+            
+            # Если все элементы использованы сегодня, берем наименее использованные за окно
+            weights = [1.0 / (self.window_counts.get(item, 0) + 1) for item in self.items]
+            return random.choices(self.items, weights=weights, k=1)[0]
+    
+    def record(self, item: str):
+        """Записывает использование элемента"""
+        with self.lock:
+            if item not in self.positions:
+                return
+            if self._day() != self.today:
+                self._rebuild()
+            self.window_counts[item] = self.window_counts.get(item, 0) + 1
+            self.last_used[item] = self.today
+            self._set_weight(item)
+            self.store.record_usage(self.catalog, item, self.today)
+    
+    def choose(self) -> str:
+        item = self.pick()
+        self.record(item)
+        return item
+
+
+class PostBlock:
+    """Блок поста: тип и текст"""
+    
+    __slots__ = ('kind', 'text')
+    
+    def __init__(self, kind: str, text: str):
+        self.kind = kind
+        self.text = text
+    
+    def __repr__(self) -> str:
+        return f"PostBlock({self.kind!r}, {self.text[:30]!r})"
+
+
+class Post:
+    """Пост как список типизированных блоков.
+    
+    Текст разбирается на блоки один раз; проверки, исправления и подсчет
+    длины работают с блоками, а текст для отправки собирает render().
+    """
+    
+    HEADER, PARAGRAPH, KEY_THOUGHT, QUESTION, HASHTAGS = 'header', 'paragraph', 'key_thought', 'question', 'hashtags'
+    ORDER = (HEADER, PARAGRAPH, KEY_THOUGHT, QUESTION, HASHTAGS)
+    BLOCK_SPLIT_RE = re.compile(r'\n\s*\n')
+    JSON_OBJECT_RE = re.compile(r'\{.*\}', re.DOTALL)
+    
+    # responseSchema для structured output: блоки поста как поля объекта
+    JSON_SCHEMA = {
+        "type": "OBJECT",
+        "properties": {
+            HEADER: {"type": "STRING"},
+            PARAGRAPH: {"type": "STRING"},
+            KEY_THOUGHT: {"type": "STRING"},
+            QUESTION: {"type": "STRING"},
+            HASHTAGS: {"type": "ARRAY", "items": {"type": "STRING"}},
+        },
+        "required": list(ORDER),
+        "propertyOrdering": list(ORDER),
+    }
+    JSON_EXAMPLE = ('{"header": "заголовок", "paragraph": "основной текст", "key_thought": "ключевая мысль", '
+                    '"question": "вопрос читателю", "hashtags": ["#тег1", "#тег2", "#тег3"]}')
+    JSON_INSTRUCTION = "\n\nФОРМАТ ОТВЕТА: верни только JSON-объект, без пояснений и без markdown:\n" + JSON_EXAMPLE
+    
+    __slots__ = ('post_type', 'blocks')
+    
+    def __init__(self, post_type: str, blocks: List[PostBlock]):
+        self.post_type = post_type
+        self.blocks = blocks
+    
+    @classmethod
+    def parse(cls, text: str, post_type: str, slot_style: Dict = None) -> 'Post':
+        emoji = slot_style.get('emoji') if post_type == 'telegram' and slot_style else None
+        chunks = [chunk.strip() for chunk in cls.BLOCK_SPLIT_RE.split((text or '').strip())]
+        chunks = [chunk for chunk in chunks if chunk]
+        return cls(post_type, [PostBlock(cls.classify(chunk, i, post_type, emoji), chunk)
+                               for i, chunk in enumerate(chunks)])
+    
+    @classmethod
+    def classify(cls, text: str, index: int, post_type: str, emoji: Optional[str] = None) -> str:
+        if emoji and text.startswith(emoji):
+            return cls.HEADER
+        if post_type == 'telegram' and '🎯' in text:
+            return cls.KEY_THOUGHT
+        if text.endswith('?'):
+            if index == 0 and post_type == 'zen':
+                return cls.HEADER
+            if index != 0:
+                return cls.QUESTION
+        if text.startswith('#'):
+            return cls.HASHTAGS
+        return cls.PARAGRAPH
+    
+    @classmethod
+    def extract_json(cls, raw: str) -> Optional[Dict]:
+        """JSON-объект из ответа модели (в том числе обернутый в ```json)"""
+        match = cls.JSON_OBJECT_RE.search(raw or '')
+        if not match:
+            return None
+        try:
+            data = json.loads(match.group(0))
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    
+    @classmethod
+    def from_json(cls, raw: str, post_type: str, emoji: Optional[str] = None) -> Optional['Post']:
+        """Собирает пост из JSON-ответа модели; None, если ответ не JSON или не хватает блоков"""
+        return cls.from_dict(cls.extract_json(raw), post_type, emoji)
+    
+    @classmethod
+    def from_dict(cls, data: Optional[Dict], post_type: str, emoji: Optional[str] = None) -> Optional['Post']:
+        if not isinstance(data, dict):
+            return None
+        
+        texts = {}
+        for kind in cls.ORDER:
+            value = data.get(kind)
+            if kind == cls.HASHTAGS:
+                tags = value.split() if isinstance(value, str) else (value or [])
+                tags = [str(tag).strip().lstrip('#') for tag in tags]
+                value = ' '.join('#' + tag for tag in tags if tag)
+            # Каждый блок - одна строка, иначе при отправке он развалится на несколько
+            value = ' '.join(str(value or '').split())
+            if post_type == 'telegram':
+                value = PostTextPipeline.HTML_TAG_RE.sub('', value.replace('**', '')).strip()
+            if not value:
+                return None
+            texts[kind] = value
+        
+        if post_type == 'telegram':
+            if emoji and not texts[cls.HEADER].startswith(emoji):
+                texts[cls.HEADER] = f"{emoji} {texts[cls.HEADER]}"
+            if not texts[cls.KEY_THOUGHT].startswith('🎯'):
+                texts[cls.KEY_THOUGHT] = f"🎯 {texts[cls.KEY_THOUGHT]}"
+        
+        return cls(post_type, [PostBlock(kind, texts[kind]) for kind in cls.ORDER])
+    
+    def index_of(self, kind: str, last: bool = False) -> int:
+        """Индекс первого (или последнего) блока типа kind, -1 если его нет"""
+        indices = range(len(self.blocks) - 1, -1, -1) if last else range(len(self.blocks))
+        for i in indices:
+            if self.blocks[i].kind == kind:
+                return i
+        return -1
+    
+    def has(self, kind: str) -> bool:
+        return any(block.kind == kind for block in self.blocks)
+    
+    def lines(self) -> List[str]:
+        return [line.strip() for block in self.blocks for line in block.text.split('\n') if line.strip()]
+    
+    def body_lines(self) -> List[str]:
+        """Строки всех блоков, кроме хештегов"""
+        return [line.strip() for block in self.blocks if block.kind != self.HASHTAGS
+                for line in block.text.split('\n') if line.strip()]
+    
+    def render(self) -> str:
+        return '\n\n'.join(block.text for block in self.blocks)
+    
+    def __len__(self) -> int:
+        return len(self.render())
+
+
+class PickContext:
+    """Элементы ротации для одного промпта: выбираются вместе, использование пишется только в commit().
+    
+    С record=False commit() только помечает выбор принятым - так готовятся черновики,
+    использование которых учитывается, когда черновик уходит в слот.
+    """
+    
+    def __init__(self, engines: Dict[str, RotationEngine], record: bool = True):
+        self.engines = engines
+        self.record = record
+        self.picks: Dict[str, str] = {}
+        self.committed = False
+    
+    def get(self, catalog: str) -> str:
+        if catalog not in self.picks:
+            self.picks[catalog] = self.engines[catalog].pick()
+        return self.picks[catalog]
+    
+    def commit(self):
+        """Фиксирует использование - вызывается для принятой попытки"""
+        if self.committed:
+            return
+        if self.record:
+            for catalog, item in self.picks.items():
+                self.engines[catalog].record(item)
+        self.committed = True
+
+
+class LengthBudget:
+    """Бюджет длины генерации для слота: maxOutputTokens и запрашиваемый в промпте диапазон символов.
+    
+    По каждому ответу модели обновляются скользящие средние для пары (слот, тип поста):
+    сколько символов дает один токен и во сколько раз длина поста отличается от запрошенной.
+    """
+    ALPHA = 0.3  # вес нового наблюдения
+    # Во сколько раз check_post_complete допускает превышение максимума слота
+    LENGTH_TOLERANCE = {'telegram': 1.2, 'zen': 1.3}
+    TOKEN_HEADROOM = 1.3
+    TOKEN_STEP = 50  # округление лимита, чтобы не дробить кэш ответов
+    MIN_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS = 300, 2048
+    RATIO_LIMITS = (0.75, 1.33)
+    
+    def __init__(self, history: HistoryStore):
+        self.history = history
+        self.lock = threading.Lock()
+        self.stats: Dict[Tuple[str, str], List] = {
+            (slot_type, post_type): [chars_per_token, length_ratio, samples]
+            for slot_type, post_type, chars_per_token, length_ratio, samples in history.length_stats()
+        }
+    
+    @staticmethod
+    def _key(slot_style: Dict, post_type: str) -> Tuple[str, str]:
+        return slot_style.get('type', ''), post_type
+    
+    @staticmethod
+    def _budget(slot_style: Dict, post_type: str, kind: str) -> Tuple[int, int]:
+        return slot_style[f"{'tg' if post_type == 'telegram' else 'zen'}_{kind}"]
+    
+    def chars_per_token(self, slot_style: Dict, post_type: str) -> float:
+        """Наблюдаемое число символов на токен, до первых наблюдений - из бюджета слота"""
+        stats = self.stats.get(self._key(slot_style, post_type))
+        if stats and stats[0]:
+            return stats[0]
+        return self._budget(slot_style, post_type, 'chars')[1] / self._budget(slot_style, post_type, 'tokens')[1]
+    
+    def max_output_tokens(self, slot_style: Dict, post_type: str, overhead: int = 0) -> int:
+        """Лимит токенов, в который помещается самый длинный пост, еще проходящий проверку длины"""
+        chars = self._budget(slot_style, post_type, 'chars')[1] * self.LENGTH_TOLERANCE[post_type]
+        tokens = chars / self.chars_per_token(slot_style, post_type) * self.TOKEN_HEADROOM + overhead
+        tokens = math.ceil(tokens / self.TOKEN_STEP) * self.TOKEN_STEP
+        return max(self.MIN_OUTPUT_TOKENS, min(self.MAX_OUTPUT_TOKENS, tokens))
+    
+    def target_chars(self, slot_style: Dict, post_type: str) -> Tuple[int, int]:
+        """Диапазон символов для промпта с поправкой на то, насколько модель обычно промахивается"""
+        low, high = self._budget(slot_style, post_type, 'chars')
+        stats = self.stats.get(self._key(slot_style, post_type))
+        ratio = stats[1] if stats and stats[1] else 1.0
+        ratio = min(max(ratio, self.RATIO_LIMITS[0]), self.RATIO_LIMITS[1])
+        return round(low / ratio / 10) * 10, round(high / ratio / 10) * 10
+    
+    def observe(self, slot_style: Dict, post_type: str, response_chars: int,
+                output_tokens: Optional[int], post_chars: Optional[int]):
+        """Учитывает ответ модели: длину сырого ответа, число токенов и длину готового поста"""
+        key = self._key(slot_style, post_type)
+        requested_low, requested_high = self.target_chars(slot_style, post_type)
+        
+        with self.lock:
+            stats = self.stats.setdefault(key, [None, None, 0])
+            if output_tokens:
+                stats[0] = self._ema(stats[0], response_chars / output_tokens)
+            if post_chars:
+                stats[1] = self._ema(stats[1], post_chars / ((requested_low + requested_high) / 2))
+            stats[2] += 1
+            values = tuple(stats)
+        
+        self.history.save_length_stats(key[0], key[1], *values)
+    
+    def _ema(self, current: Optional[float], value: float) -> float:
+        return value if current is None else current + self.ALPHA * (value - current)
+
+
+def _trie_pattern(words: List[str]) -> str:
+    """Собирает из списка слов регулярку-префиксное дерево: общие префиксы проверяются один раз"""
+    tree: Dict[str, Any] = {}
+    for word in words:
+        node = tree
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+    
+    def build(node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        optional = '' in node
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')' + ('?' if optional else '')
+    
+    return build(tree)
+
+
+class PostTextPipeline:
+    """Очистка ответа модели за один проход.
+    
+    Токенизатор один раз проходит по строкам, снимает нумерацию и маркеры
+    и классифицирует строку (заголовок, абзац, хештеги). Дальше список
+    строк проходит через этапы-преобразования из STAGES.
+    """
+    
+    HEADER, BODY, HASHTAGS = 'header', 'body', 'hashtags'
+    
+    MARKERS = [
+        'заголовок:', 'абзац 1:', 'абзац 2:', 'ключевая мысль:', 'вопрос:', 'хештеги:',
+        'якорь:', 'в итоге:', 'anchor:', 'header:', 'paragraph:', 'key thought:',
+        'question:', 'hashtags:', 'абзац:', 'блок:', 'блок 1:', 'блок 2:', 'блок 3:', 'блок 4:', 'блок 5:',
+        'пустая строка', 'пустая строка:', 'ппустая строка'
+    ]
+    KEY_THOUGHT_PREFIXES = ('🎯 Ключевая мысль:', 'Ключевая мысль:', 'Ключевая мысль ')
+    DEFAULT_HASHTAGS = "#управление #практика #результат"
+    
+    MARKER_RE = re.compile(_trie_pattern(MARKERS), re.IGNORECASE)
+    NUMBERING_RE = re.compile(r'^\[\d+\]\s*')
+    HTML_TAG_RE = re.compile(r'<[^>]+>')
+    HASHTAG_RE = re.compile(r'#\w+')
+    NON_WORD_RE = re.compile(r'[^\w]')
+    
+    STAGES = ('_capitalize_paragraphs', '_hashtags_to_end', '_ensure_hashtags')
+    
+    def process(self, text: str, post_type: str, theme: Optional[str] = None) -> str:
+        if not text:
+            return text
+        lines = self.tokenize(text, post_type)
+        for stage in self.STAGES:
+            lines = getattr(self, stage)(lines, post_type, theme)
+        return '\n\n'.join(line for _, line in lines)
+    
+    def tokenize(self, text: str, post_type: str) -> List[Tuple[str, str]]:
+        """Разбивает текст на непустые строки (вид, текст) без маркеров и служебной разметки"""
+        telegram = post_type == 'telegram'
+        lines = []
+        for line in text.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
             
-            url = f"{self.BASE_URL}/repos/{self.repo_owner}/{self.repo_name}/contents/{file_path}"
-            response = session.get(url, headers=self._get_headers())
+            if line[0] == '[':
+                # Нумерация [1], [2]... и одиночная скобка в начале
+                line = self.NUMBERING_RE.sub('', line, count=1)
             
-            if response.status_code == 200:
-                content = response.json()
-                if "content" in content and content.get("encoding") == "base64":
-                    decoded = base64.b64decode(content["content"]).decode('utf-8')
-                    return decoded
-                return {"error": "Неожиданный формат ответа"}
-            return {"error": f"API error: {response.status_code}"}
-        except Exception as e:
-            logger.error(f"❌ Ошибка GitHub API: {e}")
-            return {"error": str(e)}
-    
-    def edit_file(self, file_path: str, new_content: str, commit_message: str) -> Dict:
-        try:
-            if not self.github_token or not self.repo_owner or not self.repo_name:
-                return {"error": "Недостаточно данных для доступа к репозиторию"}
+            # Метки "ЗАГОЛОВОК:", "АБЗАЦ 1:" и т.д. - оставляем текст после двоеточия
+            marker = self.MARKER_RE.match(line)
+            if marker:
+                colon = line.find(':')
+                line = line[colon + 1:].strip() if colon >= 0 else line[marker.end():].strip()
             
-            url = f"{self.BASE_URL}/repos/{self.repo_owner}/{self.repo_name}/contents/{file_path}"
-            response = session.get(url, headers=self._get_headers())
+            if line.startswith('['):
+                line = line[1:]
             
-            if response.status_code != 200:
-                return {"error": "Файл не найден"}
+            # Цифры-обрывки в конце (например, "5" после хештегов)
+            if not line or (len(line) <= 2 and line.isdigit()):
+                continue
             
-            current_file = response.json()
-            sha = current_file["sha"]
+            if telegram:
+                line = line.replace('**', '')
             
-            encoded_content = base64.b64encode(new_content.encode('utf-8')).decode('utf-8')
+            if line[0] == '#':
+                kind = self.HASHTAGS
+            else:
+                if telegram and '<' in line:
+                    line = self.HTML_TAG_RE.sub('', line)
+                line = self._strip_key_thought(line)
+                kind = self.BODY if lines else self.HEADER
             
-            data = {
-                "message": commit_message,
-                "content": encoded_content,
-                "sha": sha
-            }
+            line = line.strip()
+            if line:
+                lines.append((kind, line))
+        return lines
+    
+    def _strip_key_thought(self, line: str) -> str:
+        for prefix in self.KEY_THOUGHT_PREFIXES:
+            if line.startswith(prefix):
+                return line[len(prefix):].strip()
+        return line
+    
+    def _capitalize_paragraphs(self, lines, post_type, theme):
+        """Абзацы (кроме заголовка) начинаются с заглавной буквы"""
+        return [(kind, line[0].upper() + line[1:] if kind == self.BODY and line[0].islower() else line)
+                for kind, line in lines]
+    
+    def _hashtags_to_end(self, lines, post_type, theme):
+        """Telegram: хештеги переносятся в конец поста"""
+        if post_type != 'telegram':
+            return lines
+        return ([item for item in lines if item[0] != self.HASHTAGS] +
+                [item for item in lines if item[0] == self.HASHTAGS])
+    
+    def _ensure_hashtags(self, lines, post_type, theme):
+        """Если хештегов не осталось, добавляет их по словам темы"""
+        if not theme or any(self.HASHTAG_RE.search(line) for _, line in lines):
+            return lines
+        return lines + [(self.HASHTAGS, self.theme_hashtags(theme))]
+    
+    @classmethod
+    def theme_hashtags(cls, theme: Optional[str]) -> str:
+        """Хештеги из первых трех значимых слов темы"""
+        theme_words = [word.strip() for word in (theme or '').split() if len(word.strip()) > 2]
+        if not theme_words:
+            return cls.DEFAULT_HASHTAGS
+        return '#' + ' #'.join(cls.NON_WORD_RE.sub('', word.lower()) for word in theme_words[:3])
+
+
+class WebhookServer:
+    """Локальный HTTP сервер для webhook Telegram.
+    
+    Принимает POST с обновлением, сверяет заголовок X-Telegram-Bot-Api-Secret-Token,
+    отвечает 200 и передает JSON обновления в on_update. С port=0 слушает свободный
+    порт - так же его можно поднять локально вместо Telegram.
+    """
+    SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+    MAX_BODY = 1024 * 1024
+    
+    def __init__(self, host: str, port: int, secret: str, on_update: Callable[[Dict], None]):
+        self.secret = secret
+        self.on_update = on_update
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+    
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+    
+    def _make_handler(self):
+        server = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                # compare_digest на str падает на не-ASCII символах - сравниваем байты
+                secret = self.headers.get(server.SECRET_HEADER, "").encode("utf-8")
+                if not hmac.compare_digest(secret, server.secret.encode("utf-8")):
+                    logger.warning(f"⚠️ Webhook: запрос с неверным секретом от {self.client_address[0]}")
+                    return self._reply(403)
+                
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    return self._reply(400)
+                if length <= 0 or length > server.MAX_BODY:
+                    return self._reply(400)
+                try:
+                    update = json.loads(self.rfile.read(length).decode('utf-8'))
+                except ValueError:
+                    return self._reply(400)
+                
+                # Telegram ждет быстрый ответ - обрабатываем уже после него
+                self._reply(200)
+                try:
+                    server.on_update(update)
+                except Exception as e:
+                    logger.error(f"💥 Webhook: ошибка обработки обновления: {e}")
             
-            response = session.put(url, headers=self._get_headers(), json=data)
-            return response.json()
-        except Exception as e:
-            logger.error(f"❌ Ошибка редактирования файла: {e}")
-            return {"error": str(e)}
+            def _reply(self, status: int):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            
+            def log_message(self, format, *args):
+                logger.debug("webhook: " + format % args)
+        
+        return Handler
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="webhook", daemon=True)
+        self.thread.start()
+        logger.info(f"🌐 Webhook сервер слушает порт {self.port}")
+    
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread:
+            self.thread.join(timeout=5)
 
 
 class TelegramBot:
@@ -572,28 +2429,59 @@ class TelegramBot:
         self.auto = auto
         self.bot = telebot.TeleBot(BOT_TOKEN, parse_mode='HTML')
         self.github_manager = GitHubAPIManager()
+        self.gemini = GeminiClient(GEMINI_API_KEY)
+        self.gemini_cache = GeminiResponseCache()
+        self.image_pool = ImageCandidatePool()
+        self.photo_cache = TelegramPhotoCache()
+        self.text_pipeline = PostTextPipeline()
         self.pending_posts: Dict[int, Dict] = {}
-        self.post_history = self._load_json("post_history.json", {
-            "sent_slots": {},
-            "rejected_slots": {},
-            "generated_texts": [],
-            "used_approaches": [],
-            "used_questions": [],
-            "used_key_thoughts": []
-        })
-        self.image_history = self._load_json("image_history.json", {
-            "used_images": []
-        })
+        # pending_posts меняют поток приема обновлений, пул действий модерации и цикл демона
+        self.pending_lock = threading.RLock()
+        # Постоянный id поста на модерации: message_id меняется, когда пост пересылается с новым фото
+        self.post_ids = itertools.count(1)
+        self.history = HistoryStore()
+        if self.history.needs_json_migration():
+            self.history.migrate_from_json(
+                self._load_json("post_history.json", {}),
+                self._load_json("image_history.json", {})
+            )
+        # Очищаем записи старше 30 дней
+        thirty_days_ago = (self.get_moscow_time() - timedelta(days=30)).strftime("%Y-%m-%d")
+        self.history.prune_usage(thirty_days_ago)
+        self.history.prune_images(thirty_days_ago)
+        # Черновики на прошедшие дни уже не понадобятся
+        self.history.prune_drafts(self.get_moscow_time().strftime("%Y-%m-%d"))
+        self.history.flush()
+        self.pexels = PexelsClient(PEXELS_API_KEY, self.history)
+        self.image_resolver = ImageResolver(self._build_image_providers())
+        self.text_index = TextHashIndex(seed=self.history.text_hashes)
+        self.image_usage = ImageUsageIndex(self.history, self.get_moscow_time)
+        self.near_duplicates = SimHashIndex()
+        self.length_budget = LengthBudget(self.history)
+        self.rotation = {
+            "theme": RotationEngine("theme", self.THEMES, self.history, self.get_moscow_time, bonus_days=2),
+            "approach": RotationEngine("approach", self.APPROACHES, self.history, self.get_moscow_time),
+            "question": RotationEngine("question", self.QUESTION_TYPES, self.history, self.get_moscow_time),
+            "thought": RotationEngine("thought", self.KEY_THOUGHTS, self.history, self.get_moscow_time),
+        }
         self.current_theme = None
         self.current_format = None
         self.current_style = None
         self.published_posts_count = 0
-        self.workflow_complete = False
-        self.stop_polling = False
+        # Модерация завершена: выставляют обработчики одобрения, отклонения и правок
+        self.moderation_done = threading.Event()
+        self.stop_polling_event = threading.Event()
         self.publish_lock = threading.Lock()
-        self.completion_lock = threading.Lock()
         self.polling_lock = threading.Lock()
         self.polling_thread = None
+        self.webhook_server: Optional[WebhookServer] = None
+        # Долгие действия с кнопок выполняются в пуле; по одному действию на пост одновременно
+        self.callback_executor = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS, thread_name_prefix="callback")
+        self.busy_posts: set = set()
+        self.busy_lock = threading.Lock()
+        self.shutdown_event = threading.Event()
+        # Слоты, черновик для которых в этом процессе не получился: сгенерируются в срок
+        self.failed_drafts: set = set()
         
         self.callback_handlers = {
             "publish": self._handle_approval,
@@ -615,125 +2503,21 @@ class TelegramBot:
             logger.warning(f"⚠️ Ошибка загрузки {filename}: {e}")
         return default_data
     
-    def _save_json(self, filename: str, data: Dict) -> bool:
+    def _flush_state(self):
+        """Сбрасывает на диск накопленные изменения истории и кэша"""
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            return True
+            self.history.flush()
+            self.text_index.flush()
+            self.near_duplicates.flush()
+            self.gemini_cache.flush()
+            self.image_pool.flush()
+            self.photo_cache.flush()
         except Exception as e:
-            logger.error(f"❌ Ошибка сохранения {filename}: {e}")
-            return False
+            logger.error(f"❌ Ошибка сохранения состояния: {e}")
     
     def get_moscow_time(self) -> datetime:
         return datetime.utcnow() + timedelta(hours=3)
     
-    def _clean_metadata(self, text: str, post_type: str) -> str:
-        """Удаляет маркеры и метаданные из текста"""
-        if not text:
-            return text
-        
-        lines = []
-        for line in text.split('\n'):
-            line = line.strip()
-            if not line:
-                lines.append('')
-                continue
-            
-            # Удаляем нумерацию типа [1], [2], [3], [4] и т.д.
-            line = re.sub(r'^\[\d+\]\s*', '', line)
-            
-            # Удаляем метки типа "ЗАГОЛОВОК:", "АБЗАЦ 1:", "АБЗАЦ 2:", "КЛЮЧЕВАЯ МЫСЛЬ:", "ВОПРОС:", "ХЕШТЕГИ:" и т.д.
-            markers_to_remove = [
-                'заголовок:', 'абзац 1:', 'абзац 2:', 'ключевая мысль:', 'вопрос:', 'хештеги:',
-                'якорь:', 'в итоге:', 'anchor:', 'header:', 'paragraph:', 'key thought:',
-                'question:', 'hashtags:', 'абзац:', 'блок:', 'блок 1:', 'блок 2:', 'блок 3:', 'блок 4:', 'блок 5:',
-                'пустая строка', 'пустая строка:', 'пустая строка:', 'ппустая строка'
-            ]
-            
-            for marker in markers_to_remove:
-                if line.lower().startswith(marker):
-                    # Удаляем метку, оставляем только текст после двоеточия
-                    parts = line.split(':', 1)
-                    if len(parts) > 1:
-                        line = parts[1].strip()
-                    else:
-                        line = line[len(marker):].strip()
-                    break
-            
-            # Удаляем начальные квадратные скобки '[' в начале строки
-            if line.startswith('['):
-                line = re.sub(r'^\[', '', line)
-            
-                       # Удаляем цифры в конце строк (например, "5" после хештегов)
-            if line.isdigit() and len(line) <= 2:
-                continue
-            
-            # ИСПРАВЛЕНИЕ: Не удалять строки с хештегами, которые выглядят как "#с" или "#у" и т.д.
-            if post_type in ['telegram', 'zen'] and line.startswith('#') and len(line) <= 3:
-                lines.append(line)
-                continue
-            
-            # Telegram: сохраняем эмодзи в начале
-            if post_type == 'telegram' and self.current_style:
-                emoji = self.current_style.get('emoji', '')
-                if emoji and line.startswith(emoji):
-                    # Оставляем эмодзи + заголовок
-                    pass
-            
-            # Telegram: НЕ удалять хештеги
-            if post_type == 'telegram' and line.startswith('#'):
-                # Оставляем хештеги как есть
-                lines.append(line)
-                continue
-            
-            # Zen: НЕ удалять хештеги
-            if post_type == 'zen' and line.startswith('#'):
-                # Оставляем хештеги как есть
-                lines.append(line)
-                continue
-            
-            # Удаляем теги форматирования HTML, но оставляем текст
-            if post_type == 'telegram':
-                line = re.sub(r'<[^>]+>', '', line)
-            
-            lines.append(line)
-        
-        # Объединяем обратно, убирая лишние пустые строки
-        cleaned_text = '\n'.join(lines)
-        
-        # Убираем повторяющиеся пустые строки (больше 2 подряд)
-        cleaned_text = re.sub(r'\n\s*\n\s*\n+', '\n\n', cleaned_text)
-        
-        # Telegram: если убрались все хештеги, добавляем дефолтные
-        if post_type == 'telegram' and not re.search(r'#\w+', cleaned_text):
-            if self.current_theme:
-                theme_words = [word.strip() for word in self.current_theme.split() if len(word.strip()) > 2]
-                if theme_words:
-                    hashtags = '#' + ' #'.join([re.sub(r'[^\w]', '', word.lower()) for word in theme_words[:3]])
-                else:
-                    hashtags = "#управление #практика #результат"
-                
-                cleaned_text = cleaned_text.strip()
-                if not cleaned_text.endswith('\n'):
-                    cleaned_text += '\n\n'
-                cleaned_text += hashtags
-        
-        # Zen: если убрались все хештеги, добавляем дефолтные
-        if post_type == 'zen' and not re.search(r'#\w+', cleaned_text):
-            if self.current_theme:
-                theme_words = [word.strip() for word in self.current_theme.split() if len(word.strip()) > 2]
-                if theme_words:
-                    hashtags = '#' + ' #'.join([re.sub(r'[^\w]', '', word.lower()) for word in theme_words[:3]])
-                else:
-                    hashtags = "#управление #практика #результат"
-                
-                cleaned_text = cleaned_text.strip()
-                if not cleaned_text.endswith('\n'):
-                    cleaned_text += '\n\n'
-                cleaned_text += hashtags
-        
-        return cleaned_text.strip()
-    
     def _get_text_hash(self, text: str) -> str:
         """Получает хеш текста для проверки уникальности"""
         # Убираем эмодзи и лишние пробелы для более точного сравнения
@@ -742,311 +2526,35 @@ class TelegramBot:
         return hashlib.md5(clean_text.encode('utf-8')).hexdigest()
     
     def _is_duplicate_text(self, text: str) -> bool:
-        """Проверяет, был ли такой текст уже сгенерирован"""
-        text_hash = self._get_text_hash(text)
-        generated_texts = self.post_history.get("generated_texts", [])
-        return text_hash in generated_texts
+        """Проверяет, был ли такой или почти такой текст уже сгенерирован"""
+        if self.text_index.contains(self._get_text_hash(text)):
+            return True
+        
+        distance = self.near_duplicates.nearest_distance(text)
+        if distance is not None:
+            logger.info(f"🔁 Найден почти-дубликат (SimHash, расстояние {distance})")
+            return True
+        return False
     
     def _add_to_generated_texts(self, text: str):
         """Добавляет хеш текста в историю"""
-        text_hash = self._get_text_hash(text)
-        if "generated_texts" not in self.post_history:
-            self.post_history["generated_texts"] = []
-        
-        # Ограничиваем размер истории до последних 500 текстов
-        if len(self.post_history["generated_texts"]) >= 500:
-            self.post_history["generated_texts"] = self.post_history["generated_texts"][-250:]
-        
-        if text_hash not in self.post_history["generated_texts"]:
-            self.post_history["generated_texts"].append(text_hash)
-            self._save_json("post_history.json", self.post_history)
-    
-    def _get_fresh_approach(self) -> str:
-        """Получает свежий подход для поста с улучшенной ротацией"""
-        today = self.get_moscow_time().strftime("%Y-%m-%d")
-        
-        # Загружаем историю использования подходов
-        if "used_approaches_detailed" not in self.post_history:
-            self.post_history["used_approaches_detailed"] = []
-        
-        used_details = self.post_history["used_approaches_detailed"]
-        
-        # Очищаем старые записи (старше 30 дней)
-        thirty_days_ago = (self.get_moscow_time() - timedelta(days=30)).strftime("%Y-%m-%d")
-        used_details = [item for item in used_details if item.get("last_used", "") >= thirty_days_ago]
-        
-        # Подсчитываем использование за последние 7 дней
-        week_ago = (self.get_moscow_time() - timedelta(days=7)).strftime("%Y-%m-%d")
-        recent_usage = {}
-        
-        for item in used_details:
-            if item.get("last_used", "") >= week_ago:
-                approach = item.get("approach", "")
-                if approach:
-                    recent_usage[approach] = recent_usage.get(approach, 0) + 1
-        
-        # Исключаем подходы, использованные сегодня
-        today_used = [item.get("approach", "") for item in used_details if item.get("last_used", "") == today]
-        
-        # Создаем список доступных подходов с весами
-        available_approaches = []
-        weights = []
-        
-        for approach in self.APPROACHES:
-            if approach in today_used:
-                continue  # Не используем подходы, уже использованные сегодня
-            
-            # Вычисляем вес: меньше использований = больший вес
-            usage_count = recent_usage.get(approach, 0)
-            weight = 1.0 / (usage_count + 1)  # +1 чтобы избежать деления на 0
-            
-            # Добавляем бонус для подходов, не использованных более 7 дней
-            if usage_count == 0:
-                weight *= 2.0
-            
-            available_approaches.append(approach)
-            weights.append(weight)
-        
-        if not available_approaches:
-            # Если все подходы использованы сегодня, используем наименее использованные за неделю
-            for approach in self.APPROACHES:
-                usage_count = recent_usage.get(approach, 0)
-                weight = 1.0 / (usage_count + 1)
-                available_approaches.append(approach)
-                weights.append(weight)
-        
-        # Выбираем подход с учетом весов
-        chosen = random.choices(available_approaches, weights=weights, k=1)[0]
-        
-        # Обновляем историю использования
-        found = False
-        for item in used_details:
-            if item.get("approach", "") == chosen:
-                item["last_used"] = today
-                item["count"] = item.get("count", 0) + 1
-                found = True
-                break
-        
-        if not found:
-            used_details.append({
-                "approach": chosen,
-                "last_used": today,
-                "count": 1
-            })
-        
-        # Ограничиваем размер истории
-        if len(used_details) > 500:
-            # Удаляем наименее используемые подходы
-            used_details.sort(key=lambda x: (x.get("count", 0), x.get("last_used", "")))
-            used_details = used_details[-400:]
-        
-        self.post_history["used_approaches_detailed"] = used_details
-        
-        # Сохраняем также в старом формате для обратной совместимости
-        if "used_approaches" not in self.post_history:
-            self.post_history["used_approaches"] = []
-        
-        # Ограничиваем размер старого списка
-        if len(self.post_history["used_approaches"]) >= 200:
-            self.post_history["used_approaches"] = self.post_history["used_approaches"][-100:]
-        
-        self.post_history["used_approaches"].append(chosen)
-        self._save_json("post_history.json", self.post_history)
-        
-        return chosen
+        self.text_index.add(self._get_text_hash(text))
+        self.near_duplicates.add(text)
     
-    def _get_fresh_question(self) -> str:
-        """Получает свежий вопрос для поста с улучшенной ротацией"""
-        today = self.get_moscow_time().strftime("%Y-%m-%d")
-        
-        # Загружаем историю использования вопросов
-        if "used_questions_detailed" not in self.post_history:
-            self.post_history["used_questions_detailed"] = []
-        
-        used_details = self.post_history["used_questions_detailed"]
-        
-        # Очищаем старые записи (старше 30 дней)
-        thirty_days_ago = (self.get_moscow_time() - timedelta(days=30)).strftime("%Y-%m-%d")
-        used_details = [item for item in used_details if item.get("last_used", "") >= thirty_days_ago]
-        
-        # Подсчитываем использование за последние 7 дней
-        week_ago = (self.get_moscow_time() - timedelta(days=7)).strftime("%Y-%m-%d")
-        recent_usage = {}
-        
-        for item in used_details:
-            if item.get("last_used", "") >= week_ago:
-                question = item.get("question", "")
-                if question:
-                    recent_usage[question] = recent_usage.get(question, 0) + 1
-        
-        # Исключаем вопросы, использованные сегодня
-        today_used = [item.get("question", "") for item in used_details if item.get("last_used", "") == today]
-        
-        # Создаем список доступных вопросов с весами
-        available_questions = []
-        weights = []
-        
-        for question in self.QUESTION_TYPES:
-            if question in today_used:
-                continue  # Не используем вопросы, уже использованные сегодня
-            
-            # Вычисляем вес: меньше использований = больший вес
-            usage_count = recent_usage.get(question, 0)
-            weight = 1.0 / (usage_count + 1)  # +1 чтобы избежать деления на 0
-            
-            # Добавляем бонус для вопросов, не использованных более 7 дней
-            if usage_count == 0:
-                weight *= 2.0
-            
-            available_questions.append(question)
-            weights.append(weight)
-        
-        if not available_questions:
-            # Если все вопросы использованы сегодня, используем наименее использованные за неделю
-            for question in self.QUESTION_TYPES:
-                usage_count = recent_usage.get(question, 0)
-                weight = 1.0 / (usage_count + 1)
-                available_questions.append(question)
-                weights.append(weight)
-        
-        # Выбираем вопрос с учетом весов
-        chosen = random.choices(available_questions, weights=weights, k=1)[0]
-        
-        # Обновляем историю использования
-        found = False
-        for item in used_details:
-            if item.get("question", "") == chosen:
-                item["last_used"] = today
-                item["count"] = item.get("count", 0) + 1
-                found = True
-                break
-        
-        if not found:
-            used_details.append({
-                "question": chosen,
-                "last_used": today,
-                "count": 1
-            })
-        
-        # Ограничиваем размер истории
-        if len(used_details) > 500:
-            # Удаляем наименее используемые вопросы
-            used_details.sort(key=lambda x: (x.get("count", 0), x.get("last_used", "")))
-            used_details = used_details[-400:]
-        
-        self.post_history["used_questions_detailed"] = used_details
-        
-        # Сохраняем также в старом формате для обратной совместимости
-        if "used_questions" not in self.post_history:
-            self.post_history["used_questions"] = []
-        
-        # Ограничиваем размер старого списка
-        if len(self.post_history["used_questions"]) >= 200:
-            self.post_history["used_questions"] = self.post_history["used_questions"][-100:]
-        
-        self.post_history["used_questions"].append(chosen)
-        self._save_json("post_history.json", self.post_history)
-        
-        return chosen
+    # ========== ОБНОВЛЕННЫЕ ПРОМПТЫ ==========
+    def new_pick_context(self, record: bool = True) -> PickContext:
+        return PickContext(self.rotation, record)
     
-    def _get_fresh_key_thought(self) -> str:
-        """Получает свежую ключевую мысль для поста с улучшенной ротацией"""
-        today = self.get_moscow_time().strftime("%Y-%m-%d")
-        
-        # Загружаем историю использования ключевых мыслей
-        if "used_key_thoughts_detailed" not in self.post_history:
-            self.post_history["used_key_thoughts_detailed"] = []
-        
-        used_details = self.post_history["used_key_thoughts_detailed"]
-        
-        # Очищаем старые записи (старше 30 дней)
-        thirty_days_ago = (self.get_moscow_time() - timedelta(days=30)).strftime("%Y-%m-%d")
-        used_details = [item for item in used_details if item.get("last_used", "") >= thirty_days_ago]
-        
-        # Подсчитываем использование за последние 7 дней
-        week_ago = (self.get_moscow_time() - timedelta(days=7)).strftime("%Y-%m-%d")
-        recent_usage = {}
-        
-        for item in used_details:
-            if item.get("last_used", "") >= week_ago:
-                thought = item.get("thought", "")
-                if thought:
-                    recent_usage[thought] = recent_usage.get(thought, 0) + 1
-        
-        # Исключаем мысли, использованные сегодня
-        today_used = [item.get("thought", "") for item in used_details if item.get("last_used", "") == today]
-        
-        # Создаем список доступных мыслей с весами
-        available_thoughts = []
-        weights = []
-        
-        for thought in self.KEY_THOUGHTS:
-            if thought in today_used:
-                continue  # Не используем мысли, уже использованные сегодня
-            
-            # Вычисляем вес: меньше использований = больший вес
-            usage_count = recent_usage.get(thought, 0)
-            weight = 1.0 / (usage_count + 1)  # +1 чтобы избежать деления на 0
-            
-            # Добавляем бонус для мыслей, не использованных более 7 дней
-            if usage_count == 0:
-                weight *= 2.0
-            
-            available_thoughts.append(thought)
-            weights.append(weight)
-        
-        if not available_thoughts:
-            # Если все мысли использованы сегодня, используем наименее использованные за неделю
-            for thought in self.KEY_THOUGHTS:
-                usage_count = recent_usage.get(thought, 0)
-                weight = 1.0 / (usage_count + 1)
-                available_thoughts.append(thought)
-                weights.append(weight)
-        
-        # Выбираем мысль с учетом весов
-        chosen = random.choices(available_thoughts, weights=weights, k=1)[0]
-        
-        # Обновляем историю использования
-        found = False
-        for item in used_details:
-            if item.get("thought", "") == chosen:
-                item["last_used"] = today
-                item["count"] = item.get("count", 0) + 1
-                found = True
-                break
-        
-        if not found:
-            used_details.append({
-                "thought": chosen,
-                "last_used": today,
-                "count": 1
-            })
-        
-        # Ограничиваем размер истории
-        if len(used_details) > 500:
-            # Удаляем наименее используемые мысли
-            used_details.sort(key=lambda x: (x.get("count", 0), x.get("last_used", "")))
-            used_details = used_details[-400:]
-        
-        self.post_history["used_key_thoughts_detailed"] = used_details
+    def create_telegram_prompt(self, theme: str, slot_style: Dict, text_format: str, image_description: str,
+                               picks: PickContext = None) -> str:
+        """Создает промпт для Telegram поста с вариативностью.
         
-        # Сохраняем также в старом формате для обратной совместимости
-        if "used_key_thoughts" not in self.post_history:
-            self.post_history["used_key_thoughts"] = []
-        
-        # Ограничиваем размер старого списка
-        if len(self.post_history["used_key_thoughts"]) >= 200:
-            self.post_history["used_key_thoughts"] = self.post_history["used_key_thoughts"][-100:]
-        
-        self.post_history["used_key_thoughts"].append(chosen)
-        self._save_json("post_history.json", self.post_history)
-        
-        return chosen
-    
-    # ========== ОБНОВЛЕННЫЕ ПРОМПТЫ ==========
-    def create_telegram_prompt(self, theme: str, slot_style: Dict, text_format: str, image_description: str) -> str:
-        """Создает промпт для Telegram поста с вариативностью"""
+        Если picks передан, использование элементов ротации фиксирует вызывающий
+        через picks.commit() для принятой попытки; иначе фиксируется сразу.
+        """
         emoji = slot_style['emoji']
+        commit_now = picks is None
+        picks = picks or self.new_pick_context()
         
         # Выбираем случайный шаблон структуры
         templates = [
@@ -1105,10 +2613,13 @@ class TelegramBot:
         prompt = template.format(
             theme=theme,
             emoji=emoji,
-            approach=self._get_fresh_approach(),
-            key_thought=self._get_fresh_key_thought(),
-            question=self._get_fresh_question()
+            approach=picks.get("approach"),
+            key_thought=picks.get("thought"),
+            question=picks.get("question")
         )
+        if commit_now:
+            picks.commit()
+        target_min, target_max = self.length_budget.target_chars(slot_style, 'telegram')
         
         prompt += f"""
 
@@ -1124,15 +2635,18 @@ class TelegramBot:
 9. БЛОК КЛЮЧЕВОЙ МЫСЛИ НЕ ДОЛЖЕН НАЧИНАТЬСЯ С ФРАЗ "КЛЮЧЕВАЯ МЫСЛЬ:", "КЛЮЧЕВАЯ МЫСЛЬ" ИЛИ "🎯 КЛЮЧЕВАЯ МЫСЛЬ:"
 
 ВАЖНО:
-- Длина поста: {slot_style['tg_chars'][0]}-{slot_style['tg_chars'][1]} символов
+- Длина поста: {target_min}-{target_max} символов
 - Не используй маркировку [1], [2], [3] в итоговом тексте
 - Если не хватает длины - сократи Блок 2, но сохрани все 5 блоков
 - Убедись, что все абзацы начинаются с заглавной буквы
 """
         return prompt.strip()
     
-    def create_zen_prompt(self, theme: str, slot_style: Dict, text_format: str, image_description: str) -> str:
-        """Создает промпт для Zen поста с вариативностью"""
+    def create_zen_prompt(self, theme: str, slot_style: Dict, text_format: str, image_description: str,
+                          picks: PickContext = None) -> str:
+        """Создает промпт для Zen поста с вариативностью (picks - как в create_telegram_prompt)"""
+        commit_now = picks is None
+        picks = picks or self.new_pick_context()
         
         # Выбираем случайный шаблон структуры
         templates = [
@@ -1187,10 +2701,13 @@ class TelegramBot:
         
         prompt = template.format(
             theme=theme,
-            approach=self._get_fresh_approach(),
-            key_thought=self._get_fresh_key_thought(),
-            question=self._get_fresh_question()
+            approach=picks.get("approach"),
+            key_thought=picks.get("thought"),
+            question=picks.get("question")
         )
+        if commit_now:
+            picks.commit()
+        target_min, target_max = self.length_budget.target_chars(slot_style, 'zen')
         
         prompt += f"""
 
@@ -1207,7 +2724,7 @@ class TelegramBot:
 10. БЛОК КЛЮЧЕВОЙ МЫСЛИ НЕ ДОЛЖЕН НАЧИНАТЬСЯ С ФРАЗ "КЛЮЧЕВАЯ МЫСЛЬ:", "КЛЮЧЕВАЯ МЫСЛЬ" ИЛИ "КЛЮЧЕВАЯ МЫСЛЬ:"
 
 ВАЖНО:
-- Длина поста: {slot_style['zen_chars'][0]}-{slot_style['zen_chars'][1]} символов
+- Длина поста: {target_min}-{target_max} символов
 - Не используй маркировку [1], [2], [3] в итоговом тексте
 - Сохраняй профессиональный тон без эмоциональных эмодзи
 - Если не хватает длины - сократи Блок 2, но сохрани все 5 блоков
@@ -1215,297 +2732,225 @@ class TelegramBot:
 """
         return prompt.strip()
     
-    def generate_with_gemini(self, prompt: str, post_type: str) -> Optional[str]:
-        """Генерация через Gemini API"""
+    def generate_with_gemini(self, prompt: str, post_type: str, deadline: Optional[float] = None,
+                             fresh: bool = False, slot_style: Dict = None,
+                             as_post: bool = False, theme: Optional[str] = None) -> Union[str, Post, None]:
+        """Генерация через Gemini API; fresh=True - не брать ответ из кэша, нужен новый вариант.
+        
+        as_post=True возвращает готовый Post: из JSON-ответа в structured-режиме
+        или после очистки и исправления структуры для свободного текста.
+        theme - тема поста для хештегов и заглушек (по умолчанию текущая тема слота).
+        """
         try:
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/gemma-3-27b-it:generateContent?key={GEMINI_API_KEY}"
-            
+            if deadline is None:
+                deadline = time.monotonic() + GEMINI_REQUEST_BUDGET
+            structured = self.gemini.structured_mode
+            if structured == "prompt":
+                prompt += Post.JSON_INSTRUCTION
+            budget_style = slot_style or self.current_style
+            if budget_style:
+                # Лимит по бюджету слота; JSON-обертке нужен небольшой запас токенов
+                max_tokens = self.length_budget.max_output_tokens(budget_style, post_type,
+                                                                  overhead=60 if structured else 0)
+            else:
+                max_tokens = 1000
             data = {
                 "contents": [{"parts": [{"text": prompt}]}],
                 "generationConfig": {
                     "temperature": 0.9,
                     "topP": 0.95,
                     "topK": 40,
-                    "maxOutputTokens": 1000,
+                    "maxOutputTokens": max_tokens,
                 }
             }
+            if structured == "schema":
+                data["generationConfig"]["responseMimeType"] = "application/json"
+                data["generationConfig"]["responseSchema"] = Post.JSON_SCHEMA
+            self.gemini.limit_thinking(data["generationConfig"])
+            
+            cache_key = self.gemini_cache.make_key(prompt, self.gemini.model, data["generationConfig"])
+            if not fresh:
+                cached_text = self.gemini_cache.get(cache_key)
+                if cached_text:
+                    response = self._build_response(cached_text, post_type, slot_style, structured, as_post, theme)
+                    # Уже принятый ранее текст из кэша повторно не отдаем
+                    rendered = response.render() if isinstance(response, Post) else response
+                    if not self._is_duplicate_text(rendered):
+                        logger.info(f"💾 {post_type.upper()} текст взят из кэша, длина: {len(cached_text)} символов")
+                        return response
+            
+            result = self.gemini.generate_content(data, deadline=deadline)
+            
+            if result and 'candidates' in result and result['candidates']:
+                candidate = result['candidates'][0]
+                generated_text = candidate['content']['parts'][0]['text']
+                logger.info(f"✅ {post_type.upper()} текст получен, длина: {len(generated_text)} символов")
+                output_tokens = result.get('usageMetadata', {}).get('candidatesTokenCount')
+                
+                if candidate.get('finishReason') == 'MAX_TOKENS':
+                    # Обрезанный ответ все равно не пройдет проверки; учитываем только символы на токен
+                    logger.warning(f"✂️ {post_type.upper()}: ответ уперся в лимит {max_tokens} токенов")
+                    if budget_style:
+                        self.length_budget.observe(budget_style, post_type, len(generated_text), output_tokens, None)
+                    return None
+                
+                self.gemini_cache.put(cache_key, generated_text)
+                response = self._build_response(generated_text, post_type, slot_style, structured, as_post, theme)
+                if budget_style and response:
+                    self.length_budget.observe(budget_style, post_type, len(generated_text), output_tokens,
+                                               len(response))
+                return response
             
-            response = session.post(url, json=data, timeout=60)
-            
-            if response.status_code == 200:
-                result = response.json()
-                if 'candidates' in result and result['candidates']:
-                    generated_text = result['candidates'][0]['content']['parts'][0]['text']
-                    logger.info(f"✅ {post_type.upper()} текст получен, длина: {len(generated_text)} символов")
-                    
-                    # Сразу очищаем метаданные
-                    cleaned_text = self._clean_metadata(generated_text, post_type)
-                    
-                    # Дополнительная обработка для исправления проблем
-                    cleaned_text = self._fix_post_issues(cleaned_text, post_type)
-                    
-                    return cleaned_text.strip()
-            
-            logger.error(f"❌ Ошибка API: {response.status_code}")
             return None
             
         except Exception as e:
             logger.error(f"💥 Ошибка генерации {post_type}: {e}")
             return None
     
-    def _fix_post_issues(self, text: str, post_type: str) -> str:
-        """Исправляет конкретные проблемы в посте"""
-        if not text:
-            return text
+    def _build_response(self, generated_text: str, post_type: str, slot_style: Optional[Dict],
+                        structured: Optional[str], as_post: bool, theme: Optional[str] = None) -> Union[str, Post]:
+        """Превращает сырой ответ модели в текст или Post"""
+        slot_style = slot_style or self.current_style
+        style = slot_style if post_type == 'telegram' else None
         
-        lines = [line.strip() for line in text.split('\n') if line.strip()]
-        if not lines:
-            return text
+        if structured:
+            post = Post.from_json(generated_text, post_type, style.get('emoji') if style else None)
+            if post:
+                # Блоки уже типизированы - эвристическое исправление структуры не нужно
+                return post if as_post else post.render()
+            logger.warning(f"⚠️ {post_type.upper()}: ответ не разобран как JSON, обрабатываю как текст")
         
-        # Исправление 1: Удаляем ** ** из Telegram постов
-        if post_type == 'telegram':
-            lines = [line.replace('**', '') for line in lines]
-        
-        # Исправление 2: Убеждаемся, что все абзацы начинаются с заглавной буквы
-        fixed_lines = []
-        for i, line in enumerate(lines):
-            if line and line[0].islower() and i > 0:  # Если строка начинается с маленькой буквы и не первая
-                # Проверяем, не хештег ли это
-                if not line.startswith('#'):
-                    line = line[0].upper() + line[1:] if len(line) > 1 else line
-            fixed_lines.append(line)
-        
-        # Исправление 3: Перемещаем хештеги в конец для Telegram
-        if post_type == 'telegram':
-            hashtag_lines = []
-            non_hashtag_lines = []
-            
-            for line in fixed_lines:
-                if line.startswith('#'):
-                    hashtag_lines.append(line)
-                else:
-                    non_hashtag_lines.append(line)
-            
-            # Собираем обратно, хештеги в конце
-            if hashtag_lines:
-                fixed_lines = non_hashtag_lines + [''] + hashtag_lines
-        
-        # Исправление 4: Убираем лишние пустые строки между хештегами
-        if post_type in ['telegram', 'zen']:
-            result_lines = []
-            in_hashtag_section = False
-            
-            for line in fixed_lines:
-                if line.startswith('#'):
-                    if not in_hashtag_section:
-                        in_hashtag_section = True
-                        # Добавляем пустую строку перед хештегами, если её нет
-                        if result_lines and result_lines[-1] != '':
-                            result_lines.append('')
-                    result_lines.append(line)
-                else:
-                    in_hashtag_section = False
-                    result_lines.append(line)
-            
-            fixed_lines = result_lines
-        
-        # Исправление 5: Удаляем фразы "Ключевая мысль:", "Ключевая мысль" и "🎯 Ключевая мысль:"
-        fixed_lines = []
-        for line in lines:
-            if line.startswith('Ключевая мысль:') or line.startswith('Ключевая мысль ') or line.startswith('🎯 Ключевая мысль:'):
-                # Удаляем префикс, оставляем только содержание
-                if line.startswith('Ключевая мысль:'):
-                    line = line.replace('Ключевая мысль:', '', 1).strip()
-                elif line.startswith('Ключевая мысль '):
-                    line = line.replace('Ключевая мысль ', '', 1).strip()
-                elif line.startswith('🎯 Ключевая мысль:'):
-                    line = line.replace('🎯 Ключевая мысль:', '', 1).strip()
-            fixed_lines.append(line)
-        
-        return '\n\n'.join(fixed_lines)  # Добавлена пустая строка между блоками
-    
-    def validate_post_structure(self, text: str, post_type: str, slot_style: Dict = None) -> Tuple[bool, str]:
+        cleaned_text = self._postprocess_generated(generated_text, post_type, theme)
+        if not as_post:
+            return cleaned_text
+        return self._repair_post(Post.parse(cleaned_text, post_type, style), style, theme)
+    
+    def _postprocess_generated(self, generated_text: str, post_type: str, theme: Optional[str] = None) -> str:
+        """Очистка сырого ответа модели"""
+        return self.text_pipeline.process(generated_text, post_type, theme or self.current_theme).strip()
+    
+    def validate_post_structure(self, text: str, post_type: str, slot_style: Dict = None,
+                                theme: Optional[str] = None) -> Tuple[bool, str]:
         """Проверка структуры поста на целостность - ОБНОВЛЕННАЯ ЛОГИКА"""
         if not text:
             return False, "Пустой текст"
-        
-        # Разделяем на блоки по двойным переносам строк
-        blocks = re.split(r'\n\s*\n', text.strip())
-        blocks = [block.strip() for block in blocks if block.strip()]
-        
+        return True, self._repair_post(Post.parse(text, post_type, slot_style), slot_style, theme).render()
+    
+    def check_post_complete(self, text: str, post_type: str, slot_style: Dict = None) -> bool:
+        """Проверка завершенности поста - КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ"""
+        if not text:
+            return False
+        return self._post_complete(Post.parse(text, post_type, slot_style), slot_style)
+    
+    def _default_block(self, kind: str, post_type: str, slot_style: Dict = None,
+                       theme: Optional[str] = None) -> PostBlock:
+        """Заглушка для недостающего блока"""
+        post_theme = theme or self.current_theme
+        theme = post_theme if post_theme else 'управления'
+        if kind == Post.HEADER:
+            if post_type == 'telegram' and slot_style and slot_style.get('emoji'):
+                text = f"{slot_style['emoji']} Важный вопрос по теме {theme}"
+            else:
+                text = f"Важный вопрос по теме {theme}?"
+        elif kind == Post.PARAGRAPH:
+            text = "Это важный момент, который требует внимания и обсуждения. Мы рассмотрим его детально."
+        elif kind == Post.KEY_THOUGHT:
+            text = "Важно понимать суть вопроса и действовать системно."
+            if post_type == 'telegram':
+                text = "🎯 " + text
+        elif kind == Post.QUESTION:
+            text = "Как вы решаете подобные задачи в своей практике?"
+        else:
+            text = PostTextPipeline.theme_hashtags(post_theme)
+        return PostBlock(kind, text)
+    
+    def _repair_post(self, post: Post, slot_style: Dict = None, theme: Optional[str] = None) -> Post:
+        """Приводит блоки поста к порядку заголовок - абзац - ключевая мысль - вопрос - хештеги"""
+        post_type = post.post_type
+        blocks = post.blocks
         logger.info(f"🔍 {post_type} пост: найдено {len(blocks)} блоков")
         
         # Должно быть минимум 5 блоков
         if len(blocks) < 5:
             logger.warning(f"❌ {post_type} пост: недостаточно блоков ({len(blocks)} из 5)")
             
-            # Определяем, какие блоки у нас есть
-            existing_block_types = []
-            for i, block in enumerate(blocks):
-                if post_type == 'telegram' and slot_style and slot_style.get('emoji') and block.startswith(slot_style['emoji']):
-                    existing_block_types.append('header')
-                elif post_type == 'telegram' and '🎯' in block:
-                    existing_block_types.append('key_thought')
-                elif block.endswith('?') and i == 0 and post_type == 'zen':
-                    existing_block_types.append('header')
-                elif block.endswith('?') and i != 0:
-                    existing_block_types.append('question')
-                elif block.startswith('#'):
-                    existing_block_types.append('hashtags')
-                else:
-                    existing_block_types.append('paragraph')
-            
-            # Создаем правильный порядок блоков
-            correct_blocks = []
-            required_order = ['header', 'paragraph', 'key_thought', 'question', 'hashtags']
-            
-            for required_type in required_order:
-                if required_type in existing_block_types:
-                    # Берем первый блок такого типа
-                    for i, block_type in enumerate(existing_block_types):
-                        if block_type == required_type:
-                            correct_blocks.append(blocks[i])
-                            # Удаляем использованный блок
-                            blocks.pop(i)
-                            existing_block_types.pop(i)
-                            break
+            # Первый блок каждого типа ставим на свое место, недостающие добавляем
+            remaining = list(blocks)
+            ordered = []
+            for kind in Post.ORDER:
+                block = next((block for block in remaining if block.kind == kind), None)
+                if block:
+                    remaining.remove(block)
+                    ordered.append(block)
                 else:
-                    # Добавляем недостающий блок
-                    if required_type == 'header':
-                        if post_type == 'telegram' and slot_style and slot_style.get('emoji'):
-                            correct_blocks.append(f"{slot_style['emoji']} Важный вопрос по теме {self.current_theme if self.current_theme else 'управления'}")
-                        else:
-                            correct_blocks.append(f"Важный вопрос по теме {self.current_theme if self.current_theme else 'управления'}?")
-                    elif required_type == 'paragraph':
-                        correct_blocks.append("Это важный момент, который требует внимания и обсуждения. Мы рассмотрим его детально.")
-                    elif required_type == 'key_thought':
-                        if post_type == 'telegram':
-                            correct_blocks.append("🎯 Важно понимать суть вопроса и действовать системно.")
-                        else:
-                            correct_blocks.append("Важно понимать суть вопроса и действовать системно.")
-                    elif required_type == 'question':
-                        correct_blocks.append("Как вы решаете подобные задачи в своей практике?")
-                    elif required_type == 'hashtags':
-                        if self.current_theme:
-                            theme_words = [word.strip() for word in self.current_theme.split() if len(word.strip()) > 2]
-                            if theme_words:
-                                hashtags = '#' + ' #'.join([re.sub(r'[^\w]', '', word.lower()) for word in theme_words[:3]])
-                            else:
-                                hashtags = "#управление #практика #результат"
-                        else:
-                            hashtags = "#управление #практика #результат"
-                        correct_blocks.append(hashtags)
-            
-            # Добавляем оставшиеся блоки в конец
-            if blocks:
-                correct_blocks.extend(blocks)
-            
-            fixed_text = '\n\n'.join(correct_blocks)
-            logger.info(f"✅ {post_type} пост: блоки упорядочены, теперь {len(correct_blocks)} блоков")
-            return True, fixed_text
-        
-        # Если блоков 5 или больше, проверяем их порядок
-        # Определяем типы блоков
-        block_types = []
-        for i, block in enumerate(blocks):
-            if post_type == 'telegram' and slot_style and slot_style.get('emoji') and block.startswith(slot_style['emoji']):
-                block_types.append('header')
-            elif post_type == 'telegram' and '🎯' in block:
-                block_types.append('key_thought')
-            elif block.endswith('?') and i == 0 and post_type == 'zen':
-                block_types.append('header')
-            elif block.endswith('?') and i != 0:
-                block_types.append('question')
-            elif block.startswith('#'):
-                block_types.append('hashtags')
-            else:
-                block_types.append('paragraph')
+                    ordered.append(self._default_block(kind, post_type, slot_style, theme))
+            
+            # Оставшиеся блоки - в конец
+            post.blocks = ordered + remaining
+            logger.info(f"✅ {post_type} пост: блоки упорядочены, теперь {len(post.blocks)} блоков")
+            return post
         
-        # Проверяем порядок
-        expected_order = ['header', 'paragraph', 'key_thought', 'question', 'hashtags']
         issues = []
         
-        # Проверяем, что хештеги последние
-        if 'hashtags' in block_types:
-            hashtag_index = block_types.index('hashtags')
-            if hashtag_index != len(block_types) - 1:
-                # Перемещаем хештеги в конец
-                hashtag_block = blocks.pop(hashtag_index)
-                blocks.append(hashtag_block)
-                block_types.pop(hashtag_index)
-                block_types.append('hashtags')
-                issues.append("хештеги перемещены в конец")
-        
-        # Проверяем, что заголовок первый
-        if 'header' in block_types:
-            header_index = block_types.index('header')
-            if header_index != 0:
-                header_block = blocks.pop(header_index)
-                blocks.insert(0, header_block)
-                block_types.pop(header_index)
-                block_types.insert(0, 'header')
-                issues.append("заголовок перемещен в начало")
-        
-        # Проверяем ключевую мысль для Telegram
-        if post_type == 'telegram' and 'key_thought' in block_types:
-            key_thought_index = block_types.index('key_thought')
-            # Должна быть после параграфа и перед вопросом
-            if key_thought_index < 1 or key_thought_index > 3:
-                # Ищем правильное место
-                if 'paragraph' in block_types:
-                    para_index = block_types.index('paragraph')
-                    if para_index < len(block_types) - 1:
-                        key_thought_block = blocks.pop(key_thought_index)
-                        blocks.insert(para_index + 1, key_thought_block)
-                        block_types.pop(key_thought_index)
-                        block_types.insert(para_index + 1, 'key_thought')
-                        issues.append("ключевая мысль перемещена после параграфа")
-        
-        # Проверяем вопросы
-        question_indices = [i for i, t in enumerate(block_types) if t == 'question']
-        if question_indices:
-            # Оставляем только последний вопрос перед хештегами
-            if len(question_indices) > 1:
-                # Удаляем лишние вопросы
-                for i in range(len(question_indices) - 1):
-                    idx = question_indices[i] - i
-                    blocks.pop(idx)
-                    block_types.pop(idx)
+        # Хештеги последние
+        hashtag_index = post.index_of(Post.HASHTAGS)
+        if hashtag_index != -1 and hashtag_index != len(blocks) - 1:
+            blocks.append(blocks.pop(hashtag_index))
+            issues.append("хештеги перемещены в конец")
+        
+        # Заголовок первый
+        header_index = post.index_of(Post.HEADER)
+        if header_index > 0:
+            blocks.insert(0, blocks.pop(header_index))
+            issues.append("заголовок перемещен в начало")
+        
+        # Ключевая мысль для Telegram - после параграфа и перед вопросом
+        if post_type == 'telegram':
+            key_thought_index = post.index_of(Post.KEY_THOUGHT)
+            if key_thought_index != -1 and (key_thought_index < 1 or key_thought_index > 3):
+                para_index = post.index_of(Post.PARAGRAPH)
+                if para_index != -1 and para_index < len(blocks) - 1:
+                    blocks.insert(para_index + 1, blocks.pop(key_thought_index))
+                    issues.append("ключевая мысль перемещена после параграфа")
+        
+        # Вопросы: оставляем только последний, и он стоит перед хештегами
+        question_index = post.index_of(Post.QUESTION, last=True)
+        if question_index != -1:
+            if post.index_of(Post.QUESTION) != question_index:
+                question = blocks[question_index]
+                blocks[:] = [block for block in blocks if block.kind != Post.QUESTION or block is question]
+                question_index = blocks.index(question)
                 issues.append("удалены лишние вопросы")
             
-            # Проверяем, что вопрос перед хештегами
-            last_question_idx = [i for i, t in enumerate(block_types) if t == 'question'][-1]
-            hashtag_idx = [i for i, t in enumerate(block_types) if t == 'hashtags'][-1] if 'hashtags' in block_types else len(block_types)
-            
-            if last_question_idx != hashtag_idx - 1:
-                # Перемещаем вопрос перед хештегами
-                question_block = blocks.pop(last_question_idx)
-                blocks.insert(hashtag_idx - 1 if hashtag_idx > 0 else len(blocks) - 1, question_block)
-                block_types.pop(last_question_idx)
-                block_types.insert(hashtag_idx - 1 if hashtag_idx > 0 else len(block_types) - 1, 'question')
+            hashtag_index = post.index_of(Post.HASHTAGS, last=True)
+            if hashtag_index == -1:
+                hashtag_index = len(blocks)
+            if question_index != hashtag_index - 1:
+                question = blocks.pop(question_index)
+                hashtag_index = post.index_of(Post.HASHTAGS, last=True)
+                blocks.insert(hashtag_index if hashtag_index != -1 else len(blocks), question)
                 issues.append("вопрос перемещен перед хештегами")
         
-        # Проверяем, что второй блок начинается с заглавной буквы
+        # Второй блок начинается с заглавной буквы
         if len(blocks) > 1:
             second_block = blocks[1]
-            if second_block and second_block[0].islower():
-                blocks[1] = second_block[0].upper() + second_block[1:] if len(second_block) > 1 else second_block
+            if second_block.text and second_block.text[0].islower():
+                second_block.text = second_block.text[0].upper() + second_block.text[1:]
                 issues.append("второй блок исправлен на заглавную букву")
         
         if issues:
             logger.info(f"✅ {post_type} пост: исправления - {', '.join(issues)}")
         
-        fixed_text = '\n\n'.join(blocks[:5])  # Берем только первые 5 блоков
-        return True, fixed_text
+        del blocks[5:]  # Берем только первые 5 блоков
+        return post
     
-    def check_post_complete(self, text: str, post_type: str, slot_style: Dict = None) -> bool:
-        """Проверка завершенности поста - КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ"""
-        if not text:
-            return False
-        
-        text_length = len(text)
+    def _post_complete(self, post: Post, slot_style: Dict = None) -> bool:
+        """Проверка длины и обязательных элементов разобранного поста"""
+        text_length = len(post)
+        lines = post.lines()
+        body_lines = post.body_lines()
         
-        if post_type == 'telegram':
+        if post.post_type == 'telegram':
             if not slot_style:
                 return False
             
@@ -1520,10 +2965,8 @@ class TelegramBot:
                 logger.warning(f"⚠️ Telegram пост слишком длинный: {text_length} (максимум {tg_max * 1.2})")
                 return False
             
-            lines = [line.strip() for line in text.split('\n') if line.strip()]
-            
             # Проверяем наличие ключевых элементов
-            if slot_style and 'emoji' in slot_style:
+            if 'emoji' in slot_style:
                 emoji_found = any(line.startswith(slot_style['emoji']) for line in lines)
                 if not emoji_found:
                     logger.warning(f"⚠️ Telegram пост не содержит эмодзи {slot_style['emoji']}")
@@ -1534,34 +2977,28 @@ class TelegramBot:
                 logger.warning(f"⚠️ Telegram пост не содержит ключевой мысли с 🎯")
                 return False
             
-            question_found = any('?' in line and not line.startswith('#') for line in lines)
-            if not question_found:
+            question_lines = [line for line in body_lines if '?' in line]
+            if not question_lines:
                 logger.warning(f"⚠️ Telegram пост не содержит вопроса!")
                 return False
             
             # Проверяем завершенность вопроса
-            for line in lines:
-                if '?' in line and not line.startswith('#'):
-                    if not line.strip().endswith('?'):
-                        logger.warning(f"❌ Telegram пост: вопрос не заканчивается знаком ?")
-                        return False
-            
-            hashtag_found = any(line.startswith('#') for line in lines)
-            if not hashtag_found:
+            if any(not line.endswith('?') for line in question_lines):
+                logger.warning(f"❌ Telegram пост: вопрос не заканчивается знаком ?")
+                return False
+            
+            if not post.has(Post.HASHTAGS):
                 logger.warning(f"⚠️ Telegram пост не содержит хештегов!")
                 return False
             
             # Проверяем, что хештеги в конце
-            hashtag_indices = [i for i, line in enumerate(lines) if line.startswith('#')]
-            if hashtag_indices:
-                last_hashtag_index = max(hashtag_indices)
-                if last_hashtag_index != len(lines) - 1:
-                    logger.warning(f"⚠️ Telegram пост: хештеги не в конце!")
-                    return False
+            if post.blocks[-1].kind != Post.HASHTAGS:
+                logger.warning(f"⚠️ Telegram пост: хештеги не в конце!")
+                return False
             
             return True
         
-        elif post_type == 'zen':
+        elif post.post_type == 'zen':
             if not slot_style:
                 zen_min, zen_max = 600, 800
             else:
@@ -1576,95 +3013,243 @@ class TelegramBot:
                 logger.warning(f"⚠️ Zen пост слишком длинный: {text_length} (максимум {zen_max * 1.3})")
                 return False
             
-            lines = [line.strip() for line in text.split('\n') if line.strip()]
-            
             if len(lines) < 3:
                 logger.warning(f"❌ Zen пост: недостаточно строк ({len(lines)})")
                 return False
             
-            question_found = any('?' in line and not line.startswith('#') for line in lines)
-            if not question_found:
+            question_lines = [line for line in body_lines if '?' in line]
+            if not question_lines:
                 logger.warning("❌ Zen пост: нет вопросов")
                 return False
             
             # Проверяем завершенность вопроса
-            for line in lines:
-                if '?' in line and not line.startswith('#'):
-                    if not line.strip().endswith('?'):
-                        logger.warning(f"❌ Zen пост: вопрос не заканчивается знаком ?")
-                        return False
-            
-            hashtag_found = any(line.startswith('#') for line in lines)
-            if not hashtag_found:
+            if any(not line.endswith('?') for line in question_lines):
+                logger.warning(f"❌ Zen пост: вопрос не заканчивается знаком ?")
+                return False
+            
+            if not post.has(Post.HASHTAGS):
                 logger.warning("❌ Zen пост: нет хештегов")
                 return False
             
             # Проверяем, что второй абзац начинается с заглавной буквы
-            if len(lines) > 1:
-                # Ищем второй не-хештег блок
-                non_hashtag_lines = [line for line in lines if not line.startswith('#')]
-                if len(non_hashtag_lines) > 1:
-                    second_line = non_hashtag_lines[1]
-                    if second_line and second_line[0].islower():
-                        logger.warning("❌ Zen пост: второй абзац начинается с маленькой буквы")
-                        return False
+            if len(body_lines) > 1 and body_lines[1][0].islower():
+                logger.warning("❌ Zen пост: второй абзац начинается с маленькой буквы")
+                return False
             
             return True
         
         return False
     
     def generate_with_retry(self, theme: str, slot_style: Dict, text_format: str, image_description: str,
-                           max_attempts: int = 3) -> Tuple[Optional[str], Optional[str]]:
-        """Генерация постов с повторными попытками - КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ"""
-        tg_min, tg_max = slot_style['tg_chars']
-        zen_min, zen_max = slot_style['zen_chars']
+                           max_attempts: int = 3,
+                           picks_out: Optional[Dict[str, Dict]] = None,
+                           record_picks: bool = True) -> Tuple[Optional[str], Optional[str]]:
+        """Генерация постов с повторными попытками - Telegram и Дзен параллельно.
+        
+        В picks_out (если передан) записываются элементы ротации, использованные в принятых постах;
+        record_picks=False - не учитывать их в ротации сейчас (для черновиков).
+        """
+        if picks_out is None:
+            picks_out = {}
+        deadline = time.monotonic() + GENERATION_BUDGET
+        cancel_event = threading.Event()
+        results: Dict[str, Optional[str]] = {'telegram': None, 'zen': None}
+        
+        if GEMINI_COMBINED:
+            results.update(self._generate_combined(theme, slot_style, text_format, image_description, deadline,
+                                                   picks_out, record_picks))
+            if results['telegram'] and results['zen']:
+                return results['telegram'], results['zen']
+            missing = [post_type for post_type, text in results.items() if not text]
+            logger.info(f"🔁 Общий запрос: перегенерирую отдельно {', '.join(missing)}")
+        
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="generate")
+        futures = {
+            executor.submit(self._generate_post_with_retry, post_type, theme, slot_style, text_format,
+                            image_description, max_attempts, deadline, cancel_event, picks_out,
+                            record_picks): post_type
+            for post_type in ('telegram', 'zen') if not results[post_type]
+        }
+        
+        try:
+            pending = set(futures)
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.warning(f"⏰ Бюджет генерации {GENERATION_BUDGET} сек исчерпан, останавливаю генерацию")
+                    break
+                
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    post_type = futures[future]
+                    try:
+                        results[post_type] = future.result()
+                    except Exception as e:
+                        logger.error(f"💥 Ошибка генерации {post_type}: {e}")
+                    
+                    # Без Telegram поста слот не отправляется, Дзен можно не дожидаться
+                    if post_type == 'telegram' and not results['telegram']:
+                        pending = set()
+        finally:
+            cancel_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        if not results['telegram']:
+            logger.error("❌ Не удалось сгенерировать Telegram пост после всех попыток")
+            return None, None
+        
+        return results['telegram'], results['zen']
+    
+    COMBINED_SPLIT_RE = re.compile(r'={3}\s*TELEGRAM\s*={3}(.*?)={3}\s*(?:ZEN|ДЗЕН)\s*={3}(.*)',
+                                   re.DOTALL | re.IGNORECASE)
+    
+    def _generate_combined(self, theme: str, slot_style: Dict, text_format: str, image_description: str,
+                           deadline: float, picks_out: Dict[str, Dict],
+                           record_picks: bool = True) -> Dict[str, Optional[str]]:
+        """Один запрос на оба варианта поста; каждая половина проверяется отдельно.
+        
+        Возвращает принятые тексты по типам, None - для половины, которую нужно перегенерировать.
+        """
+        results: Dict[str, Optional[str]] = {'telegram': None, 'zen': None}
+        picks = {post_type: self.new_pick_context(record_picks) for post_type in results}
+        structured = self.gemini.structured_mode
+        
+        prompt = f"""Нужны два варианта поста на одну тему: для Telegram и для Дзен. Требования к каждому - в своем разделе.
+
+=== ЗАДАНИЕ 1: TELEGRAM ===
+{self.create_telegram_prompt(theme, slot_style, text_format, image_description, picks['telegram'])}
+
+=== ЗАДАНИЕ 2: ДЗЕН ===
+{self.create_zen_prompt(theme, slot_style, text_format, image_description, picks['zen'])}"""
+        if structured:
+            prompt += ("\n\nФОРМАТ ОТВЕТА: верни только JSON-объект с двумя постами, без пояснений и без markdown:\n"
+                       f'{{"telegram": {Post.JSON_EXAMPLE}, "zen": {Post.JSON_EXAMPLE}}}')
+        else:
+            prompt += ("\n\nФОРМАТ ОТВЕТА: строка ===TELEGRAM===, затем пост для Telegram; "
+                       "после него строка ===ZEN===, затем пост для Дзен. Больше ничего не пиши.")
+        
+        overhead = 60 if structured else 0
+        data = {
+            "contents": [{"parts": [{"text": prompt}]}],
+            "generationConfig": {
+                "temperature": 0.9,
+                "topP": 0.95,
+                "topK": 40,
+                "maxOutputTokens": sum(self.length_budget.max_output_tokens(slot_style, post_type, overhead)
+                                       for post_type in results),
+            }
+        }
+        if structured == "schema":
+            data["generationConfig"]["responseMimeType"] = "application/json"
+            data["generationConfig"]["responseSchema"] = {
+                "type": "OBJECT",
+                "properties": {"telegram": Post.JSON_SCHEMA, "zen": Post.JSON_SCHEMA},
+                "required": ["telegram", "zen"],
+            }
+        self.gemini.limit_thinking(data["generationConfig"])
+        
+        logger.info("🤖 Генерация Telegram и Zen постов одним запросом...")
+        try:
+            result = self.gemini.generate_content(data, deadline=deadline)
+            if not (result and result.get('candidates')):
+                return results
+            candidate = result['candidates'][0]
+            generated_text = candidate['content']['parts'][0]['text']
+        except Exception as e:
+            logger.error(f"💥 Ошибка общего запроса: {e}")
+            return results
+        
+        if candidate.get('finishReason') == 'MAX_TOKENS':
+            logger.warning("✂️ Общий запрос уперся в лимит токенов")
+            return results
+        
+        output_tokens = result.get('usageMetadata', {}).get('candidatesTokenCount')
+        for post_type, post in self._split_combined(generated_text, slot_style, structured, theme).items():
+            if post:
+                self.length_budget.observe(slot_style, post_type, len(generated_text), output_tokens, len(post))
+            accepted = self._accept_candidate(post, post_type, slot_style)
+            if accepted:
+                picks[post_type].commit()
+                picks_out[post_type] = dict(picks[post_type].picks)
+                self._add_to_generated_texts(accepted)
+                results[post_type] = accepted
+                logger.info(f"✅ {post_type.upper()} из общего запроса принят, {len(accepted)} символов")
+        return results
+    
+    def _split_combined(self, generated_text: str, slot_style: Dict, structured: Optional[str],
+                        theme: Optional[str] = None) -> Dict[str, Optional[Post]]:
+        """Разбирает ответ общего запроса на два поста"""
+        emoji = slot_style.get('emoji')
+        if structured:
+            data = Post.extract_json(generated_text) or {}
+            posts = {'telegram': Post.from_dict(data.get('telegram'), 'telegram', emoji),
+                     'zen': Post.from_dict(data.get('zen'), 'zen')}
+            if posts['telegram'] or posts['zen']:
+                return posts
+            logger.warning("⚠️ Общий запрос: ответ не разобран как JSON, пробую разделители")
+        
+        match = self.COMBINED_SPLIT_RE.search(generated_text)
+        if not match:
+            logger.warning("⚠️ Общий запрос: не удалось разделить ответ на Telegram и Zen")
+            return {'telegram': None, 'zen': None}
+        return {post_type: self._build_response(part, post_type, slot_style, None, True, theme) if part.strip() else None
+                for post_type, part in (('telegram', match.group(1)), ('zen', match.group(2)))}
+    
+    def _generate_post_with_retry(self, post_type: str, theme: str, slot_style: Dict, text_format: str,
+                                  image_description: str, max_attempts: int, deadline: float,
+                                  cancel_event: threading.Event,
+                                  picks_out: Optional[Dict[str, Dict]] = None,
+                                  record_picks: bool = True) -> Optional[str]:
+        """Генерация одного поста с повторными попытками в пределах общего бюджета"""
+        label = 'Telegram' if post_type == 'telegram' else 'Zen'
+        total_attempts = max_attempts * 2  # Увеличиваем количество попыток
         
-        tg_text = None
-        zen_text = None
+        def stopped() -> bool:
+            return cancel_event.is_set() or time.monotonic() >= deadline
         
-        # Генерируем Telegram пост с БОЛЬШИМ лимитом попыток
-        logger.info("🤖 Генерация Telegram поста...")
-        for attempt in range(max_attempts * 2):  # Увеличиваем количество попыток
-            logger.info(f"🤖 Telegram попытка {attempt+1}/{max_attempts * 2}")
-            
-            tg_prompt = self.create_telegram_prompt(theme, slot_style, text_format, image_description)
-            generated_tg = self.generate_with_gemini(tg_prompt, 'telegram')
+        logger.info(f"🤖 Генерация {label} поста...")
+        for attempt in range(total_attempts):
+            if stopped():
+                logger.warning(f"⏹️ {label}: генерация остановлена (бюджет исчерпан или отменена)")
+                return None
             
-            if generated_tg:
-                valid, fixed_tg = self.validate_post_structure(generated_tg, 'telegram', slot_style)
-                
-                if valid:
-                    if self._is_duplicate_text(fixed_tg):
-                        logger.warning(f"⚠️ Telegram пост - дубликат обнаружен, пытаюсь снова...")
-                        time.sleep(0.5)
-                        continue
-                    
-                    tg_length = len(fixed_tg)
-                    is_complete = self.check_post_complete(fixed_tg, 'telegram', slot_style)
-                    
-                    # Более мягкая проверка завершенности
-                    if is_complete:
-                        # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА: пост не должен быть обрезан
-                        if self._is_post_truncated(fixed_tg):
-                            logger.warning(f"⚠️ Telegram пост обрезан, пробую снова...")
-                            time.sleep(0.5)
-                            continue
-                        
-                        self._add_to_generated_texts(fixed_tg)
-                        tg_text = fixed_tg
-                        logger.info(f"✅ Telegram успех! {tg_length} символов")
-                        break
-                    else:
-                        logger.warning(f"⚠️ Telegram не прошел проверку завершенности, пробую снова...")
+            logger.info(f"🤖 {label} попытка {attempt+1}/{total_attempts}"
+                        + (f" ({GEMINI_CANDIDATES} кандидатов)" if GEMINI_CANDIDATES > 1 else ""))
             
-            if attempt < (max_attempts * 2) - 1:
-                time.sleep(0.5)
+            prompts = []
+            contexts = [self.new_pick_context(record_picks) for _ in range(GEMINI_CANDIDATES)]
+            for picks in contexts:
+                if post_type == 'telegram':
+                    prompts.append(self.create_telegram_prompt(theme, slot_style, text_format, image_description, picks))
+                else:
+                    prompts.append(self.create_zen_prompt(theme, slot_style, text_format, image_description, picks))
+            
+            # Первый кандидат, прошедший все проверки, побеждает; ротацию учитываем только для него
+            for index, generated in self._generate_candidates(prompts, post_type, slot_style, cancel_event, deadline,
+                                                              theme):
+                # Запрос мог завершиться уже после отмены или дедлайна - такой результат не принимаем
+                if stopped():
+                    logger.warning(f"⏹️ {label}: кандидат готов после остановки генерации, отбрасываю")
+                    return None
+                accepted = self._accept_candidate(generated, post_type, slot_style)
+                if accepted:
+                    contexts[index].commit()
+                    if picks_out is not None:
+                        picks_out[post_type] = dict(contexts[index].picks)
+                    self._add_to_generated_texts(accepted)
+                    logger.info(f"✅ {label} успех! {len(accepted)} символов")
+                    return accepted
+            
+            if attempt < total_attempts - 1:
+                cancel_event.wait(0.5)
         
-        if not tg_text:
-            logger.error("❌ Не удалось сгенерировать Telegram пост после всех попыток")
-            # Последняя попытка с упрощенным промптом
-            logger.info("🔄 Последняя попытка Telegram с упрощенным промптом...")
-            simple_prompt = f"""Создай Telegram пост на тему "{theme}" в формате:
+        if stopped():
+            return None
+        
+        # Последняя попытка с упрощенным промптом
+        logger.info(f"🔄 Fallback-генерация {label} поста...")
+        if post_type == 'telegram':
+            fallback_prompt = f"""Создай Telegram пост на тему "{theme}" в формате:
 {slot_style['emoji']} Заголовок-вопрос
 Абзац с развитием мысли (2-3 предложения)
 🎯 Ключевая мысль (1 предложение)
@@ -1672,58 +3257,7 @@ class TelegramBot:
 #хештег1 #хештег2 #хештег3
 
 Убедись, что все предложения завершены и пост готов к публикации."""
-            
-            generated_simple = self.generate_with_gemini(simple_prompt, 'telegram')
-            if generated_simple:
-                valid, fixed_simple = self.validate_post_structure(generated_simple, 'telegram', slot_style)
-                if valid:
-                    tg_text = fixed_simple
-                    logger.info(f"✅ Telegram успех через упрощенный промпт! {len(tg_text)} символов")
-        
-        if not tg_text:
-            return None, None
-        
-        # Генерируем Zen пост
-        logger.info("🤖 Генерация Zen поста...")
-        
-        for attempt in range(max_attempts * 2):
-            logger.info(f"🤖 Zen попытка {attempt+1}/{max_attempts * 2}")
-            
-            zen_prompt = self.create_zen_prompt(theme, slot_style, text_format, image_description)
-            generated_zen = self.generate_with_gemini(zen_prompt, 'zen')
-            
-            if generated_zen:
-                valid, fixed_zen = self.validate_post_structure(generated_zen, 'zen')
-                
-                if valid:
-                    if self._is_duplicate_text(fixed_zen):
-                        logger.warning(f"⚠️ Zen пост - дубликат обнаружен, пытаюсь снова...")
-                        time.sleep(0.5)
-                        continue
-                    
-                    zen_length = len(fixed_zen)
-                    is_complete = self.check_post_complete(fixed_zen, 'zen', slot_style)
-                    
-                    if is_complete:
-                        # ДОПОЛНИТЕЛЬНАЯ ПРОВерКА: пост не должен быть обрезан
-                        if self._is_post_truncated(fixed_zen):
-                            logger.warning(f"⚠️ Zen пост обрезан, пробую снова...")
-                            time.sleep(0.5)
-                            continue
-                        
-                        self._add_to_generated_texts(fixed_zen)
-                        zen_text = fixed_zen
-                        logger.info(f"✅ Zen успех! {zen_length} символов")
-                        break
-                    else:
-                        logger.warning(f"⚠️ Zen не прошел проверку завершенности, пробую снова...")
-            
-            if attempt < (max_attempts * 2) - 1:
-                time.sleep(0.5)
-        
-        # Fallback-генерация для Zen если все еще None
-        if not zen_text:
-            logger.info("🔄 Fallback-генерация Zen поста...")
+        else:
             fallback_prompt = f"""Создай пост для Дзен на тему "{theme}" в формате:
 Заголовок-вопрос (заканчивается ?)
 Абзац с развитием мысли (2-3 предложения) - НАЧИНАЙ С ЗАГЛАВНОЙ БУКВЫ
@@ -1732,29 +3266,77 @@ class TelegramBot:
 #хештег1 #хештег2 #хештег3
 
 КРИТИЧЕСКО ВАЖНО: Все предложения должны быть завершены точками или другими знаками препинания. Пост должен быть ПОЛНЫМ и готовым к публикации."""
-            
-            generated_fallback = self.generate_with_gemini(fallback_prompt, 'zen')
-            
-            if generated_fallback:
-                valid, fixed_fallback = self.validate_post_structure(generated_fallback, 'zen')
-                if valid:
-                    zen_text = fixed_fallback
-                    logger.info(f"✅ Fallback Zen успех! {len(zen_text)} символов")
         
-        return tg_text, zen_text
+        # Промпт fallback детерминирован - из кэша вернулся бы уже опубликованный текст
+        generated_fallback = self.generate_with_gemini(fallback_prompt, post_type, deadline, fresh=True,
+                                                       slot_style=slot_style, theme=theme)
+        if generated_fallback and not stopped():
+            valid, fixed_fallback = self.validate_post_structure(generated_fallback, post_type,
+                                                                 slot_style if post_type == 'telegram' else None,
+                                                                 theme)
+            if valid and not self._is_duplicate_text(fixed_fallback):
+                self._add_to_generated_texts(fixed_fallback)
+                logger.info(f"✅ Fallback {label} успех! {len(fixed_fallback)} символов")
+                return fixed_fallback
+        
+        return None
+    
+    def _generate_candidates(self, prompts: List[str], post_type: str, slot_style: Dict,
+                             cancel_event: threading.Event, deadline: Optional[float] = None,
+                             theme: Optional[str] = None) -> Iterator[Tuple[int, Optional[Post]]]:
+        """Отправляет промпты в Gemini параллельно и отдает (индекс промпта, пост) по мере готовности"""
+        def generate(prompt: str) -> Optional[Post]:
+            return self.generate_with_gemini(prompt, post_type, deadline, slot_style=slot_style, as_post=True,
+                                             theme=theme)
+        
+        if len(prompts) == 1:
+            yield 0, generate(prompts[0])
+            return
+        
+        executor = ThreadPoolExecutor(max_workers=len(prompts), thread_name_prefix=f"{post_type}-candidate")
+        try:
+            futures = {executor.submit(generate, prompt): index
+                       for index, prompt in enumerate(prompts)}
+            for future in as_completed(futures):
+                if cancel_event.is_set():
+                    return
+                yield futures[future], future.result()
+        finally:
+            # Оставшиеся кандидаты больше не нужны
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    def _accept_candidate(self, post: Optional[Post], post_type: str, slot_style: Dict) -> Optional[str]:
+        """Прогоняет разобранного кандидата через цепочку проверок, возвращает текст поста или None"""
+        label = 'Telegram' if post_type == 'telegram' else 'Zen'
+        if not post or not post.blocks:
+            return None
+        
+        fixed = post.render()
+        
+        if self._is_duplicate_text(fixed):
+            logger.warning(f"⚠️ {label} пост - дубликат обнаружен, пытаюсь снова...")
+            return None
+        
+        if not self._post_complete(post, slot_style):
+            logger.warning(f"⚠️ {label} не прошел проверку завершенности, пробую снова...")
+            return None
+        
+        # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА: пост не должен быть обрезан
+        if self._post_truncated(post):
+            logger.warning(f"⚠️ {label} пост обрезан, пробую снова...")
+            return None
+        
+        return fixed
     
     def _is_post_truncated(self, text: str) -> bool:
         """Проверяет, обрезан ли пост посередине предложения"""
         if not text:
             return False
-        
-        lines = [line.strip() for line in text.split('\n') if line.strip()]
-        
-        if not lines:
-            return False
-        
+        return self._post_truncated(Post.parse(text, 'zen'))
+    
+    def _post_truncated(self, post: Post) -> bool:
         # Ищем последнюю не-хештег строку
-        non_hashtag_lines = [line for line in lines if not line.startswith('#')]
+        non_hashtag_lines = post.body_lines()
         
         if not non_hashtag_lines:
             return False
@@ -1785,21 +3367,28 @@ class TelegramBot:
         """Перегенерирует один пост"""
         try:
             logger.info(f"🔄 Перегенерация {post_type} поста...")
+            deadline = time.monotonic() + CALLBACK_GENERATION_BUDGET
             
             for attempt in range(5):  # Увеличиваем количество попыток
+                if time.monotonic() >= deadline:
+                    logger.warning(f"⏰ Бюджет перегенерации {CALLBACK_GENERATION_BUDGET} сек исчерпан")
+                    break
+                picks = self.new_pick_context()
                 if post_type == 'telegram':
-                    prompt = self.create_telegram_prompt(theme, slot_style, "разбор ситуации", image_description)
+                    prompt = self.create_telegram_prompt(theme, slot_style, "разбор ситуации", image_description, picks)
                 else:
-                    prompt = self.create_zen_prompt(theme, slot_style, "разбор ситуации", image_description)
+                    prompt = self.create_zen_prompt(theme, slot_style, "разбор ситуации", image_description, picks)
                 
-                generated_text = self.generate_with_gemini(prompt, post_type)
+                generated_text = self.generate_with_gemini(prompt, post_type, deadline, fresh=True, slot_style=slot_style,
+                                                           theme=theme)
                 
                 if generated_text:
-                    valid, fixed_text = self.validate_post_structure(generated_text, post_type, slot_style if post_type == 'telegram' else None)
+                    valid, fixed_text = self.validate_post_structure(generated_text, post_type, slot_style if post_type == 'telegram' else None, theme)
                     if valid:
                         if not self._is_duplicate_text(fixed_text):
                             is_complete = self.check_post_complete(fixed_text, post_type, slot_style if post_type == 'telegram' else None)
                             if is_complete:
+                                picks.commit()
                                 self._add_to_generated_texts(fixed_text)
                                 logger.info(f"✅ {post_type} перегенерация успешна!")
                                 return fixed_text
@@ -1808,7 +3397,7 @@ class TelegramBot:
                             time.sleep(0.5)
                             continue
             
-            logger.error(f"❌ Не удалось перегенерировать {post_type} пост после 5 попыток")
+            logger.error(f"❌ Не удалось перегенерировать {post_type} пост")
             return None
             
         except Exception as e:
@@ -1816,8 +3405,13 @@ class TelegramBot:
             return None
     
     # ========== ОСТАЛЬНЫЕ МЕТОДЫ ==========
-    def get_post_image_and_description(self, theme: str) -> Tuple[Optional[str], str]:
-        """Находит подходящую картинку с улучшенной системой ротации"""
+    def get_post_image_and_description(self, theme: str, record: bool = True,
+                                       usage_out: Optional[Dict] = None) -> Tuple[Optional[str], str]:
+        """Находит подходящую картинку с улучшенной системой ротации.
+        
+        record=False - использование картинки не учитывается сразу (черновик); что учесть потом,
+        кладется в usage_out для _record_image_usage.
+        """
         try:
             # Расширенные тематические запросы
             theme_queries = {
@@ -1846,156 +3440,50 @@ class TelegramBot:
             
             logger.info(f"🔍 Ищем фото по запросу: '{query}'")
             
-            # Очищаем историю изображений старше 30 дней
-            if "used_images_detailed" in self.image_history:
-                thirty_days_ago = (self.get_moscow_time() - timedelta(days=30)).strftime("%Y-%m-%d")
-                self.image_history["used_images_detailed"] = [
-                    item for item in self.image_history["used_images_detailed"]
-                    if item.get("last_used", "") >= thirty_days_ago
-                ]
-            
-            # Получаем изображения с Pexels API (увеличиваем количество до 30)
-            if PEXELS_API_KEY:
-                url = "https://api.pexels.com/v1/search"
-                params = {"query": query, "per_page": 30, "orientation": "landscape", "size": "large"}
-                headers = {"Authorization": PEXELS_API_KEY}
-                
-                response = session.get(url, params=params, headers=headers, timeout=15)
-                if response.status_code == 200:
-                    data = response.json()
-                    photos = data.get("photos", [])
-                    if photos:
-                        # Получаем список использованных изображений за последние 7 дней
-                        seven_days_ago = (self.get_moscow_time() - timedelta(days=7)).strftime("%Y-%m-%d")
-                        recently_used = []
-                        
-                        if "used_images_detailed" in self.image_history:
-                            recently_used = [
-                                item.get("url", "") for item in self.image_history["used_images_detailed"]
-                                if item.get("last_used", "") >= seven_days_ago
-                            ]
-                        
-                        # Исключаем недавно использованные изображения
-                        available = [
-                            p for p in photos 
-                            if p.get("src", {}).get("large") not in recently_used
-                        ]
-                        
-                        # Если есть доступные изображения, выбираем случайное
-                        if available:
-                            photo = random.choice(available)
-                        else:
-                            # Если все изображения недавно использовались, выбираем наименее используемое
-                            if "used_images_detailed" in self.image_history:
-                                # Считаем частоту использования
-                                usage_count = {}
-                                for item in self.image_history["used_images_detailed"]:
-                                    url = item.get("url", "")
-                                    if url:
-                                        usage_count[url] = usage_count.get(url, 0) + 1
-                                
-                                # Находим наименее используемые изображения
-                                available_photos = []
-                                for photo in photos:
-                                    url = photo.get("src", {}).get("large", "")
-                                    if url:
-                                        count = usage_count.get(url, 0)
-                                        available_photos.append((photo, count))
-                                
-                                if available_photos:
-                                    available_photos.sort(key=lambda x: x[1])
-                                    photo = available_photos[0][0]
-                                else:
-                                    photo = random.choice(photos)
-                            else:
-                                photo = random.choice(photos)
-                        
-                        image_url = photo.get("src", {}).get("large", "")
-                        if image_url:
-                            today = self.get_moscow_time().strftime("%Y-%m-%d")
-                            
-                            # Обновляем детальную историю
-                            if "used_images_detailed" not in self.image_history:
-                                self.image_history["used_images_detailed"] = []
-                            
-                            found = False
-                            for item in self.image_history["used_images_detailed"]:
-                                if item.get("url", "") == image_url:
-                                    item["last_used"] = today
-                                    item["count"] = item.get("count", 0) + 1
-                                    item["theme"] = theme
-                                    found = True
-                                    break
-                            
-                            if not found:
-                                self.image_history["used_images_detailed"].append({
-                                    "url": image_url,
-                                    "last_used": today,
-                                    "count": 1,
-                                    "theme": theme,
-                                    "query": query
-                                })
-                            
-                            # Ограничиваем размер истории
-                            if len(self.image_history["used_images_detailed"]) > 500:
-                                # Удаляем наименее используемые изображения
-                                self.image_history["used_images_detailed"].sort(
-                                    key=lambda x: (x.get("count", 0), x.get("last_used", ""))
-                                )
-                                self.image_history["used_images_detailed"] = self.image_history["used_images_detailed"][-400:]
-                            
-                            # Сохраняем также в старом формате для обратной совместимости
-                            if "used_images" not in self.image_history:
-                                self.image_history["used_images"] = []
-                            
-                            if image_url not in self.image_history["used_images"]:
-                                self.image_history["used_images"].append(image_url)
-                            
-                            # Ограничиваем размер старого списка
-                            if len(self.image_history["used_images"]) > 300:
-                                self.image_history["used_images"] = self.image_history["used_images"][-200:]
-                            
-                            self._save_json("image_history.json", self.image_history)
-                            
-                            return image_url, f"Фото на тему '{query}'"
-            
-            # Fallback на Unsplash
-            encoded_query = quote_plus(query)
-            unsplash_url = f"https://source.unsplash.com/featured/1200x630/?{encoded_query}"
-            
-            response = session.head(unsplash_url, timeout=5, allow_redirects=True)
-            if response.status_code == 200:
-                image_url = response.url
-                
-                # Сохраняем в историю
-                if "used_images_detailed" not in self.image_history:
-                    self.image_history["used_images_detailed"] = []
-                
-                today = self.get_moscow_time().strftime("%Y-%m-%d")
-                self.image_history["used_images_detailed"].append({
-                    "url": image_url,
-                    "last_used": today,
-                    "count": 1,
-                    "theme": theme,
-                    "query": query,
-                    "source": "unsplash"
-                })
-                
-                if "used_images" not in self.image_history:
-                    self.image_history["used_images"] = []
-                
-                if image_url not in self.image_history["used_images"]:
-                    self.image_history["used_images"].append(image_url)
-                
-                self._save_json("image_history.json", self.image_history)
+            # Свежие - не использованные за 7 дней (проверка по индексу за O(1))
+            seven_days_ago = (self.get_moscow_time() - timedelta(days=7)).strftime("%Y-%m-%d")
+            found = self.image_resolver.resolve(
+                query, lambda photo: not self.image_usage.used_since(photo, seven_days_ago), self.image_usage.count
+            )
+            if found:
+                photo, provider = found
+                image_url = photo["url"]
+                usage = {"photo": {"id": photo.get("id"), "url": image_url}, "query": query, "source": provider.name}
+                if usage_out is not None:
+                    usage_out.update(usage)
+                if record:
+                    self._record_image_usage(theme, usage)
                 
-                return image_url, f"Фото на тему '{query}' (Unsplash)"
+                description = f"Фото на тему '{query}'"
+                return image_url, f"{description} ({provider.label})" if provider.label else description
             
         except Exception as e:
             logger.error(f"❌ Ошибка поиска картинки: {e}")
         
         return None, "Нет картинки"
     
+    def _record_image_usage(self, theme: str, usage: Dict):
+        """Учитывает картинку в индексе свежести и истории"""
+        today = self.get_moscow_time().strftime("%Y-%m-%d")
+        self.image_usage.record(usage["photo"], today)
+        self.history.record_image(usage["photo"]["url"], today, theme, usage["query"], source=usage["source"])
+    
+    def _build_image_providers(self) -> List[ImageProvider]:
+        """Источники картинок из IMAGE_PROVIDERS в порядке предпочтения"""
+        factories = {
+            "pexels": lambda: PexelsProvider(self.pexels, self.image_pool),
+            "unsplash": UnsplashProvider,
+            "local": LocalFolderProvider,
+            "stub": StubImageProvider,
+        }
+        providers = []
+        for name in IMAGE_PROVIDERS:
+            if name in factories:
+                providers.append(factories[name]())
+            else:
+                logger.warning(f"⚠️ Неизвестный источник картинок: {name}")
+        return providers
+    
     def create_inline_keyboard(self) -> InlineKeyboardMarkup:
         """Создает inline клавиатуру"""
         keyboard = InlineKeyboardMarkup(row_width=3)
@@ -2012,6 +3500,9 @@ class TelegramBot:
         return keyboard
     
     # ========== CALLBACK ОБРАБОТЧИКИ ==========
+    # Действия, которые ходят в Gemini или за картинками - выполняются в пуле, а не в потоке приема обновлений
+    LONG_CALLBACKS = {"edit_text": "переделай текст", "edit_photo": "замени фото", "edit_all": "переделай полностью"}
+    
     def _handle_callback(self, call: CallbackQuery):
         """Основной обработчик callback"""
         try:
@@ -2021,20 +3512,111 @@ class TelegramBot:
             message_id = call.message.message_id
             callback_data = call.data
             
-            if message_id not in self.pending_posts:
+            with self.pending_lock:
+                post_data = self.pending_posts.get(message_id)
+            if post_data is None:
                 return
             
-            post_data = self.pending_posts[message_id]
+            post_key = post_data.get('post_id', message_id)
             
             if callback_data.startswith("theme_"):
-                self._handle_theme_selection(message_id, post_data, call, callback_data)
+                self._submit_callback_job(
+                    post_key, call, f"новый пост на тему «{callback_data[len('theme_'):]}»",
+                    lambda: self._handle_theme_selection(message_id, post_data, call, callback_data)
+                )
+                return
+            
+            if callback_data in self.LONG_CALLBACKS:
+                handler = self.callback_handlers[callback_data]
+                self._submit_callback_job(post_key, call, self.LONG_CALLBACKS[callback_data],
+                                          lambda: handler(message_id, post_data, call))
                 return
             
             if callback_data in self.callback_handlers:
-                self.callback_handlers[callback_data](message_id, post_data, call)
+                # Публикация и отклонение не должны пересекаться с правкой этого поста, которая еще идет в пуле
+                if not self._claim_post(post_key, call):
+                    return
+                try:
+                    self.callback_handlers[callback_data](message_id, post_data, call)
+                finally:
+                    self._release_post(post_key)
                 
         except Exception as e:
             logger.error(f"💥 Ошибка обработки callback: {e}")
+        finally:
+            self._flush_state()
+            # Правки заменяют пост новым сообщением или снимают его с модерации - проверяем после любого действия
+            self._check_moderation_done()
+    
+    def _claim_post(self, post_key: int, call: CallbackQuery) -> bool:
+        """Помечает пост занятым; если над ним уже идет действие, отвечает на нажатие и возвращает False"""
+        with self.busy_lock:
+            busy = post_key in self.busy_posts
+            if not busy:
+                self.busy_posts.add(post_key)
+        if busy:
+            self.bot.answer_callback_query(call.id, "⏳ Пост еще обрабатывается, подождите...")
+        return not busy
+    
+    def _release_post(self, post_key: int):
+        with self.busy_lock:
+            self.busy_posts.discard(post_key)
+    
+    def _submit_callback_job(self, post_key: int, call: CallbackQuery, title: str, job: Callable[[], bool]):
+        """Ставит долгое действие над постом в пул; повторные нажатия, пока оно идет, отклоняются"""
+        if not self._claim_post(post_key, call):
+            return
+        
+        # Отвечаем на нажатие сразу: иначе кнопка висит с часиками, пока действие ждет в очереди пула
+        try:
+            self.bot.answer_callback_query(call.id, f"⏳ {title}...")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось ответить на нажатие: {e}")
+        
+        try:
+            progress = self.bot.send_message(chat_id=ADMIN_CHAT_ID, text=f"⏳ <b>Выполняю:</b> {title}...",
+                                             parse_mode='HTML')
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось отправить статус действия: {e}")
+            progress = None
+        
+        try:
+            self.callback_executor.submit(self._run_callback_job, post_key, title, job, progress)
+        except Exception:
+            self._release_post(post_key)
+            raise
+    
+    def _run_callback_job(self, post_key: int, title: str, job: Callable[[], bool], progress: Optional[Message]):
+        started = time.monotonic()
+        failed = True
+        try:
+            # Обработчик сам сообщает об ошибке админу и возвращает False
+            failed = not job()
+        except Exception as e:
+            logger.error(f"💥 Ошибка действия '{title}': {e}")
+        finally:
+            self._release_post(post_key)
+            self._flush_state()
+            self._check_moderation_done()
+        
+        if progress:
+            status = "❌ Ошибка" if failed else "✔️ Завершено"
+            try:
+                self.bot.edit_message_text(chat_id=ADMIN_CHAT_ID, message_id=progress.message_id,
+                                           text=f"{status}: {title} ({time.monotonic() - started:.0f} сек)")
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось обновить статус действия: {e}")
+    
+    def _check_moderation_done(self):
+        """Сигнализирует о завершении модерации, когда не осталось постов в ожидании и действий в работе"""
+        with self.pending_lock:
+            posts = list(self.pending_posts.values())
+        remaining = sum(1 for p in posts
+                        if p.get('status') in [PostStatus.PENDING, PostStatus.NEEDS_EDIT])
+        with self.busy_lock:
+            remaining += len(self.busy_posts)
+        if remaining == 0:
+            self.moderation_done.set()
     
     def _handle_approval(self, message_id: int, post_data: Dict, call: CallbackQuery):
         """Обработка одобрения поста"""
@@ -2091,11 +3673,11 @@ class TelegramBot:
                     self.published_posts_count += 1
                     
                     if self.published_posts_count >= 2:
-                        with self.completion_lock:
-                            self.workflow_complete = True
+                        self.moderation_done.set()
             
-            if message_id in self.pending_posts:
-                del self.pending_posts[message_id]
+            with self.pending_lock:
+                self.pending_posts.pop(message_id, None)
+            self._check_moderation_done()
                 
         except Exception as e:
             logger.error(f"💥 Ошибка обработки одобрения: {e}")
@@ -2145,37 +3727,19 @@ class TelegramBot:
             slot_time = post_data.get('slot_time', '')
             
             if slot_time:
-                if "rejected_slots" not in self.post_history:
-                    self.post_history["rejected_slots"] = {}
-                
-                if today not in self.post_history["rejected_slots"]:
-                    self.post_history["rejected_slots"][today] = []
-                
-                self.post_history["rejected_slots"][today].append({
-                    "time": slot_time,
-                    "type": post_data.get('type'),
-                    "theme": post_data.get('theme'),
-                    "reason": "Отклонено через кнопку"
-                })
-                self._save_json("post_history.json", self.post_history)
-            
-            if message_id in self.pending_posts:
-                del self.pending_posts[message_id]
-                
-            remaining = len([p for p in self.pending_posts.values() 
-                           if p.get('status') in [PostStatus.PENDING, PostStatus.NEEDS_EDIT]])
-            if remaining == 0:
-                with self.completion_lock:
-                    self.workflow_complete = True
-                    
+                self.history.record_slot(today, slot_time, "rejected", post_type=post_data.get('type'),
+                                         theme=post_data.get('theme'), reason="Отклонено через кнопку")
+            
+            with self.pending_lock:
+                self.pending_posts.pop(message_id, None)
+            self._check_moderation_done()
+            
         except Exception as e:
             logger.error(f"💥 Ошибка обработки отклонения: {e}")
     
-    def _handle_edit_request(self, message_id: int, post_data: Dict, call: CallbackQuery, edit_type: str):
-        """Обработка запроса на редактирование"""
+    def _handle_edit_request(self, message_id: int, post_data: Dict, call: CallbackQuery, edit_type: str) -> bool:
+        """Обработка запроса на редактирование; возвращает True, если правка применена"""
         try:
-            self.bot.answer_callback_query(call.id, f"✏️ {edit_type}...")
-            
             theme = post_data.get('theme', 'HR и управление персоналом')
             slot_style = post_data.get('slot_style', self.TIME_STYLES.get("15:00"))
             
@@ -2234,6 +3798,7 @@ class TelegramBot:
                         text=f"✅ Текст {post_data['type']} поста успешно перегенерирован!",
                         parse_mode='HTML'
                     )
+                    return True
                 else:
                     self.bot.send_message(
                         chat_id=ADMIN_CHAT_ID,
@@ -2259,22 +3824,25 @@ class TelegramBot:
                         pass
                     
                     try:
-                        sent = self.bot.send_photo(
+                        sent = self._send_photo(
                             chat_id=ADMIN_CHAT_ID,
-                            photo=new_image_url,
+                            image_url=new_image_url,
                             caption=post_data['text'][:1024],
                             parse_mode='HTML',
                             reply_markup=keyboard
                         )
                         
-                        old_data = self.pending_posts.pop(message_id, {})
-                        self.pending_posts[sent.message_id] = {**old_data, 'image_url': new_image_url}
+                        # Замена одним шагом: иначе между pop и вставкой модерация выглядит завершенной
+                        with self.pending_lock:
+                            old_data = self.pending_posts.pop(message_id, post_data)
+                            self.pending_posts[sent.message_id] = {**old_data, 'image_url': new_image_url}
                         
                         self.bot.send_message(
                             chat_id=ADMIN_CHAT_ID,
                             text="✅ Фото успешно заменено!",
                             parse_mode='HTML'
                         )
+                        return True
                     except Exception as e:
                         logger.error(f"❌ Ошибка отправки нового фото: {e}")
                         self.bot.send_message(
@@ -2315,16 +3883,17 @@ class TelegramBot:
                                 message_id=message_id
                             )
                             
-                            sent = self.bot.send_photo(
+                            sent = self._send_photo(
                                 chat_id=ADMIN_CHAT_ID,
-                                photo=new_image_url,
+                                image_url=new_image_url,
                                 caption=new_text[:1024],
                                 parse_mode='HTML',
                                 reply_markup=keyboard
                             )
                             
-                            old_data = self.pending_posts.pop(message_id, {})
-                            self.pending_posts[sent.message_id] = {**old_data, 'text': new_text, 'image_url': new_image_url}
+                            with self.pending_lock:
+                                old_data = self.pending_posts.pop(message_id, post_data)
+                                self.pending_posts[sent.message_id] = {**old_data, 'text': new_text, 'image_url': new_image_url}
                         else:
                             if 'image_url' in post_data and post_data['image_url'] and post_data['image_url'].startswith('http'):
                                 self.bot.edit_message_caption(
@@ -2348,6 +3917,7 @@ class TelegramBot:
                             text=f"✅ {post_data['type']} пост полностью перегенерирован!",
                             parse_mode='HTML'
                         )
+                        return True
                     except Exception as e:
                         logger.error(f"❌ Ошибка обновления сообщения: {e}")
                         self.bot.send_message(
@@ -2361,6 +3931,7 @@ class TelegramBot:
                         text=f"❌ Не удалось перегенерировать {post_data['type']} пост",
                         parse_mode='HTML'
                     )
+            return False
             
         except Exception as e:
             logger.error(f"💥 Ошибка обработки запроса на редактирование: {e}")
@@ -2369,6 +3940,7 @@ class TelegramBot:
                 text=f"❌ Ошибка при редактировании: {e}",
                 parse_mode='HTML'
             )
+            return False
     
     def _handle_new_post_request(self, message_id: int, post_data: Dict, call: CallbackQuery):
         """Обработка запроса на новый пост"""
@@ -2409,11 +3981,10 @@ class TelegramBot:
         except Exception as e:
             logger.error(f"💥 Ошибка обработки запроса на новый пост: {e}")
     
-    def _handle_theme_selection(self, message_id: int, post_data: Dict, call: CallbackQuery, callback_data: str):
-        """Обработка выбора темы"""
+    def _handle_theme_selection(self, message_id: int, post_data: Dict, call: CallbackQuery, callback_data: str) -> bool:
+        """Обработка выбора темы; возвращает True, если новый пост отправлен на модерацию"""
         try:
             selected_theme = callback_data.replace("theme_", "")
-            self.bot.answer_callback_query(call.id, f"✅ Выбрана тема: {selected_theme}")
             
             try:
                 self.bot.delete_message(
@@ -2435,15 +4006,17 @@ class TelegramBot:
             slot_style = post_data.get('slot_style', self.TIME_STYLES.get("15:00"))
             post_type = post_data.get('type', 'telegram')
             
+            picks = self.new_pick_context()
             if post_type == 'telegram':
-                prompt = self.create_telegram_prompt(selected_theme, slot_style, "разбор ситуации", f"Фото на тему '{selected_theme}'")
+                prompt = self.create_telegram_prompt(selected_theme, slot_style, "разбор ситуации", f"Фото на тему '{selected_theme}'", picks)
             else:
-                prompt = self.create_zen_prompt(selected_theme, slot_style, "разбор ситуации", f"Фото на тему '{selected_theme}'")
+                prompt = self.create_zen_prompt(selected_theme, slot_style, "разбор ситуации", f"Фото на тему '{selected_theme}'", picks)
             
-            new_text = self.generate_with_gemini(prompt, post_type)
+            deadline = time.monotonic() + CALLBACK_GENERATION_BUDGET
+            new_text = self.generate_with_gemini(prompt, post_type, deadline, slot_style=slot_style, theme=selected_theme)
             
             if new_text:
-                valid, fixed_text = self.validate_post_structure(new_text, post_type, slot_style if post_type == 'telegram' else None)
+                valid, fixed_text = self.validate_post_structure(new_text, post_type, slot_style if post_type == 'telegram' else None, selected_theme)
                 
                 if valid:
                     if self._is_duplicate_text(fixed_text):
@@ -2453,9 +4026,12 @@ class TelegramBot:
                             parse_mode='HTML'
                         )
                         for attempt in range(2):
-                            new_text = self.generate_with_gemini(prompt, post_type)
+                            if time.monotonic() >= deadline:
+                                break
+                            new_text = self.generate_with_gemini(prompt, post_type, deadline, fresh=True,
+                                                                 slot_style=slot_style, theme=selected_theme)
                             if new_text:
-                                valid, fixed_text = self.validate_post_structure(new_text, post_type, slot_style if post_type == 'telegram' else None)
+                                valid, fixed_text = self.validate_post_structure(new_text, post_type, slot_style if post_type == 'telegram' else None, selected_theme)
                                 if valid and not self._is_duplicate_text(fixed_text):
                                     break
                             time.sleep(2)
@@ -2465,9 +4041,9 @@ class TelegramBot:
                     keyboard = self.create_inline_keyboard()
                     
                     if new_image_url and new_image_url.startswith('http'):
-                        sent = self.bot.send_photo(
+                        sent = self._send_photo(
                             chat_id=ADMIN_CHAT_ID,
-                            photo=new_image_url,
+                            image_url=new_image_url,
                             caption=fixed_text[:1024],
                             parse_mode='HTML',
                             reply_markup=keyboard
@@ -2480,7 +4056,8 @@ class TelegramBot:
                             reply_markup=keyboard
                         )
                     
-                    self.pending_posts[sent.message_id] = {
+                    new_post = {
+                        'post_id': next(self.post_ids),
                         'type': post_type,
                         'text': fixed_text,
                         'image_url': new_image_url or '',
@@ -2488,10 +4065,14 @@ class TelegramBot:
                         'status': PostStatus.PENDING,
                         'theme': selected_theme,
                         'slot_style': slot_style,
+                        'day': post_data.get('day', ''),
                         'slot_time': post_data.get('slot_time', ''),
                         'edit_timeout': self.get_moscow_time() + timedelta(minutes=10)
                     }
+                    with self.pending_lock:
+                        self.pending_posts[sent.message_id] = new_post
                     
+                    picks.commit()
                     self._add_to_generated_texts(fixed_text)
                     
                     self.bot.send_message(
@@ -2499,6 +4080,7 @@ class TelegramBot:
                         text=f"✅ Новый {post_type} пост на тему '{selected_theme}' создан и отправлен на модерацию!",
                         parse_mode='HTML'
                     )
+                    return True
                 else:
                     self.bot.send_message(
                         chat_id=ADMIN_CHAT_ID,
@@ -2511,6 +4093,7 @@ class TelegramBot:
                     text=f"❌ Не удалось сгенерировать текст для темы '{selected_theme}'",
                     parse_mode='HTML'
                 )
+            return False
             
         except Exception as e:
             logger.error(f"💥 Ошибка обработки выбора темы: {e}")
@@ -2519,6 +4102,7 @@ class TelegramBot:
                 text=f"❌ Ошибка при создании нового поста: {e}",
                 parse_mode='HTML'
             )
+            return False
     
     def _handle_back_to_main(self, message_id: int, post_data: Dict, call: CallbackQuery):
         """Обработка возврата к основным кнопкам"""
@@ -2576,8 +4160,8 @@ class TelegramBot:
             
             if auto:
                 today = self.get_moscow_time().strftime("%Y-%m-%d")
-                sent_slots_today = self.post_history.get("sent_slots", {}).get(today, [])
-                rejected_slots_today = self.post_history.get("rejected_slots", {}).get(today, [])
+                sent_slots_today = self.history.slots_on(today, "sent")
+                rejected_slots_today = self.history.slots_on(today, "rejected")
                 
                 for slot_time, slot_style in self.TIME_STYLES.items():
                     slot_hour, slot_minute = map(int, slot_time.split(':'))
@@ -2585,13 +4169,7 @@ class TelegramBot:
                     
                     if target_time >= slot_datetime:
                         if slot_time not in sent_slots_today and slot_time not in rejected_slots_today:
-                            has_pending_for_slot = any(
-                                post.get('slot_time') == slot_time and 
-                                post.get('status') in [PostStatus.PENDING, PostStatus.NEEDS_EDIT]
-                                for post in self.pending_posts.values()
-                            )
-                            
-                            if not has_pending_for_slot:
+                            if not self._has_pending_post(today, slot_time):
                                 logger.info(f"🕒 Найден незапущенный слот {slot_time} для автоматического запуска")
                                 return slot_time, slot_style
                 
@@ -2636,85 +4214,7 @@ class TelegramBot:
     
     def _get_smart_theme(self) -> str:
         try:
-            today = self.get_moscow_time().strftime("%Y-%m-%d")
-            yesterday = (self.get_moscow_time() - timedelta(days=1)).strftime("%Y-%m-%d")
-            
-            # Загружаем историю использования тем
-            if "theme_usage" not in self.post_history:
-                self.post_history["theme_usage"] = {}
-            
-            theme_usage = self.post_history["theme_usage"]
-            
-            # Инициализируем счетчики использования тем за последние 7 дней
-            week_ago = (self.get_moscow_time() - timedelta(days=7)).strftime("%Y-%m-%d")
-            recent_usage = {}
-            
-            for theme in self.THEMES:
-                recent_usage[theme] = 0
-                if theme in theme_usage:
-                    # Считаем использование за последние 7 дней
-                    for date_str, count in theme_usage[theme].items():
-                        if date_str >= week_ago:
-                            recent_usage[theme] += count
-            
-            # Исключаем темы, использованные сегодня
-            today_used = []
-            for theme in self.THEMES:
-                if theme in theme_usage and today in theme_usage[theme]:
-                    today_used.append(theme)
-            
-            # Выбираем тему с наименьшим использованием за последние 7 дней
-            available_themes = [theme for theme in self.THEMES if theme not in today_used]
-            
-            if not available_themes:
-                # Если все темы использованы сегодня, выбираем наименее используемую за последние 7 дней
-                available_themes = self.THEMES
-            
-            # Взвешенный выбор: меньшая частота использования = больший вес
-            weights = []
-            for theme in available_themes:
-                usage = recent_usage.get(theme, 0)
-                weight = 1.0 / (usage + 1)  # +1 чтобы избежать деления на 0
-                
-                # Бонус для тем, не использованных более 2 дней
-                if theme in theme_usage:
-                    last_used_dates = [date for date in theme_usage[theme].keys() if date >= week_ago]
-                    if not last_used_dates or max(last_used_dates) < yesterday:
-                        weight *= 2.0
-                
-                weights.append(weight)
-            
-            chosen = random.choices(available_themes, weights=weights, k=1)[0]
-            
-            # Обновляем статистику использования
-            if chosen not in theme_usage:
-                theme_usage[chosen] = {}
-            
-            if today not in theme_usage[chosen]:
-                theme_usage[chosen][today] = 0
-            
-            theme_usage[chosen][today] += 1
-            
-            # Очищаем старые данные (старше 30 дней)
-            thirty_days_ago = (self.get_moscow_time() - timedelta(days=30)).strftime("%Y-%m-%d")
-            for theme in theme_usage:
-                theme_usage[theme] = {
-                    date: count for date, count in theme_usage[theme].items()
-                    if date >= thirty_days_ago
-                }
-            
-            self.post_history["theme_usage"] = theme_usage
-            
-            # Сохраняем также в старом формате для обратной совместимости
-            if "theme_rotation" not in self.post_history:
-                self.post_history["theme_rotation"] = []
-            
-            # Ограничиваем размер старого списка
-            if len(self.post_history["theme_rotation"]) >= 50:
-                self.post_history["theme_rotation"] = self.post_history["theme_rotation"][-30:]
-            
-            self.post_history["theme_rotation"].append(chosen)
-            self._save_json("post_history.json", self.post_history)
+            chosen = self.rotation["theme"].choose()
             
             self.current_theme = chosen
             return chosen
@@ -2724,6 +4224,47 @@ class TelegramBot:
             self.current_theme = random.choice(self.THEMES)
             return self.current_theme
     
+    def _download_photo(self, image_url: str) -> Optional[bytes]:
+        """Скачивает картинку и, если есть Pillow, пережимает до TELEGRAM_PHOTO_MAX_SIDE по большей стороне"""
+        try:
+            response = session.get(image_url, timeout=15)
+            if response.status_code != 200 or not response.content:
+                logger.warning(f"⚠️ Не удалось скачать картинку ({response.status_code}), отдаю Telegram URL")
+                return None
+        except requests.RequestException as e:
+            logger.warning(f"⚠️ Не удалось скачать картинку: {e}, отдаю Telegram URL")
+            return None
+        
+        content = response.content
+        if Image is None or TELEGRAM_PHOTO_MAX_SIDE <= 0:
+            return content
+        try:
+            with Image.open(BytesIO(content)) as image:
+                if max(image.size) <= TELEGRAM_PHOTO_MAX_SIDE and image.format == "JPEG":
+                    return content
+                image.thumbnail((TELEGRAM_PHOTO_MAX_SIDE, TELEGRAM_PHOTO_MAX_SIDE))
+                output = BytesIO()
+                image.convert("RGB").save(output, format="JPEG", quality=85, optimize=True)
+            logger.info(f"🗜️ Картинка пережата: {len(content) // 1024} -> {output.tell() // 1024} КБ")
+            return output.getvalue()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось пережать картинку: {e}")
+            return content
+    
+    def _send_photo(self, chat_id: Union[int, str], image_url: str, **kwargs) -> Message:
+        """send_photo через кэш file_id: картинка скачивается и загружается в Telegram один раз на URL"""
+        file_id = self.photo_cache.get(image_url)
+        if file_id:
+            try:
+                return self.bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except Exception as e:
+                logger.warning(f"⚠️ file_id картинки не принят, загружаю заново: {e}")
+                self.photo_cache.forget(image_url)
+        
+        sent = self.bot.send_photo(chat_id=chat_id, photo=self._download_photo(image_url) or image_url, **kwargs)
+        self.photo_cache.remember(image_url, sent)
+        return sent
+    
     def _publish_to_channel(self, text: str, image_url: str, channel: str) -> bool:
         try:
             logger.info(f"📤 Публикую в {channel}")
@@ -2731,9 +4272,9 @@ class TelegramBot:
             if image_url and image_url.strip() and image_url.startswith('http'):
                 try:
                     caption = text[:1024] if len(text) > 1024 else text
-                    self.bot.send_photo(
+                    self._send_photo(
                         chat_id=channel,
-                        photo=image_url,
+                        image_url=image_url,
                         caption=caption,
                         parse_mode='HTML'
                     )
@@ -2769,7 +4310,9 @@ class TelegramBot:
         logger.info("📤 Отправляю посты на модерацию...")
         
         success_count = 0
-        edit_timeout = self.get_moscow_time() + timedelta(minutes=10)
+        now = self.get_moscow_time()
+        day = now.strftime("%Y-%m-%d")
+        edit_timeout = now + timedelta(minutes=10)
         
         def send_post(post_type: str, text: str, channel: str) -> Optional[int]:
             nonlocal success_count
@@ -2781,9 +4324,9 @@ class TelegramBot:
                     for attempt in range(3):
                         try:
                             caption = text[:caption_length]
-                            sent = self.bot.send_photo(
+                            sent = self._send_photo(
                                 chat_id=ADMIN_CHAT_ID,
-                                photo=image_url,
+                                image_url=image_url,
                                 caption=caption,
                                 parse_mode='HTML',
                                 reply_markup=keyboard
@@ -2814,7 +4357,8 @@ class TelegramBot:
                     message_id = sent.message_id
                     image_url_used = ''
                 
-                self.pending_posts[message_id] = {
+                post = {
+                    'post_id': next(self.post_ids),
                     'type': post_type,
                     'text': text,
                     'image_url': image_url_used if 'image_url_used' in locals() else image_url,
@@ -2822,9 +4366,12 @@ class TelegramBot:
                     'status': PostStatus.PENDING,
                     'theme': theme,
                     'slot_style': self.current_style,
+                    'day': day,
                     'slot_time': slot_time,
                     'edit_timeout': edit_timeout
                 }
+                with self.pending_lock:
+                    self.pending_posts[message_id] = post
                 
                 success_count += 1
                 return message_id
@@ -2874,8 +4421,12 @@ class TelegramBot:
                                   f"   Символов: {len(zen_text)} (нужно {self.current_style['zen_chars'][0]}-{self.current_style['zen_chars'][1]})\n"
                                   f"   Токенов: {zen_token_min}-{zen_token_max}\n\n")
                 
-                instruction += (f"<b>📊 Итог по токенам:</b> {total_token_min}-{total_token_max} токенов\n\n"
-                              f"<b>⏰ Время на решение:</b> до {edit_timeout.strftime('%H:%M')} МСК")
+                instruction += f"<b>📊 Итог по токенам:</b> {total_token_min}-{total_token_max} токенов\n\n"
+                
+                if self.pexels.enabled:
+                    instruction += f"<b>🖼️ Квота Pexels:</b> {self.pexels.summary()}\n\n"
+                
+                instruction += (f"<b>⏰ Время на решение:</b> до {edit_timeout.strftime('%H:%M')} МСК")
                 
                 self.bot.send_message(
                     chat_id=ADMIN_CHAT_ID,
@@ -2892,12 +4443,18 @@ class TelegramBot:
             logger.info(f"🎬 Создание постов для {slot_time}")
             self.current_style = slot_style
             
-            theme = self._get_smart_theme()
-            text_format = "разбор ситуации"
-            
-            image_url, image_description = self.get_post_image_and_description(theme)
-            
-            tg_text, zen_text = self.generate_with_retry(theme, slot_style, text_format, image_description)
+            draft = self._take_draft(slot_time)
+            if draft:
+                theme = draft['theme']
+                self.current_theme = theme
+                image_url, tg_text, zen_text = draft['image_url'], draft['tg_text'], draft['zen_text']
+            else:
+                theme = self._get_smart_theme()
+                text_format = "разбор ситуации"
+                
+                image_url, image_description = self.get_post_image_and_description(theme)
+                
+                tg_text, zen_text = self.generate_with_retry(theme, slot_style, text_format, image_description)
             
             if not tg_text:
                 logger.error("❌ Не удалось создать Telegram пост")
@@ -2920,13 +4477,7 @@ class TelegramBot:
             
             if success_count >= 2:
                 today = self.get_moscow_time().strftime("%Y-%m-%d")
-                if "sent_slots" not in self.post_history:
-                    self.post_history["sent_slots"] = {}
-                if today not in self.post_history["sent_slots"]:
-                    self.post_history["sent_slots"][today] = []
-                
-                self.post_history["sent_slots"][today].append(slot_time)
-                self._save_json("post_history.json", self.post_history)
+                self.history.record_slot(today, slot_time, "sent", theme=theme)
                 
                 logger.info(f"✅ {success_count} поста отправлены на модерацию")
                 return True
@@ -2944,6 +4495,265 @@ class TelegramBot:
                 parse_mode='HTML'
             )
             return False
+        finally:
+            self._flush_state()
+    
+    def _take_draft(self, slot_time: str) -> Optional[Dict]:
+        """Готовый черновик для слота, если он есть и не устарел"""
+        now = self.get_moscow_time()
+        draft = self.history.take_draft(now.strftime("%Y-%m-%d"), slot_time)
+        if not draft:
+            return None
+        
+        age = now - datetime.strptime(draft['created_at'], "%Y-%m-%d %H:%M:%S")
+        if age > timedelta(hours=DRAFT_MAX_AGE_HOURS):
+            logger.info(f"🗑️ Черновик для {slot_time} устарел ({age}), генерирую заново")
+            return None
+        
+        logger.info(f"📦 Использую черновик для {slot_time} (тема: {draft['theme']}, подготовлен {draft['created_at']})")
+        # Ротация и свежесть картинок учитывают черновик только сейчас, когда он занимает слот
+        self.rotation["theme"].record(draft['theme'])
+        if draft['image_usage']:
+            self._record_image_usage(draft['theme'], draft['image_usage'])
+        for post_picks in draft['picks'].values():
+            for catalog, item in post_picks.items():
+                if catalog in self.rotation:
+                    self.rotation[catalog].record(item)
+        return draft
+    
+    def _upcoming_slots(self, now: datetime, count: int) -> List[Tuple[str, str, Dict]]:
+        """Ближайшие count слотов после now: (день, время слота, стиль)"""
+        slots = []
+        for day_offset in range(count // len(self.TIME_STYLES) + 2):
+            day = (now + timedelta(days=day_offset)).date()
+            for slot_time in sorted(self.TIME_STYLES):
+                slot_hour, slot_minute = map(int, slot_time.split(':'))
+                if datetime(day.year, day.month, day.day, slot_hour, slot_minute) > now:
+                    slots.append((day.strftime("%Y-%m-%d"), slot_time, self.TIME_STYLES[slot_time]))
+        return slots[:count]
+    
+    def _pending_draft_slots(self, count: int = DRAFT_SLOTS_AHEAD) -> List[Tuple[str, str, Dict]]:
+        """Ближайшие слоты, для которых еще нет черновика и которые еще не отправлены"""
+        upcoming = self._upcoming_slots(self.get_moscow_time(), count)
+        return [(day, slot_time, slot_style) for day, slot_time, slot_style in upcoming
+                if (day, slot_time) not in self.failed_drafts
+                and slot_time not in self.history.draft_slots(day)
+                and slot_time not in self.history.slots_on(day, "sent")]
+    
+    def _pregenerate_draft(self, day: str, slot_time: str, slot_style: Dict) -> bool:
+        """Генерирует, проверяет и кладет в очередь черновик одного слота"""
+        try:
+            logger.info(f"📝 Готовлю черновик для {day} {slot_time}")
+            # Тема и стиль передаются явно (current_theme/current_style принадлежат текущему слоту);
+            # в ротации тема, элементы промптов и картинка учитываются, когда черновик займет слот
+            theme = self.rotation["theme"].pick()
+            image_usage: Dict = {}
+            image_url, image_description = self.get_post_image_and_description(theme, record=False,
+                                                                               usage_out=image_usage)
+            
+            picks: Dict[str, Dict] = {}
+            tg_text, zen_text = self.generate_with_retry(theme, slot_style, "разбор ситуации", image_description,
+                                                         picks_out=picks, record_picks=False)
+            if not tg_text:
+                logger.warning(f"⚠️ Черновик для {day} {slot_time} не получился, слот сгенерируется в срок")
+                self.failed_drafts.add((day, slot_time))
+                return False
+            
+            self.history.save_draft(day, slot_time, theme, tg_text, zen_text, image_url, image_description,
+                                    picks, image_usage, self.get_moscow_time().strftime("%Y-%m-%d %H:%M:%S"))
+            return True
+        except Exception as e:
+            logger.error(f"💥 Ошибка подготовки черновика {day} {slot_time}: {e}")
+            self.failed_drafts.add((day, slot_time))
+            return False
+        finally:
+            # Каждый готовый черновик фиксируем сразу, не дожидаясь остальных
+            self._flush_state()
+    
+    def pregenerate_drafts(self, count: int = DRAFT_SLOTS_AHEAD) -> int:
+        """Заранее генерирует и проверяет посты для ближайших слотов и кладет их в очередь черновиков"""
+        created = sum(self._pregenerate_draft(*slot) for slot in self._pending_draft_slots(count))
+        logger.info(f"📝 Подготовлено черновиков: {created}")
+        return created
+    
+    def _start_updates(self):
+        """Запускает прием нажатий кнопок модерации: webhook, если задан WEBHOOK_URL, иначе polling"""
+        if WEBHOOK_URL:
+            try:
+                self._start_webhook()
+                return
+            except Exception as e:
+                logger.error(f"❌ Не удалось запустить webhook ({e}), переключаюсь на polling")
+                if self.webhook_server:
+                    self.webhook_server.stop()
+                    self.webhook_server = None
+        self._start_polling()
+    
+    def _stop_updates(self):
+        if self.webhook_server:
+            self._stop_webhook()
+        else:
+            self._stop_polling()
+        # Новые нажатия больше не приходят - дожидаемся начатых действий, чтобы их результат попал на диск
+        self.callback_executor.shutdown(wait=True)
+    
+    def _start_webhook(self):
+        secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+        
+        def on_update(update_json: Dict):
+            update = Update.de_json(update_json)
+            if update and update.callback_query:
+                self._handle_callback(update.callback_query)
+        
+        self.webhook_server = WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT, secret, on_update)
+        self.webhook_server.start()
+        self.bot.set_webhook(url=WEBHOOK_URL, secret_token=secret, allowed_updates=["callback_query"],
+                             drop_pending_updates=True)
+        logger.info(f"🌐 Webhook установлен: {WEBHOOK_URL}")
+    
+    def _stop_webhook(self):
+        logger.info("🛑 Останавливаю webhook...")
+        try:
+            self.bot.delete_webhook()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось снять webhook: {e}")
+        self.webhook_server.stop()
+        self.webhook_server = None
+    
+    def _start_polling(self):
+        """Снимает webhook, регистрирует обработчик кнопок и запускает polling в фоновом потоке"""
+        self.bot.delete_webhook(drop_pending_updates=True)
+        
+        @self.bot.callback_query_handler(func=lambda call: True)
+        def handle_callback(call):
+            self._handle_callback(call)
+        
+        def polling_task():
+            try:
+                while not self.stop_polling_event.is_set():
+                    try:
+                        self.bot.polling(none_stop=True, interval=1, timeout=30)
+                    except Exception as e:
+                        logger.error(f"❌ Ошибка polling: {e}")
+                        self.stop_polling_event.wait(5)
+            except Exception as e:
+                logger.error(f"❌ Критическая ошибка в polling: {e}")
+        
+        self.stop_polling_event.clear()
+        self.polling_thread = threading.Thread(target=polling_task, daemon=True)
+        self.polling_thread.start()
+    
+    def _stop_polling(self):
+        logger.info("🛑 Останавливаю polling...")
+        self.stop_polling_event.set()
+        # bot.polling возвращается после текущего long poll запроса
+        self.bot.stop_polling()
+        
+        if self.polling_thread and self.polling_thread.is_alive():
+            self.polling_thread.join(timeout=5)
+    
+    def _due_slot(self, now: datetime, attempts: Dict[Tuple[str, str], Tuple[int, datetime]]) -> Optional[Tuple[str, str, Dict]]:
+        """Слот, который пора генерировать: (день, время слота, стиль) или None"""
+        day = now.strftime("%Y-%m-%d")
+        done = self.history.slots_on(day, "sent") | self.history.slots_on(day, "rejected")
+        for slot_time in sorted(self.TIME_STYLES):
+            slot_hour, slot_minute = map(int, slot_time.split(':'))
+            slot_at = datetime(now.year, now.month, now.day, slot_hour, slot_minute)
+            if slot_time in done or now < slot_at - timedelta(minutes=DAEMON_LEAD_MINUTES):
+                continue
+            if now - slot_at > timedelta(minutes=DAEMON_MAX_LATE_MINUTES):
+                continue
+            if self._has_pending_post(day, slot_time):
+                continue
+            
+            count, last_try = attempts.get((day, slot_time), (0, None))
+            if count >= DAEMON_MAX_ATTEMPTS:
+                continue
+            if last_try and now - last_try < timedelta(minutes=DAEMON_RETRY_MINUTES):
+                continue
+            return day, slot_time, self.TIME_STYLES[slot_time]
+        return None
+    
+    def _has_pending_post(self, day: str, slot_time: str) -> bool:
+        """Есть ли на модерации пост этого слота за этот день"""
+        with self.pending_lock:
+            posts = list(self.pending_posts.values())
+        return any(post.get('day') == day and post.get('slot_time') == slot_time
+                   and post.get('status') in [PostStatus.PENDING, PostStatus.NEEDS_EDIT]
+                   for post in posts)
+    
+    def _expire_pending_posts(self, now: datetime):
+        """Снимает с модерации посты, время на решение по которым истекло; правка, которая еще идет, не трогается"""
+        with self.busy_lock:
+            busy = set(self.busy_posts)
+        with self.pending_lock:
+            expired = [(message_id, post) for message_id, post in self.pending_posts.items()
+                       if post.get('edit_timeout') and post['edit_timeout'] < now
+                       and post.get('post_id', message_id) not in busy]
+            for message_id, _ in expired:
+                del self.pending_posts[message_id]
+        for message_id, post in expired:
+            logger.info(f"⌛ Время модерации {post.get('type')} поста слота {post.get('day')} {post.get('slot_time')} истекло")
+            try:
+                self.bot.edit_message_reply_markup(chat_id=ADMIN_CHAT_ID, message_id=message_id, reply_markup=None)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось убрать кнопки с просроченного поста: {e}")
+        if expired:
+            self._check_moderation_done()
+    
+    def _seconds_until_next_slot(self, now: datetime) -> float:
+        """Сколько спать до начала ближайшего слота (с учетом упреждения)"""
+        upcoming = self._upcoming_slots(now + timedelta(minutes=DAEMON_LEAD_MINUTES), 1)
+        if not upcoming:
+            return 3600
+        day, slot_time, _ = upcoming[0]
+        slot_at = datetime.strptime(f"{day} {slot_time}", "%Y-%m-%d %H:%M")
+        return max(1.0, (slot_at - timedelta(minutes=DAEMON_LEAD_MINUTES) - now).total_seconds())
+    
+    def run_daemon(self):
+        """Постоянный режим: один процесс, планировщик по TIME_STYLES, постоянный polling.
+        
+        Сессии HTTP, кэши и индексы остаются прогретыми между слотами; между слотами
+        готовятся черновики для следующих - по одному за итерацию, чтобы наступивший
+        слот не ждал всю очередь черновиков.
+        """
+        logger.info("🚀 Запуск в режиме демона")
+        attempts: Dict[Tuple[str, str], Tuple[int, datetime]] = {}
+        self._start_updates()
+        try:
+            while not self.shutdown_event.is_set():
+                try:
+                    now = self.get_moscow_time()
+                    # Посты без решения не копятся и не держат слот: снимаем их по истечении времени на решение
+                    self._expire_pending_posts(now)
+                    due = self._due_slot(now, attempts)
+                    if due:
+                        day, slot_time, slot_style = due
+                        count, _ = attempts.get((day, slot_time), (0, None))
+                        attempts[(day, slot_time)] = (count + 1, now)
+                        if not self.create_and_send_posts(slot_time, slot_style):
+                            logger.warning(f"⚠️ Слот {slot_time} не удался (попытка {count + 1}/{DAEMON_MAX_ATTEMPTS}), "
+                                           f"повтор через {DAEMON_RETRY_MINUTES} мин")
+                        continue
+                    
+                    # Свободное время - на один черновик, если он успеет до начала следующего слота
+                    if DRAFT_SLOTS_AHEAD > 0 and self._seconds_until_next_slot(now) > GENERATION_BUDGET:
+                        pending = self._pending_draft_slots()
+                        if pending:
+                            self._pregenerate_draft(*pending[0])
+                            continue
+                    
+                    # Не дольше 5 минут: повторы неудачных слотов и сдвиги часов
+                    sleep_for = min(self._seconds_until_next_slot(now), 300)
+                    self.shutdown_event.wait(sleep_for)
+                except Exception as e:
+                    # Сбой одной итерации не должен останавливать демон
+                    logger.error(f"💥 Ошибка в цикле демона: {e}")
+                    self.shutdown_event.wait(60)
+        finally:
+            self._stop_updates()
+            self._flush_state()
+            logger.info("✅ Демон остановлен")
     
     def run_single_cycle(self):
         try:
@@ -2968,54 +4778,24 @@ class TelegramBot:
                 logger.error("❌ Не удалось создать посты")
                 return
             
-            self.bot.delete_webhook(drop_pending_updates=True)
-            
-            @self.bot.callback_query_handler(func=lambda call: True)
-            def handle_callback(call):
-                self._handle_callback(call)
-            
-            def polling_task():
-                try:
-                    while not self.stop_polling:
-                        try:
-                            self.bot.polling(none_stop=True, interval=1, timeout=30)
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка polling: {e}")
-                            time.sleep(5)
-                except Exception as e:
-                    logger.error(f"❌ Критическая ошибка в polling: {e}")
-            
-            self.polling_thread = threading.Thread(target=polling_task, daemon=True)
-            self.polling_thread.start()
+            self._start_updates()
             
             logger.info("⏳ Ожидание обработки (10 минут)...")
-            start_time = time.time()
-            timeout = 600
-            
-            while time.time() - start_time < timeout:
-                with self.completion_lock:
-                    if self.workflow_complete:
-                        logger.info("✅ Workflow завершен")
-                        break
-                
-                remaining = len([p for p in self.pending_posts.values() 
-                               if p.get('status') in [PostStatus.PENDING, PostStatus.NEEDS_EDIT]])
-                if remaining == 0:
-                    logger.info("✅ Все посты обработаны")
-                    break
-                
-                time.sleep(1)
-            
-            logger.info("🛑 Останавливаю polling...")
-            self.stop_polling = True
+            self._check_moderation_done()
+            if self.moderation_done.wait(timeout=600):
+                logger.info("✅ Все посты обработаны")
+            else:
+                logger.warning("⏰ Время модерации истекло")
             
-            if self.polling_thread and self.polling_thread.is_alive():
-                self.polling_thread.join(timeout=5)
+            self._stop_updates()
             
             logger.info("✅ Работа завершена")
             
         except Exception as e:
             logger.error(f"💥 Ошибка в цикле работы: {e}")
+        finally:
+            self.callback_executor.shutdown(wait=True)
+            self._flush_state()
 
 
 def main():
@@ -3023,11 +4803,23 @@ def main():
         parser = argparse.ArgumentParser()
         parser.add_argument('--slot', help='Конкретный слот (формат HH:MM)')
         parser.add_argument('--auto', action='store_true', help='Автоматический запуск')
+        parser.add_argument('--pregenerate', action='store_true',
+                            help='Заранее подготовить черновики для ближайших слотов')
+        parser.add_argument('--daemon', action='store_true',
+                            help='Постоянный режим с внутренним планировщиком слотов')
         
         args = parser.parse_args()
         
+        # При отмене/таймауте job приходит SIGTERM - завершаемся штатно, чтобы сработали finally и flush
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        
         bot = TelegramBot(target_slot=args.slot, auto=args.auto)
-        bot.run_single_cycle()
+        if args.daemon:
+            bot.run_daemon()
+        elif args.pregenerate:
+            bot.pregenerate_drafts()
+        else:
+            bot.run_single_cycle()
         
     except KeyboardInterrupt:
         logger.info("🛑 Остановка по команде пользователя")
@@ -0,0 +1,41 @@
+"""Микробенчмарк очистки ответа модели: PostTextPipeline против старой очистки.
+
+Запуск: python tests/bench_text_pipeline.py [число прогонов]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Без обязательных переменных модуль бота завершает процесс при импорте
+for name in ("BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_CHAT_ID"):
+    os.environ.setdefault(name, "test")
+
+from github_bot import PostTextPipeline
+import legacy_text_cleanup
+
+THEME = "Кадровый менеджмент и HR"
+
+# 24 строки: типичная разметка по шаблону промпта, повторенная три раза
+SAMPLE = """[1] ЗАГОЛОВОК: 🌅 <b>Почему **команды** выгорают</b>
+АБЗАЦ 1: первое наблюдение о том, как устроена работа.
+#hr #команда
+АБЗАЦ 2: второе наблюдение, с деталями и цифрами 42%.
+КЛЮЧЕВАЯ МЫСЛЬ: мысль дня
+🎯 Ключевая мысль: ещё одна
+ВОПРОС: а как у вас?
+5
+""" * 3
+
+
+def main(runs: int = 3000):
+    pipeline = PostTextPipeline()
+    for post_type in ('telegram', 'zen'):
+        old = timeit.timeit(lambda: legacy_text_cleanup.postprocess(SAMPLE, post_type, THEME), number=runs)
+        new = timeit.timeit(lambda: pipeline.process(SAMPLE, post_type, THEME), number=runs)
+        print(f"{post_type}: {old / runs * 1e6:.1f}us -> {new / runs * 1e6:.1f}us (x{old / new:.1f})")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3000)
@@ -0,0 +1,122 @@
+"""Очистка ответа модели до PostTextPipeline (_clean_metadata + _fix_post_issues).
+
+Эталон для сравнения в test_text_pipeline.py и bench_text_pipeline.py. Поведение сохранено:
+методы TelegramBot стали функциями (тема - аргумент), убраны только ветки, результат которых не использовался.
+"""
+import re
+
+
+def clean_metadata(text, post_type, current_theme=None):
+    """Удаляет маркеры и метаданные из текста"""
+    if not text:
+        return text
+
+    lines = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            lines.append('')
+            continue
+
+        # Удаляем нумерацию типа [1], [2], [3], [4] и т.д.
+        line = re.sub(r'^\[\d+\]\s*', '', line)
+
+        # Удаляем метки типа "ЗАГОЛОВОК:", "АБЗАЦ 1:", "АБЗАЦ 2:", "КЛЮЧЕВАЯ МЫСЛЬ:", "ВОПРОС:", "ХЕШТЕГИ:" и т.д.
+        markers_to_remove = [
+            'заголовок:', 'абзац 1:', 'абзац 2:', 'ключевая мысль:', 'вопрос:', 'хештеги:',
+            'якорь:', 'в итоге:', 'anchor:', 'header:', 'paragraph:', 'key thought:',
+            'question:', 'hashtags:', 'абзац:', 'блок:', 'блок 1:', 'блок 2:', 'блок 3:', 'блок 4:', 'блок 5:',
+            'пустая строка', 'пустая строка:', 'пустая строка:', 'ппустая строка'
+        ]
+
+        for marker in markers_to_remove:
+            if line.lower().startswith(marker):
+                # Удаляем метку, оставляем только текст после двоеточия
+                parts = line.split(':', 1)
+                if len(parts) > 1:
+                    line = parts[1].strip()
+                else:
+                    line = line[len(marker):].strip()
+                break
+
+        # Удаляем начальные квадратные скобки '[' в начале строки
+        if line.startswith('['):
+            line = re.sub(r'^\[', '', line)
+
+        # Удаляем цифры в конце строк (например, "5" после хештегов)
+        if line.isdigit() and len(line) <= 2:
+            continue
+
+        if post_type in ['telegram', 'zen'] and line.startswith('#') and len(line) <= 3:
+            lines.append(line)
+            continue
+
+        # Telegram и Zen: НЕ удалять хештеги
+        if post_type in ['telegram', 'zen'] and line.startswith('#'):
+            lines.append(line)
+            continue
+
+        # Удаляем теги форматирования HTML, но оставляем текст
+        if post_type == 'telegram':
+            line = re.sub(r'<[^>]+>', '', line)
+
+        lines.append(line)
+
+    # Объединяем обратно, убирая лишние пустые строки
+    cleaned_text = '\n'.join(lines)
+
+    # Убираем повторяющиеся пустые строки (больше 2 подряд)
+    cleaned_text = re.sub(r'\n\s*\n\s*\n+', '\n\n', cleaned_text)
+
+    # Если убрались все хештеги, добавляем дефолтные
+    if post_type in ['telegram', 'zen'] and not re.search(r'#\w+', cleaned_text):
+        if current_theme:
+            theme_words = [word.strip() for word in current_theme.split() if len(word.strip()) > 2]
+            if theme_words:
+                hashtags = '#' + ' #'.join([re.sub(r'[^\w]', '', word.lower()) for word in theme_words[:3]])
+            else:
+                hashtags = "#управление #практика #результат"
+
+            cleaned_text = cleaned_text.strip()
+            if not cleaned_text.endswith('\n'):
+                cleaned_text += '\n\n'
+            cleaned_text += hashtags
+
+    return cleaned_text.strip()
+
+
+def fix_post_issues(text, post_type):
+    """Исправляет конкретные проблемы в посте.
+
+    Как и в оригинале, результат собирается из исходных строк: заглавные буквы абзацев
+    и перенос хештегов Telegram в конец вычисляются, но в результат не попадают.
+    """
+    if not text:
+        return text
+
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    if not lines:
+        return text
+
+    # Удаляем ** ** из Telegram постов
+    if post_type == 'telegram':
+        lines = [line.replace('**', '') for line in lines]
+
+    # Удаляем фразы "Ключевая мысль:", "Ключевая мысль" и "🎯 Ключевая мысль:"
+    fixed_lines = []
+    for line in lines:
+        if line.startswith('Ключевая мысль:') or line.startswith('Ключевая мысль ') or line.startswith('🎯 Ключевая мысль:'):
+            if line.startswith('Ключевая мысль:'):
+                line = line.replace('Ключевая мысль:', '', 1).strip()
+            elif line.startswith('Ключевая мысль '):
+                line = line.replace('Ключевая мысль ', '', 1).strip()
+            elif line.startswith('🎯 Ключевая мысль:'):
+                line = line.replace('🎯 Ключевая мысль:', '', 1).strip()
+        fixed_lines.append(line)
+
+    return '\n\n'.join(fixed_lines)
+
+
+def postprocess(text, post_type, theme=None):
+    """_postprocess_generated до PostTextPipeline"""
+    return fix_post_issues(clean_metadata(text, post_type, theme), post_type).strip()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Без обязательных переменных модуль бота завершает процесс при импорте
+for name in ("BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_CHAT_ID"):
+    os.environ.setdefault(name, "test")
+
+from github_bot import HistoryStore, ImageUsageIndex
+
+SMALL = "https://images.pexels.com/photos/123/pexels-photo-123.jpeg?w=800"
+LARGE = "https://images.pexels.com/photos/123/pexels-photo-123.jpeg?w=1200"
+LOCAL = "https://example.com/images/office.jpg"
+DAY = "2026-10-10"
+
+
+class ImageUsageMigrationTest(unittest.TestCase):
+    """HistoryStore.index_image_usage: image_usage -> дневные счетчики с ключом pexels:<id> или URL"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = HistoryStore(os.path.join(directory, "bot_history.db"))
+        self.addCleanup(self.store.conn.close)
+        for url in (SMALL, LARGE, LOCAL):
+            self.store.record_image(url, DAY, "HR", "office")
+
+    def usage(self):
+        return sorted(self.store.usage_by_day(ImageUsageIndex.CATALOG, "2026-01-01"))
+
+    def test_fresh_install(self):
+        self.store.index_image_usage()
+
+        self.assertEqual(self.usage(), [(LOCAL, DAY, 1), ("pexels:123", DAY, 2)])
+
+    def test_rekeys_rows_from_first_migration(self):
+        # Первая версия переноса: ключ - URL, флаг image_usage_indexed уже стоит
+        self.store._execute("INSERT OR IGNORE INTO rotation_usage (catalog, item, day, count) "
+                            "SELECT 'image', url, last_used, count FROM image_usage")
+        self.store.set_meta("image_usage_indexed", "2026-10-11T00:00:00")
+        # После нее фото Pexels уже записывались под id
+        self.store.record_usage(ImageUsageIndex.CATALOG, "pexels:123", DAY)
+        self.store.record_usage(ImageUsageIndex.CATALOG, "pexels:9", "2026-10-11")
+
+        self.store.index_image_usage()
+
+        self.assertEqual(self.usage(), [(LOCAL, DAY, 1), ("pexels:123", DAY, 3), ("pexels:9", "2026-10-11", 1)])
+
+    def test_runs_once(self):
+        self.store.index_image_usage()
+        self.store.index_image_usage()
+
+        self.assertEqual(self.usage(), [(LOCAL, DAY, 1), ("pexels:123", DAY, 2)])
+
+    def test_index_sees_migrated_keys(self):
+        index = ImageUsageIndex(self.store, lambda: datetime(2026, 10, 17))
+
+        self.assertEqual(index.count({"id": 123, "url": LARGE}), 2)
+        self.assertTrue(index.used_since({"id": 123, "url": SMALL}, "2026-10-10"))
+        self.assertEqual(index.count({"url": LOCAL}), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import json
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Без обязательных переменных модуль бота завершает процесс при импорте
+for name in ("BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_CHAT_ID"):
+    os.environ.setdefault(name, "test")
+
+from github_bot import Post
+
+STYLE = {'emoji': '🌅'}
+
+BLOCKS = [
+    "🌅 Утренний заголовок",
+    "Почему команды выгорают?",
+    "Обычный абзац текста.",
+    "абзац со строчной буквы",
+    "🎯 Ключевая мысль дня",
+    "Мысль с 🎯 внутри",
+    "А как у вас?",
+    "#hr #команда",
+    "Текст\nв две строки",
+    "Заголовок без эмодзи",
+]
+
+
+def legacy_block_types(blocks, post_type, slot_style):
+    """Классификация блоков из validate_post_structure до Post.parse"""
+    types = []
+    for i, block in enumerate(blocks):
+        if post_type == 'telegram' and slot_style and slot_style.get('emoji') and block.startswith(slot_style['emoji']):
+            types.append('header')
+        elif post_type == 'telegram' and '🎯' in block:
+            types.append('key_thought')
+        elif block.endswith('?') and i == 0 and post_type == 'zen':
+            types.append('header')
+        elif block.endswith('?') and i != 0:
+            types.append('question')
+        elif block.startswith('#'):
+            types.append('hashtags')
+        else:
+            types.append('paragraph')
+    return types
+
+
+class PostParseTest(unittest.TestCase):
+    """Post.parse: разбиение на блоки и классификация"""
+
+    def test_classification_matches_legacy(self):
+        rng = random.Random(12)
+        for _ in range(20000):
+            blocks = [rng.choice(BLOCKS) for _ in range(rng.randint(1, 7))]
+            post_type = rng.choice(('telegram', 'zen'))
+            style = rng.choice((STYLE, None))
+            post = Post.parse('\n\n'.join(blocks), post_type, style)
+
+            self.assertEqual([block.text for block in post.blocks], blocks)
+            self.assertEqual([block.kind for block in post.blocks], legacy_block_types(blocks, post_type, style))
+
+    def test_blank_lines_and_render(self):
+        post = Post.parse("\n\n🌅 Заголовок\n \n\nАбзац\n\n\n\n#hr\n", 'telegram', STYLE)
+
+        self.assertEqual([block.kind for block in post.blocks], [Post.HEADER, Post.PARAGRAPH, Post.HASHTAGS])
+        self.assertEqual(post.render(), "🌅 Заголовок\n\nАбзац\n\n#hr")
+        self.assertEqual(len(post), len(post.render()))
+        self.assertEqual(Post.parse("", 'zen').blocks, [])
+
+    def test_index_and_lines(self):
+        post = Post.parse("Заголовок\n\nВопрос один?\n\nТекст\nвторая строка\n\nВопрос два?\n\n#a #b", 'zen')
+
+        self.assertEqual(post.index_of(Post.QUESTION), 1)
+        self.assertEqual(post.index_of(Post.QUESTION, last=True), 3)
+        self.assertEqual(post.index_of(Post.KEY_THOUGHT), -1)
+        self.assertTrue(post.has(Post.HASHTAGS))
+        self.assertEqual(post.lines()[2:4], ["Текст", "вторая строка"])
+        self.assertNotIn("#a #b", post.body_lines())
+
+
+class PostFromDictTest(unittest.TestCase):
+    """Post.from_dict / from_json: ответ модели в structured-режиме"""
+    DATA = {
+        "header": "Заголовок",
+        "paragraph": "Основной   текст\nв две строки",
+        "key_thought": "Мысль",
+        "question": "Как у вас?",
+        "hashtags": ["#hr", "команда", " #рост "],
+    }
+
+    def test_telegram_normalization(self):
+        data = dict(self.DATA, header="<b>**Заголовок**</b>")
+        post = Post.from_dict(data, 'telegram', '🌅')
+
+        self.assertEqual([block.kind for block in post.blocks], list(Post.ORDER))
+        self.assertEqual(post.render(), "🌅 Заголовок\n\nОсновной текст в две строки\n\n🎯 Мысль\n\n"
+                                        "Как у вас?\n\n#hr #команда #рост")
+
+    def test_zen_keeps_plain_blocks(self):
+        post = Post.from_dict(dict(self.DATA, hashtags="#hr команда"), 'zen', '🌅')
+
+        self.assertEqual(post.blocks[0].text, "Заголовок")
+        self.assertEqual(post.blocks[2].text, "Мысль")
+        self.assertEqual(post.blocks[4].text, "#hr #команда")
+
+    def test_missing_or_empty_block(self):
+        self.assertIsNone(Post.from_dict(None, 'zen'))
+        self.assertIsNone(Post.from_dict({k: v for k, v in self.DATA.items() if k != "question"}, 'zen'))
+        self.assertIsNone(Post.from_dict(dict(self.DATA, hashtags=[]), 'zen'))
+        self.assertIsNone(Post.from_dict(dict(self.DATA, header="<b></b>"), 'telegram'))
+
+    def test_from_json_in_markdown(self):
+        raw = "Вот пост:\n```json\n" + json.dumps(self.DATA, ensure_ascii=False) + "\n```"
+
+        self.assertEqual(Post.from_json(raw, 'zen').render(), Post.from_dict(self.DATA, 'zen').render())
+        self.assertIsNone(Post.from_json("не json", 'zen'))
+        self.assertIsNone(Post.from_json("[1, 2]", 'zen'))
+
+    def test_rendered_post_parses_back(self):
+        post = Post.from_dict(self.DATA, 'telegram', '🌅')
+        parsed = Post.parse(post.render(), 'telegram', STYLE)
+
+        self.assertEqual([block.kind for block in parsed.blocks], list(Post.ORDER))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Без обязательных переменных модуль бота завершает процесс при импорте
+for name in ("BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_CHAT_ID"):
+    os.environ.setdefault(name, "test")
+
+from github_bot import FenwickTree, HistoryStore, RotationEngine
+
+
+class FenwickTreeTest(unittest.TestCase):
+    """FenwickTree против линейного прохода по префиксным суммам"""
+
+    def test_find_matches_linear_scan(self):
+        rng = random.Random(9)
+        for size in (1, 2, 3, 7, 16, 33):
+            weights = [rng.choice((0.0, 0.25, 0.5, 1.0, 2.0)) for _ in range(size)]
+            tree = FenwickTree(size)
+            for i, weight in enumerate(weights):
+                tree.update(i, weight)
+            self.assertAlmostEqual(tree.total(), sum(weights))
+
+            for _ in range(500):
+                value = rng.random() * tree.total()
+                prefix, expected = 0.0, size - 1
+                for i, weight in enumerate(weights):
+                    prefix += weight
+                    if prefix > value:
+                        expected = i
+                        break
+                with self.subTest(size=size, value=value):
+                    self.assertEqual(tree.find(value), expected)
+                    self.assertGreater(weights[tree.find(value)], 0)
+
+
+class RotationEngineTest(unittest.TestCase):
+    """RotationEngine: веса 1/(использований+1), x2 без использования bonus_days дней, сегодняшние исключены"""
+    ITEMS = ["a", "b", "c", "d"]
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.store = HistoryStore(os.path.join(directory, "bot_history.db"))
+        self.addCleanup(self.store.conn.close)
+        self.now = datetime(2026, 10, 17, 12, 0)
+
+    def day(self, days_ago: int) -> str:
+        return (self.now - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+
+    def engine(self, **kwargs) -> RotationEngine:
+        return RotationEngine("approach", self.ITEMS, self.store, lambda: self.now, **kwargs)
+
+    def test_weights(self):
+        self.store.record_usage("approach", "a", self.day(0))
+        self.store.record_usage("approach", "b", self.day(1))
+        self.store.record_usage("approach", "b", self.day(1))
+        self.store.record_usage("approach", "c", self.day(5))
+        self.store.record_usage("approach", "d", self.day(9))  # за пределами окна
+
+        engine = self.engine(window_days=7, bonus_days=2)
+
+        self.assertEqual(engine.weights, [0.0, 1 / 3, 1.0, 2.0])
+
+    def test_used_today_never_picked_and_record_updates_weight(self):
+        engine = self.engine()
+        engine.record("a")
+        engine.record("b")
+        engine.record("unknown")
+
+        self.assertEqual(engine.weights[:2], [0.0, 0.0])
+        self.assertTrue(all(engine.pick() in ("c", "d") for _ in range(200)))
+
+    def test_pick_follows_weights(self):
+        self.store.record_usage("approach", "a", self.day(1))
+        self.store.record_usage("approach", "a", self.day(1))
+        self.store.record_usage("approach", "a", self.day(1))
+        engine = self.engine(bonus_days=2)
+        random.seed(12)
+
+        picks = [engine.pick() for _ in range(8000)]
+
+        # Веса 0.25 и по 2.0: доля "a" - 1/25
+        self.assertAlmostEqual(picks.count("a") / len(picks), 0.25 / 6.25, delta=0.01)
+
+    def test_all_used_today_still_picks(self):
+        engine = self.engine()
+        for item in self.ITEMS:
+            engine.record(item)
+
+        self.assertIn(engine.pick(), self.ITEMS)
+
+    def test_rebuilds_on_new_day(self):
+        engine = self.engine()
+        engine.record("a")
+        self.assertEqual(engine.weights[0], 0.0)
+
+        self.now += timedelta(days=1)
+        engine.pick()
+
+        # Вчерашнее использование попало в хранилище: одно за окно, без бонуса
+        self.assertEqual(engine.weights[0], 0.5)
+        self.assertEqual(self.engine().weights[0], 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Без обязательных переменных модуль бота завершает процесс при импорте
+for name in ("BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_CHAT_ID"):
+    os.environ.setdefault(name, "test")
+
+from github_bot import SimHashIndex
+
+WORDS = ("команда руководитель проект сроки бюджет отчет встреча клиент задача решение риск качество "
+         "сотрудник обучение результат процесс план ремонт смета бренд кризис медиа").split()
+
+
+def reference_fingerprint(text: str) -> int:
+    """SimHash со счетчиком на каждый разряд - эталон для побитовой реализации"""
+    words = re.findall(r'\w+', text.lower())
+    shingles = [' '.join(words[i:i + 2]) for i in range(len(words) - 1)] if len(words) >= 2 else words
+    counts = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+        for bit in range(64):
+            counts[bit] += value >> bit & 1
+    return sum(1 << bit for bit in range(64) if counts[bit] > len(shingles) // 2)
+
+
+def random_text(rng: random.Random, length: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(length))
+
+
+class SimHashIndexTest(unittest.TestCase):
+    """SimHashIndex: отпечаток, поиск по полосам против перебора, хранение"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.filename = os.path.join(self.dir, "text_simhashes.bin")
+        self.rng = random.Random(8)
+
+    def test_fingerprint_matches_reference(self):
+        texts = ["", "слово", "Два слова"] + [random_text(self.rng, self.rng.randint(2, 150)) for _ in range(300)]
+        for text in texts:
+            with self.subTest(text=text[:30]):
+                self.assertEqual(SimHashIndex.fingerprint(text), reference_fingerprint(text))
+
+    def test_layout_covers_all_bits(self):
+        for max_distance in (1, 3, 10, 20):
+            with self.subTest(max_distance=max_distance):
+                bands = SimHashIndex._layout(max_distance)
+                covered = 0
+                for offset, mask, _ in bands:
+                    self.assertFalse(covered & (mask << offset))
+                    covered |= mask << offset
+                self.assertEqual(covered, (1 << 64) - 1)
+        self.assertEqual(len(SimHashIndex._layout(10)), 4)
+
+    def test_lookup_matches_brute_force(self):
+        index = SimHashIndex(self.filename, max_distance=10)
+        stored = [self.rng.getrandbits(64) for _ in range(5000)]
+        for fingerprint in stored:
+            index._index(fingerprint)
+
+        for _ in range(600):
+            query = self.rng.choice(stored)
+            for bit in self.rng.sample(range(64), self.rng.randint(0, 14)):
+                query ^= 1 << bit
+            distances = [bin(query ^ candidate).count('1') for candidate in stored]
+            expected = min((d for d in distances if d <= 10), default=None)
+            index.fingerprint = lambda text, query=query: query
+            self.assertEqual(index.nearest_distance(""), expected)
+
+    def test_near_duplicate_text_found(self):
+        index = SimHashIndex(self.filename, max_distance=10)
+        text = random_text(self.rng, 120)
+        index.add(text)
+        words = text.split()
+        words[60] = "переговоры"
+
+        self.assertIsNotNone(index.nearest_distance(' '.join(words)))
+        self.assertIsNone(index.nearest_distance(random_text(self.rng, 120)))
+
+    def test_persistence_and_disabled_index(self):
+        index = SimHashIndex(self.filename, max_distance=10)
+        index.add("первый пост про команду")
+        index.flush()
+
+        self.assertEqual(SimHashIndex(self.filename, max_distance=10).nearest_distance("первый пост про команду"), 0)
+        self.assertIsNone(SimHashIndex(self.filename, max_distance=0).nearest_distance("первый пост про команду"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Без обязательных переменных модуль бота завершает процесс при импорте
+for name in ("BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_CHAT_ID"):
+    os.environ.setdefault(name, "test")
+
+from github_bot import BloomFilter, TextHashIndex
+
+
+def text_hash(i: int) -> str:
+    return hashlib.md5(f"текст {i}".encode("utf-8")).hexdigest()
+
+
+class BloomFilterTest(unittest.TestCase):
+    """Фильтр Блума: без ложноотрицательных ответов, ложноположительные около расчетной доли"""
+
+    def test_no_false_negatives_and_error_rate(self):
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add(bytes.fromhex(text_hash(i)))
+
+        self.assertTrue(all(bytes.fromhex(text_hash(i)) in bloom for i in range(10000)))
+        false_positives = sum(bytes.fromhex(text_hash(i)) in bloom for i in range(10000, 30000))
+        # Расчетная доля 1%, с запасом на разброс
+        self.assertLess(false_positives / 20000, 0.02)
+
+
+class TextHashIndexTest(unittest.TestCase):
+    """TextHashIndex: точный set в памяти, фильтр Блума за горизонтом, append-only файл"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.filename = os.path.join(self.dir, "text_hashes.bin")
+
+    def test_add_contains_and_reload(self):
+        index = TextHashIndex(self.filename, memory_limit=100, bloom_capacity=0)
+        index.add(text_hash(1))
+        index.add(text_hash(1))
+
+        self.assertTrue(index.contains(text_hash(1)))
+        self.assertFalse(index.contains(text_hash(2)))
+        self.assertEqual(len(index), 1)
+
+        index.flush()
+        self.assertEqual(os.path.getsize(self.filename), 16)
+        self.assertTrue(TextHashIndex(self.filename, memory_limit=100, bloom_capacity=0).contains(text_hash(1)))
+
+    def test_bloom_covers_hashes_beyond_memory_limit(self):
+        index = TextHashIndex(self.filename, memory_limit=10, bloom_capacity=1000)
+        for i in range(100):
+            index.add(text_hash(i))
+
+        self.assertEqual(len(index), 10)
+        self.assertTrue(all(index.contains(text_hash(i)) for i in range(100)))
+
+        without_bloom = TextHashIndex(os.path.join(self.dir, "other.bin"), memory_limit=10, bloom_capacity=0)
+        for i in range(100):
+            without_bloom.add(text_hash(i))
+        self.assertFalse(without_bloom.contains(text_hash(0)))
+
+    def test_partial_tail_is_dropped(self):
+        index = TextHashIndex(self.filename, bloom_capacity=0)
+        index.add(text_hash(1))
+        index.flush()
+        with open(self.filename, "ab") as f:
+            f.write(b"\x00" * 5)
+
+        reloaded = TextHashIndex(self.filename, bloom_capacity=0)
+
+        self.assertEqual(len(reloaded), 1)
+        self.assertEqual(os.path.getsize(self.filename), 16)
+
+    def test_seed_on_first_run_only(self):
+        index = TextHashIndex(self.filename, bloom_capacity=0, seed=lambda: [text_hash(1), text_hash(2)])
+        self.assertTrue(index.contains(text_hash(2)))
+        self.assertEqual(os.path.getsize(self.filename), 32)
+
+        reloaded = TextHashIndex(self.filename, bloom_capacity=0, seed=lambda: [text_hash(3)])
+        self.assertFalse(reloaded.contains(text_hash(3)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Без обязательных переменных модуль бота завершает процесс при импорте
+for name in ("BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_CHAT_ID"):
+    os.environ.setdefault(name, "test")
+
+from github_bot import PostTextPipeline
+import legacy_text_cleanup
+
+THEME = "HR и управление персоналом"
+
+SAMPLE_POSTS = [
+    # Разметка по шаблону промпта: нумерация, метки, html и ** в Telegram
+    """[1] ЗАГОЛОВОК: 🌅 <b>Почему **команды** выгорают</b>
+[2] АБЗАЦ 1: Первое наблюдение о том, как устроена работа.
+[3] АБЗАЦ 2: Второе наблюдение, с деталями и цифрами 42%.
+[4] КЛЮЧЕВАЯ МЫСЛЬ: Выгорание - это сигнал, а не слабость.
+[5] ВОПРОС: А как у вас?
+[6] ХЕШТЕГИ: #hr #команда #выгорание""",
+    # Хештеги посередине, абзацы со строчной буквы, обрывок цифры и пустые строки
+    """🌇 Вечерний разбор
+
+мы снова обсуждаем планерки.
+#hr #планерки
+
+🎯 Ключевая мысль: короткая встреча честнее длинной.
+
+
+5
+Ключевая мысль итог: меньше слайдов
+вопрос: сколько длится ваша планерка?""",
+    # Ни одного хештега - добавляются по теме
+    """ЗАГОЛОВОК: Как писать пресс-релиз
+АБЗАЦ: Начните с факта, а не с эпитетов.
+ВОПРОС: Что вы пишете первым?""",
+    # Англоязычные метки и метка без двоеточия
+    """HEADER: Ремонт без сюрпризов
+Пустая строка
+PARAGRAPH: смета - это договор с самим собой.
+[текст без закрывающей скобки
+KEY THOUGHT: Закладывайте 15% резерва.
+HASHTAGS: #ремонт #смета""",
+]
+
+
+def intended_legacy_output(text: str, post_type: str, theme: str) -> str:
+    """Вывод старой очистки с исправлениями, которые в ней были задуманы, но не применялись:
+    абзацы с заглавной буквы и хештеги Telegram в конце"""
+    blocks = legacy_text_cleanup.postprocess(text, post_type, theme).split('\n\n')
+    blocks = [block[0].upper() + block[1:] if i > 0 and block[0].islower() and not block.startswith('#') else block
+              for i, block in enumerate(blocks)]
+    if post_type == 'telegram':
+        blocks = ([block for block in blocks if not block.startswith('#')] +
+                  [block for block in blocks if block.startswith('#')])
+    return '\n\n'.join(blocks)
+
+
+class PostTextPipelineTest(unittest.TestCase):
+    """PostTextPipeline против очистки до него (tests/legacy_text_cleanup.py)"""
+
+    def setUp(self):
+        self.pipeline = PostTextPipeline()
+
+    def test_matches_legacy_with_intended_fixes(self):
+        for text in SAMPLE_POSTS:
+            for post_type in ('telegram', 'zen'):
+                for theme in (THEME, None):
+                    with self.subTest(text=text[:30], post_type=post_type, theme=theme):
+                        self.assertEqual(self.pipeline.process(text, post_type, theme),
+                                         intended_legacy_output(text, post_type, theme))
+
+    def test_clean_post_is_unchanged_from_legacy(self):
+        text = SAMPLE_POSTS[0]
+        for post_type in ('telegram', 'zen'):
+            with self.subTest(post_type=post_type):
+                self.assertEqual(self.pipeline.process(text, post_type, THEME),
+                                 legacy_text_cleanup.postprocess(text, post_type, THEME))
+
+    def test_paragraphs_capitalized_and_hashtags_moved(self):
+        text = SAMPLE_POSTS[1]
+
+        self.assertEqual(self.pipeline.process(text, 'telegram', THEME), "\n\n".join([
+            "🌇 Вечерний разбор",
+            "Мы снова обсуждаем планерки.",
+            "Короткая встреча честнее длинной.",
+            "Итог: меньше слайдов",
+            "Сколько длится ваша планерка?",
+            "#hr #планерки",
+        ]))
+        # Старая очистка оставляла строчные буквы и хештеги посередине
+        self.assertIn("мы снова обсуждаем планерки.\n\n#hr #планерки",
+                      legacy_text_cleanup.postprocess(text, 'telegram', THEME))
+        # В Дзене хештеги остаются на месте
+        self.assertIn("Мы снова обсуждаем планерки.\n\n#hr #планерки",
+                      self.pipeline.process(text, 'zen', THEME))
+
+    def test_theme_hashtags_added_when_missing(self):
+        result = self.pipeline.process(SAMPLE_POSTS[2], 'telegram', THEME)
+
+        self.assertTrue(result.endswith("\n\n#управление #персоналом"))
+        self.assertEqual(result, legacy_text_cleanup.postprocess(SAMPLE_POSTS[2], 'telegram', THEME))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import http.client
+import json
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Без обязательных переменных модуль бота завершает процесс при импорте
+for name in ("BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_CHAT_ID"):
+    os.environ.setdefault(name, "test")
+
+from github_bot import WebhookServer
+
+
+class WebhookServerTest(unittest.TestCase):
+    """WebhookServer как локальная замена Telegram: POST обновления -> on_update"""
+    SECRET = "test-secret"
+
+    def setUp(self):
+        self.updates = []
+        self.received = threading.Event()
+
+        def on_update(update):
+            self.updates.append(update)
+            self.received.set()
+
+        self.server = WebhookServer("127.0.0.1", 0, self.SECRET, on_update)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def post(self, body: bytes, headers: dict) -> int:
+        conn = http.client.HTTPConnection("127.0.0.1", self.server.port, timeout=5)
+        self.addCleanup(conn.close)
+        conn.request("POST", "/", body=body, headers=headers)
+        return conn.getresponse().status
+
+    def test_update_is_dispatched(self):
+        update = {"update_id": 1, "callback_query": {"id": "42", "data": "publish"}}
+        status = self.post(json.dumps(update).encode("utf-8"),
+                           {"Content-Type": "application/json", WebhookServer.SECRET_HEADER: self.SECRET})
+
+        self.assertEqual(status, 200)
+        self.assertTrue(self.received.wait(5))
+        self.assertEqual(self.updates, [update])
+
+    def test_wrong_secret_is_rejected(self):
+        status = self.post(b'{"update_id": 2}', {WebhookServer.SECRET_HEADER: "wrong"})
+
+        self.assertEqual(status, 403)
+        self.assertEqual(self.updates, [])
+
+    def test_non_ascii_secret_is_rejected(self):
+        status = self.post(b'{"update_id": 4}', {WebhookServer.SECRET_HEADER: "секрет".encode("utf-8")})
+
+        self.assertEqual(status, 403)
+        self.assertEqual(self.updates, [])
+
+    def test_bad_content_length_is_rejected(self):
+        status = self.post(b'{"update_id": 3}', {WebhookServer.SECRET_HEADER: self.SECRET, "Content-Length": "abc"})
+
+        self.assertEqual(status, 400)
+        self.assertEqual(self.updates, [])
+
+
+if __name__ == "__main__":
+    unittest.main()